@@ -0,0 +1,203 @@
+import html
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Callable
+from urllib.parse import quote
+
+import httpx
+from loguru import logger
+
+from Config import *
+
+# Tag shared by all the work items of one export, and tag identifying each work item within the export
+EXPORT_TAG = "agile-crew-export:"
+ITEM_TAG = "agile-crew-item:"
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+PARENT_RELATION = "System.LinkTypes.Hierarchy-Reverse"
+# Most work items a single workitemsbatch request returns
+BATCH_SIZE = 200
+
+
+class AdoExportError(Exception):
+    """ Raised when some work items could not be created, exporting again only creates the missing ones """
+
+    def __init__(self, export_key: str, failed: dict):
+        super().__init__(f"{len(failed)} work items of export '{export_key}' could not be created, export the feature "
+                         f"again to create the missing ones")
+        self.export_key = export_key
+        self.failed = failed
+
+
+class AdoProject:
+    """ Azure DevOps project the features are exported to """
+
+    def __init__(self, organization_url: str, project_name: str, pat: str):
+        self.organization_url = organization_url.rstrip("/")
+        self.project_name = project_name
+        self.pat = pat
+
+    @classmethod
+    def from_environment(cls) -> "AdoProject":
+        """ Project of the AZURE_DEVOPS_ORGANIZATION_URL, AZURE_DEVOPS_PROJECT and AZURE_DEVOPS_PAT variables """
+        names = ["AZURE_DEVOPS_ORGANIZATION_URL", "AZURE_DEVOPS_PROJECT", "AZURE_DEVOPS_PAT"]
+        missing = [name for name in names if not os.environ.get(name)]
+        if missing:
+            raise ValueError(f"Set {', '.join(missing)} or pass the Azure DevOps project to export to")
+        return cls(*(os.environ[name] for name in names))
+
+
+class AdoClient:
+    """ Work item REST client of one project. Its connection pool is shared by the threads of an export. """
+
+    def __init__(self, project: AdoProject):
+        self.project = project
+        self.max_retries = config.get_value_by_mapping(ConfigMapping.ADO_MAX_RETRIES)
+        max_concurrency = config.get_value_by_mapping(ConfigMapping.ADO_MAX_CONCURRENCY)
+        self.http = httpx.Client(base_url=f"{project.organization_url}/{quote(project.project_name)}/_apis/wit/",
+                                 auth=("", project.pat),
+                                 params={"api-version": config.get_value_by_mapping(ConfigMapping.ADO_API_VERSION)},
+                                 limits=httpx.Limits(max_connections=max_concurrency,
+                                                     max_keepalive_connections=max_concurrency),
+                                 timeout=config.get_value_by_mapping(ConfigMapping.ADO_TIMEOUT))
+
+    def request(self, method: str, url: str, on_retry: Callable[[], dict | None] | None = None, **kwargs) -> dict:
+        """ Send the request, retrying throttled, failed and lost ones. `on_retry` runs before every retry and its
+        result, if any, is returned instead of sending the request again. """
+        for attempt in range(1, self.max_retries + 2):
+            if attempt > 1 and on_retry is not None:
+                result = on_retry()
+                if result is not None:
+                    return result
+            try:
+                response = self.http.request(method, url, **kwargs)
+                if response.status_code not in RETRY_STATUS_CODES:
+                    response.raise_for_status()
+                    return response.json()
+                error, delay = f"HTTP {response.status_code}", response.headers.get("Retry-After")
+            except httpx.TransportError as e:
+                error, delay = f"{type(e).__name__}: {e}", None
+            if attempt > self.max_retries:
+                raise httpx.HTTPError(f"{method} {url} failed after {attempt} attempts, last error: {error}")
+            # Utils pulls in langchain, it is only needed once a request has failed
+            from Utils import retry_delay
+            delay = float(delay) if delay is not None else retry_delay(attempt)
+            logger.warning(f"{method} {url} failed ({error}), retrying in {delay:.2f}s")
+            time.sleep(delay)
+
+    def find_exported(self, tag: str) -> dict:
+        """ Urls of the work items carrying `tag`, by their item key """
+        query = {"query": "SELECT [System.Id] FROM WorkItems WHERE [System.TeamProject] = @project "
+                          f"AND [System.Tags] CONTAINS '{tag}'"}
+        ids = [work_item["id"] for work_item in self.request("POST", "wiql", json=query)["workItems"]]
+        urls = {}
+        for start in range(0, len(ids), BATCH_SIZE):
+            batch = self.request("POST", "workitemsbatch",
+                                 json={"ids": ids[start:start + BATCH_SIZE], "fields": ["System.Tags"]})
+            for work_item in batch["value"]:
+                for item_tag in work_item["fields"].get("System.Tags", "").split(";"):
+                    if item_tag.strip().startswith(ITEM_TAG):
+                        urls[item_tag.strip()[len(ITEM_TAG):]] = work_item["url"]
+        return urls
+
+    def create_work_item(self, item_key: str, work_item_type: str, fields: dict, tags: list,
+                         parent_url: str | None = None) -> str:
+        """ Create the work item and return its url. A retried creation first looks the item up by its key, the
+        failed request may have created it before its response was lost. """
+        body = [{"op": "add", "path": f"/fields/{field}", "value": value} for field, value in fields.items()]
+        body.append({"op": "add", "path": "/fields/System.Tags", "value": "; ".join(tags)})
+        if parent_url is not None:
+            body.append({"op": "add", "path": "/relations/-", "value": {"rel": PARENT_RELATION, "url": parent_url}})
+
+        def find_created():
+            url = self.find_exported(ITEM_TAG + item_key).get(item_key)
+            return {"url": url} if url is not None else None
+
+        return self.request("POST", f"workitems/${quote(work_item_type)}", on_retry=find_created, json=body,
+                            headers={"Content-Type": "application/json-patch+json"})["url"]
+
+    def close(self):
+        self.http.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def export_key(feature: dict) -> str:
+    """ Key of the exports of a feature, its id, so the feature keeps its work items when its content is edited """
+    if not feature.get("id"):
+        raise ValueError("The feature has no id, pass the key of its export")
+    return feature["id"]
+
+
+def html_list(items: list) -> str:
+    return "<ul>" + "".join(f"<li>{html.escape(item)}</li>" for item in items) + "</ul>"
+
+
+def plan_work_items(feature: dict) -> list:
+    """ Work items of the feature by level, every one is (item key, type, fields, parent item key) and its parent is
+    in the previous level. Descriptions and acceptance criteria are HTML fields: the text is escaped so `<role>` and
+    the like are kept, and the list of acceptance criteria becomes a bulleted list. Titles are plain text. """
+    user_stories = feature["user_stories"]
+    return [
+        [("feature", "Feature",
+          {"System.Title": feature["title"], "System.Description": html.escape(feature["description"])}, None)],
+        [(f"us-{i}", "User Story",
+          {"System.Title": us["title"], "System.Description": html.escape(us["description"]),
+           "Microsoft.VSTS.Common.AcceptanceCriteria": html_list(us["acceptance_criteria"])}, "feature")
+         for i, us in enumerate(user_stories)],
+        [(f"us-{i}/task-{j}", "Task",
+          {"System.Title": task["title"], "System.Description": html.escape(task["description"])}, f"us-{i}")
+         for i, us in enumerate(user_stories) for j, task in enumerate(us["tasks"])],
+    ]
+
+
+def export_feature(client: AdoClient, feature: dict, key: str | None = None,
+                   on_progress: Callable[[int, int], None] | None = None, max_concurrency: int | None = None) -> dict:
+    """ Create the feature, its user stories and their tasks as Azure DevOps work items, the items of each level
+    concurrently. Every work item is tagged with the export key, `key` or the feature id, so exporting the same
+    feature again, also after an edit, only creates the items missing from the previous attempts, the existing ones
+    are not updated. `on_progress(done, total)` is called from the calling thread.
+    Returns the work item url of every item key. """
+    key = key or export_key(feature)
+    max_concurrency = max_concurrency or config.get_value_by_mapping(ConfigMapping.ADO_MAX_CONCURRENCY)
+    levels = plan_work_items(feature)
+    total = sum(len(level) for level in levels)
+    urls = {item_key[len(key) + 1:]: url for item_key, url in client.find_exported(EXPORT_TAG + key).items()
+            if item_key.startswith(key + "/")}
+    if urls:
+        logger.info(f"Export {key}: {len(urls)} of {total} work items already exist")
+    failed = {}
+    done = len(urls)
+    if on_progress is not None:
+        on_progress(done, total)
+
+    with ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="ado-export") as executor:
+        for level in levels:
+            futures = {}
+            for item_key, work_item_type, fields, parent in level:
+                if item_key in urls:
+                    continue
+                if parent is not None and parent not in urls:
+                    failed[item_key] = f"Parent {parent} was not created"
+                    continue
+                tags = [EXPORT_TAG + key, f"{ITEM_TAG}{key}/{item_key}"]
+                futures[executor.submit(client.create_work_item, f"{key}/{item_key}", work_item_type, fields, tags,
+                                        urls.get(parent))] = item_key
+            for future in as_completed(futures):
+                item_key = futures[future]
+                try:
+                    urls[item_key] = future.result()
+                    done += 1
+                except Exception as e:
+                    logger.error(f"Work item {item_key} of export {key} failed: {e}")
+                    failed[item_key] = str(e)
+                if on_progress is not None:
+                    on_progress(done, total)
+
+    if failed:
+        raise AdoExportError(key, failed)
+    return urls
@@ -1,17 +1,21 @@
+import asyncio
 import functools
+import time
 
 from dotenv import load_dotenv
 from langchain.agents import AgentExecutor
 from langchain.agents.format_scratchpad import format_to_openai_function_messages
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
-from langchain_openai import AzureChatOpenAI
+from langchain_core.runnables import RunnableConfig, RunnableLambda
 from loguru import logger
 
-from AgileTools import get_project_context
+from AgileTools import get_agent_tools, get_project_context_messages
 from Config import *
-from Utils import create_agent
+from LLMCache import deferred_cache_writes
+from LLMClients import get_chat_model
+from Utils import create_agent, register_node_result, retry_delay, tag_user_story
 from models.AgileCrewModels import ListOfTasks, \
-    ListOfAcceptanceCriteria, ListOfUserStories
+    ListOfAcceptanceCriteria, ListOfUserStories, AcceptanceCriteriaAndTasks
 
 load_dotenv()
 
@@ -19,13 +23,15 @@ load_dotenv()
 
 class AgentCreator:
 
-    def __init__(self, type: str):
+    def __init__(self, type: str, api_key: str | None = None):
         self.type = type
+        self.api_key = api_key
 
     def get_prompt(self):
         if self.type == "user_story":
             return ChatPromptTemplate([MessagesPlaceholder("messages"),
                                 ("system", config.get_value_by_mapping(ConfigMapping.AGENT_PROMPT_US)),
+                             *get_project_context_messages(),
                              ("user", "Feature description: \n {feature_description}"),
                              ("user", "This is some feedback from previously created user stories:\n {feedback}"),
                              ("user", "Previously created user stories:\n {previously_created_user_stories}"),
@@ -37,6 +43,7 @@ class AgentCreator:
             return ChatPromptTemplate(
                     [MessagesPlaceholder("messages"),
                      ("system", config.get_value_by_mapping(ConfigMapping.AGENT_PROMPT_AC)),
+                     *get_project_context_messages(),
                      ("user", "Feature description: \n {feature_description}"),
                      ("user", "User story:\n {user_story_to_process}"),
                      ("user", "This is some feedback from previously created acceptance_criteria:\n {feedback}"),
@@ -48,6 +55,7 @@ class AgentCreator:
         elif self.type =="tasks":
             return ChatPromptTemplate(
                 [MessagesPlaceholder("messages"),("system", config.get_value_by_mapping(ConfigMapping.AGENT_PROMPT_TASKS)),
+                 *get_project_context_messages(),
                  ("user", "User story:\n {user_story_to_process}"),
                  ("user", "Acceptance criteria:\n {acceptance_criteria}"),
                  ("user", "This is some feedback from previusly created tasks:\n {feedback}"),
@@ -56,24 +64,45 @@ class AgentCreator:
                  MessagesPlaceholder("agent_scratchpad")],
     input_variables=["examples", "agent_scratchpad", "user_story_to_process", "feedback",
                      "acceptance_criteria", "previously_created_tasks"]).partial(examples="")
+        elif self.type == "acceptance_criteria_and_tasks":
+            return ChatPromptTemplate(
+                [MessagesPlaceholder("messages"),
+                 ("system", config.get_value_by_mapping(ConfigMapping.AGENT_PROMPT_AC)),
+                 ("system", config.get_value_by_mapping(ConfigMapping.AGENT_PROMPT_TASKS)),
+                 *get_project_context_messages(),
+                 ("user", "Feature description: \n {feature_description}"),
+                 ("user", "User story:\n {user_story_to_process}"),
+                 ("user", "This is some feedback from previously created acceptance criteria and tasks:\n {feedback}"),
+                 ("user", "Previously created acceptance criteria:\n {previously_created_ac}"),
+                 ("user", "Previously created tasks:\n {previously_created_tasks}"),
+                 ("system", "Return the acceptance criteria and the tasks together using the "
+                            "'AcceptanceCriteriaAndTasks' tool provided."),
+                 MessagesPlaceholder("agent_scratchpad")],
+                input_variables=["examples", "agent_scratchpad", "user_story_to_process", "feedback",
+                                 "previously_created_ac", "previously_created_tasks"]).partial(examples="")
 
 
     def get_llm_with_tools(self):
         if self.type == "user_story":
-            return AzureChatOpenAI(model=config.get_value_by_mapping(ConfigMapping.AGENT_MODEL_DEPLOYED_US),
-                               temperature=config.get_value_by_mapping(ConfigMapping.AGENT_MODEL_TEMPERATURE_US)).bind_functions([get_project_context, ListOfUserStories])
+            return get_chat_model(config.get_value_by_mapping(ConfigMapping.AGENT_MODEL_DEPLOYED_US),
+                                  config.get_value_by_mapping(ConfigMapping.AGENT_MODEL_TEMPERATURE_US), self.api_key).bind_functions([*get_agent_tools(), ListOfUserStories])
         elif self.type == "acceptance_criteria":
-            return AzureChatOpenAI(model=config.get_value_by_mapping(ConfigMapping.AGENT_MODEL_DEPLOYED_AC),
-                               temperature=config.get_value_by_mapping(ConfigMapping.AGENT_MODEL_TEMPERATURE_AC)).bind_functions([get_project_context, ListOfAcceptanceCriteria])
+            return get_chat_model(config.get_value_by_mapping(ConfigMapping.AGENT_MODEL_DEPLOYED_AC),
+                                  config.get_value_by_mapping(ConfigMapping.AGENT_MODEL_TEMPERATURE_AC), self.api_key).bind_functions([*get_agent_tools(), ListOfAcceptanceCriteria])
         elif self.type == "tasks":
-            return AzureChatOpenAI(model=config.get_value_by_mapping(ConfigMapping.AGENT_MODEL_DEPLOYED_TASKS),
-                               temperature=config.get_value_by_mapping(ConfigMapping.AGENT_MODEL_TEMPERATURE_TASKS)).bind_functions([get_project_context, ListOfTasks])
+            return get_chat_model(config.get_value_by_mapping(ConfigMapping.AGENT_MODEL_DEPLOYED_TASKS),
+                                  config.get_value_by_mapping(ConfigMapping.AGENT_MODEL_TEMPERATURE_TASKS), self.api_key).bind_functions([*get_agent_tools(), ListOfTasks])
+        elif self.type == "acceptance_criteria_and_tasks":
+            # The combined creator runs on the deployment of the acceptance criteria agent
+            return get_chat_model(config.get_value_by_mapping(ConfigMapping.AGENT_MODEL_DEPLOYED_AC),
+                                  config.get_value_by_mapping(ConfigMapping.AGENT_MODEL_TEMPERATURE_AC), self.api_key).bind_functions([*get_agent_tools(), AcceptanceCriteriaAndTasks])
 
     def get_inputs(self):
         if self.type == "user_story":
             return {
                 "messages": lambda x: x["messages"],
                 "feature_description": lambda x: x["feature_description"],
+                "project_context": lambda x: x["project_context"],
                 "feedback": lambda x: str(x["feedback"]) if x["feedback"] not in (None, "") else "No feedback received, this is the first iteration.",
                 "previously_created_user_stories": lambda x: str(x["user_stories"]) if x["user_stories"] is not None else "No user stories to review, this is the first iteration.",
                 # Format agent scratchpad from intermediate steps
@@ -86,6 +115,7 @@ class AgentCreator:
                 "messages": lambda x: x["messages"],
                 "user_story_to_process": lambda x: str(x["user_story_to_process"]),
                 "feature_description": lambda x: x["feature_description"],
+                "project_context": lambda x: x["project_context"],
                 "feedback": lambda x: str(x["feedback"])  if x["feedback"] not in (None, "") else "No feedback received, this is the first iteration.",
                 "previously_created_ac": lambda x: str(x["acceptance_criteria_us"][-1]) if x["feedback"] not in (None,"") else None,
                 # Format agent scratchpad from intermediate steps
@@ -96,6 +126,7 @@ class AgentCreator:
         elif self.type == "tasks":
             return {
                 "messages": lambda x: x["messages"],
+                "project_context": lambda x: x["project_context"],
                 "user_story_to_process": lambda x: str(x["user_story_to_process"]),
                 "acceptance_criteria": lambda x: str(x["acceptance_criteria_us"][-1]),
                 "feedback": lambda x: str(x["feedback"]) if x["feedback"] not in (None, "") else "No feedback received, this is the first iteration.",
@@ -105,10 +136,46 @@ class AgentCreator:
                     x["intermediate_steps"]
                 ),
             }
+        elif self.type == "acceptance_criteria_and_tasks":
+            return {
+                "messages": lambda x: x["messages"],
+                "user_story_to_process": lambda x: str(x["user_story_to_process"]),
+                "feature_description": lambda x: x["feature_description"],
+                "project_context": lambda x: x["project_context"],
+                "feedback": lambda x: str(x["feedback"]) if x["feedback"] not in (None, "") else "No feedback received, this is the first iteration.",
+                "previously_created_ac": lambda x: str(x["acceptance_criteria_us"][-1]) if x["feedback"] not in (None, "") else None,
+                "previously_created_tasks": lambda x: str(x["tasks"][-1]) if x["feedback"] not in (None, "") else None,
+                # Format agent scratchpad from intermediate steps
+                "agent_scratchpad": lambda x: format_to_openai_function_messages(
+                    x["intermediate_steps"]
+                ),
+            }
+
+    @staticmethod
+    def agent_node(state, config: RunnableConfig, agent, name, process_output):
+        # A retry gets a new response from the model, not the one the cache holds for its prompt
+        with deferred_cache_writes(skip_lookups=name in (state.get("retry_attempts") or {})) as cache_writes:
+            result = agent.invoke(state, tag_user_story(state, config), return_only_outputs=True, )
+        update = register_node_result(state, process_output(state, result), name, config)
+        if update["next"] == "ERROR":
+            time.sleep(retry_delay(update["retry_attempts"][name]))
+        else:
+            cache_writes.commit()
+        return update
+
+    @staticmethod
+    async def aagent_node(state, config: RunnableConfig, agent, name, process_output):
+        with deferred_cache_writes(skip_lookups=name in (state.get("retry_attempts") or {})) as cache_writes:
+            result = await agent.ainvoke(state, tag_user_story(state, config), return_only_outputs=True, )
+        update = register_node_result(state, process_output(state, result), name, config)
+        if update["next"] == "ERROR":
+            await asyncio.sleep(retry_delay(update["retry_attempts"][name]))
+        else:
+            cache_writes.commit()
+        return update
 
     @staticmethod
-    def agent_node_us(state, agent, name):
-        result = agent.invoke(state, return_only_outputs=True, )
+    def process_output_us(state, result):
         try:
             us = ListOfUserStories(**result)
         except Exception as e:
@@ -121,8 +188,7 @@ class AgentCreator:
         }
 
     @staticmethod
-    def agent_node_tasks(state, agent, name):
-        result = agent.invoke(state)
+    def process_output_tasks(state, result):
         try:
             new_tasks = ListOfTasks(**result)
         except Exception as e:
@@ -140,8 +206,7 @@ class AgentCreator:
         }
 
     @staticmethod
-    def agent_node_ac(state, agent, name):
-        result = agent.invoke(state)
+    def process_output_ac(state, result):
         try:
             new_ac = ListOfAcceptanceCriteria(**result)
         except Exception as e:
@@ -158,12 +223,31 @@ class AgentCreator:
             "next": "CONTINUE",
             "acceptance_criteria_us": acceptance_criteria
         }
+
+    @staticmethod
+    def process_output_ac_tasks(state, result):
+        try:
+            combined = AcceptanceCriteriaAndTasks(**result)
+        except Exception as e:
+            logger.error(f"Error parsing the output: {e}")
+            return {"next": "ERROR"}
+        update = AgentCreator.process_output_ac(state, {"acceptance_criteria": combined.acceptance_criteria})
+        update.update(AgentCreator.process_output_tasks(state, {"tasks": combined.tasks}))
+        return update
+
     def create_agent_node(self):
         agent = create_agent(self.get_llm_with_tools(), self.get_prompt(), self.get_inputs())
-        agent_executor = AgentExecutor(tools=[get_project_context], agent=agent, verbose=True)
+        agent_executor = AgentExecutor(tools=get_agent_tools(), agent=agent)
         if self.type == "user_story":
-            return functools.partial(self.agent_node_us, agent=agent_executor, name="user_story_creation")
+            name, process_output = "user_story_creation", self.process_output_us
         elif self.type == "acceptance_criteria":
-            return functools.partial(self.agent_node_ac, agent=agent_executor, name="acceptance_criteria_creation")
+            name, process_output = "acceptance_criteria_creation", self.process_output_ac
         elif self.type == "tasks":
-            return functools.partial(self.agent_node_tasks, agent=agent_executor, name="tasks_creation")
+            name, process_output = "tasks_creation", self.process_output_tasks
+        elif self.type == "acceptance_criteria_and_tasks":
+            name, process_output = "acceptance_criteria_and_tasks_creation", self.process_output_ac_tasks
+        # The same node serves both graph.invoke and graph.ainvoke
+        return RunnableLambda(
+            functools.partial(self.agent_node, agent=agent_executor, name=name, process_output=process_output),
+            afunc=functools.partial(self.aagent_node, agent=agent_executor, name=name, process_output=process_output),
+            name=name)
@@ -1,20 +1,27 @@
+import asyncio
 import functools
+import time
 
 from langchain.agents import AgentExecutor
 from langchain.agents.format_scratchpad import format_to_openai_function_messages
+from langchain_core.callbacks.manager import adispatch_custom_event, dispatch_custom_event
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
-from langchain_openai import AzureChatOpenAI
+from langchain_core.runnables import RunnableConfig, RunnableLambda
 from loguru import logger
 
-from AgileTools import get_project_context
+from AgileTools import get_agent_tools, get_project_context_messages
 from Config import *
-from Utils import create_agent
+from LLMCache import deferred_cache_writes
+from LLMClients import get_chat_model
+from Utils import create_agent, register_node_result, retry_delay, tag_user_story
+from VerificationRules import acceptance_criteria_issues, rules_feedback, tasks_issues, user_stories_issues
 from models.AgileCrewModels import FeedbackOutput
 
 
 class AgentVerifier:
-    def __init__(self, type):
+    def __init__(self, type, api_key: str | None = None):
         self.type = type
+        self.api_key = api_key
         self.prompt = self.create_prompt()
 
     def prepare_agent_inputs(self) -> dict:
@@ -22,6 +29,7 @@ class AgentVerifier:
             return {
                 "messages": lambda x: x["messages"],
                 "feature_description": lambda x: x["feature_description"],
+                "project_context": lambda x: x["project_context"],
                 "feedback": lambda x: x["feedback"] if str(x["feedback"]) not in (None, "") else "No feedback to review, this is the first iteration.",
                 "user_stories": lambda x: str(x["user_stories"]) if x["user_stories"] is not None else "No user stories to "
                                                                                               "review, this is the "
@@ -34,6 +42,7 @@ class AgentVerifier:
             return {
                 "user_story_to_process": lambda x: str(x["user_story_to_process"]),
                 "feature_description": lambda x: x["feature_description"],
+                "project_context": lambda x: x["project_context"],
                 "feedback": lambda x: str(x["feedback"]) if x["feedback"] not in (None, "") else "No feedback to review, this is the first iteration.",
                 "acceptance_criteria": lambda x: str(x["acceptance_criteria_us"][-1]),
                 "agent_scratchpad": lambda x: format_to_openai_function_messages(
@@ -42,6 +51,7 @@ class AgentVerifier:
             }
         elif self.type == "tasks":
             return {
+                "project_context": lambda x: x["project_context"],
                 "user_story_to_process": lambda x: str(x["user_story_to_process"]),
                 "acceptance_criteria": lambda x: str(x["acceptance_criteria_us"][-1]),
                 "feedback": lambda x: str(x["feedback"]) if x["feedback"] not in (None, "") else "No feedback to review, this is the first iteration.",
@@ -50,11 +60,24 @@ class AgentVerifier:
                     x["intermediate_steps"]
                 ),
             }
+        elif self.type == "acceptance_criteria_and_tasks":
+            return {
+                "project_context": lambda x: x["project_context"],
+                "feature_description": lambda x: x["feature_description"],
+                "user_story_to_process": lambda x: str(x["user_story_to_process"]),
+                "acceptance_criteria": lambda x: str(x["acceptance_criteria_us"][-1]),
+                "tasks": lambda x: str(x["tasks"][-1]),
+                "feedback": lambda x: str(x["feedback"]) if x["feedback"] not in (None, "") else "No feedback to review, this is the first iteration.",
+                "agent_scratchpad": lambda x: format_to_openai_function_messages(
+                    x["intermediate_steps"]
+                ),
+            }
 
     def create_prompt(self) -> ChatPromptTemplate:
         if self.type == "user_story":
             return ChatPromptTemplate([
                 ("system", config.get_value_by_mapping(ConfigMapping.AGENT_PROMPT_CHECK_US)),
+                *get_project_context_messages(),
                 ("user", "Feature description: \n{feature_description}"),
                 ("user", "User stories to review:\n{user_stories}"),
                 ("user", "Previously returned feedback:\n{feedback}"),
@@ -65,6 +88,7 @@ class AgentVerifier:
         elif self.type == "acceptance_criteria":
             return ChatPromptTemplate([
                 ("system", config.get_value_by_mapping(ConfigMapping.AGENT_PROMPT_CHECK_AC)),
+                *get_project_context_messages(),
                 ("user", "Feature description: \n{feature_description}"),
                 ("user", "User story:\n{user_story_to_process}"),
                 ("user", "Acceptance criteria to review:\n{acceptance_criteria}"),
@@ -76,6 +100,7 @@ class AgentVerifier:
         elif self.type == "tasks":
             return ChatPromptTemplate([
                 ("system", config.get_value_by_mapping(ConfigMapping.AGENT_PROMPT_CHECK_TASKS)),
+                *get_project_context_messages(),
                 ("user", "User story:\n{user_story_to_process}"),
                 ("user", "Acceptance criteria:\n{acceptance_criteria}"),
                 ("user", "Tasks to check:\n{tasks}"),
@@ -85,6 +110,21 @@ class AgentVerifier:
                 input_variables=["examples", "agent_scratchpad",
                                  "feedback", "acceptance_criteria", "user_story_to_process", "tasks",
                                  "feedback_tasks"]).partial(examples="")
+        elif self.type == "acceptance_criteria_and_tasks":
+            return ChatPromptTemplate([
+                ("system", config.get_value_by_mapping(ConfigMapping.AGENT_PROMPT_CHECK_AC)),
+                ("system", config.get_value_by_mapping(ConfigMapping.AGENT_PROMPT_CHECK_TASKS)),
+                *get_project_context_messages(),
+                ("user", "Feature description: \n{feature_description}"),
+                ("user", "User story:\n{user_story_to_process}"),
+                ("user", "Acceptance criteria to review:\n{acceptance_criteria}"),
+                ("user", "Tasks to review:\n{tasks}"),
+                ("user", "Previously returned feedback:\n{feedback}"),
+                ("system", "Review the acceptance criteria and the tasks together and return a single feedback "
+                           "using the 'FeedbackOutput' tool provided."),
+                MessagesPlaceholder("agent_scratchpad")],
+                input_variables=["examples", "agent_scratchpad", "feature_description",
+                                 "feedback", "acceptance_criteria", "user_story_to_process", "tasks"]).partial(examples="")
 
 
     def create_verifier_agent(self):
@@ -97,8 +137,11 @@ class AgentVerifier:
         elif self.type == "tasks":
             model_name = config.get_value_by_mapping(ConfigMapping.AGENT_MODEL_DEPLOYED_CHECK_TASKS)
             model_temp = config.get_value_by_mapping(ConfigMapping.AGENT_MODEL_TEMPERATURE_CHECK_TASKS)
-        llm_with_tools = AzureChatOpenAI(model=model_name,temperature=model_temp).\
-            bind_functions([get_project_context, FeedbackOutput])
+        elif self.type == "acceptance_criteria_and_tasks":
+            model_name = config.get_value_by_mapping(ConfigMapping.AGENT_MODEL_DEPLOYED_CHECK_AC)
+            model_temp = config.get_value_by_mapping(ConfigMapping.AGENT_MODEL_TEMPERATURE_CHECK_AC)
+        llm_with_tools = get_chat_model(model_name, model_temp, self.api_key).\
+            bind_functions([*get_agent_tools(), FeedbackOutput])
 
         return create_agent(llm_with_tools, self.prompt, self.prepare_agent_inputs())
 
@@ -118,15 +161,44 @@ class AgentVerifier:
                 "check_enabled": config.get_value_by_mapping(ConfigMapping.CHECK_TASKS_ENABLED),
                 "max_verification_attempts": config.get_value_by_mapping(ConfigMapping.MAX_TASKS_VERIFICATION_ATTEMPTS),
             }
+        elif self.type == "acceptance_criteria_and_tasks":
+            # Reviewed when either check is enabled, with the most attempts of the two
+            return {
+                "check_enabled": config.get_value_by_mapping(ConfigMapping.CHECK_AC_ENABLED) or
+                                 config.get_value_by_mapping(ConfigMapping.CHECK_TASKS_ENABLED),
+                "max_verification_attempts": max(
+                    config.get_value_by_mapping(ConfigMapping.MAX_AC_VERIFICATION_ATTEMPTS),
+                    config.get_value_by_mapping(ConfigMapping.MAX_TASKS_VERIFICATION_ATTEMPTS)),
+            }
 
-    def agent_node_check(self, state, agent, name):
+    def check_required(self, state) -> bool:
         config_values = self.retrieve_agent_config_values()
-        if not config_values["check_enabled"] or \
-                state["verification_attempts"] >= config_values["max_verification_attempts"]:
-            return {"next": "CONTINUE",
-                    "feedback": "",
-                    "verification_attempts": 0}
-        result = agent.invoke(state, return_only_outputs=True, )
+        return config_values["check_enabled"] and \
+            state["verification_attempts"] < config_values["max_verification_attempts"]
+
+    def find_rule_issues(self, state) -> list:
+        if self.type == "user_story":
+            return user_stories_issues(state["user_stories"])
+        elif self.type == "acceptance_criteria":
+            return acceptance_criteria_issues(state["acceptance_criteria_us"][-1])
+        elif self.type == "tasks":
+            return tasks_issues(state["tasks"][-1])
+        elif self.type == "acceptance_criteria_and_tasks":
+            return acceptance_criteria_issues(state["acceptance_criteria_us"][-1]) + tasks_issues(state["tasks"][-1])
+
+    def pre_verify(self, state) -> dict | None:
+        """ Decide without the verifier agent when the rules are enough: obvious failures are sent back with the
+        rules feedback, and passes are accepted when trust_passes is set. None means the agent has to review. """
+        if not config.get_value_by_mapping(ConfigMapping.PRE_VERIFICATION_ENABLED):
+            return None
+        issues = self.find_rule_issues(state)
+        if issues:
+            return self.process_feedback(state, {"feedback": rules_feedback(issues), "needs_review": True})
+        if config.get_value_by_mapping(ConfigMapping.PRE_VERIFICATION_TRUST_PASSES):
+            return self.process_feedback(state, {"feedback": "", "needs_review": False})
+        return None
+
+    def process_feedback(self, state, result):
         try:
             feedback = FeedbackOutput(**result)
         except Exception as e:
@@ -144,18 +216,66 @@ class AgentVerifier:
                 result["acceptance_criteria_us"] = state["acceptance_criteria_us"]
             elif self.type == "tasks":
                 result["tasks"] = state["tasks"]
+            elif self.type == "acceptance_criteria_and_tasks":
+                result["acceptance_criteria_us"] = state["acceptance_criteria_us"]
+                result["tasks"] = state["tasks"]
             return result
         else:
             return {"next": "CONTINUE",
                     "feedback": "",
                     "verification_attempts": 0}
 
+    def agent_node_check(self, state, config: RunnableConfig, agent, name):
+        if not self.check_required(state):
+            return {"next": "CONTINUE",
+                    "feedback": "",
+                    "verification_attempts": 0}
+        update = self.pre_verify(state)
+        if update is not None:
+            # Lets the RunReport count the verifier runs saved
+            dispatch_custom_event("pre_verification", {"verifier": self.type, "next": update["next"]}, config=config)
+            return update
+        # A retry gets a new response from the model, not the one the cache holds for its prompt
+        with deferred_cache_writes(skip_lookups=name in (state.get("retry_attempts") or {})) as cache_writes:
+            result = agent.invoke(state, tag_user_story(state, config), return_only_outputs=True, )
+        update = register_node_result(state, self.process_feedback(state, result), name, config)
+        if update["next"] == "ERROR":
+            time.sleep(retry_delay(update["retry_attempts"][name]))
+        else:
+            cache_writes.commit()
+        return update
+
+    async def aagent_node_check(self, state, config: RunnableConfig, agent, name):
+        if not self.check_required(state):
+            return {"next": "CONTINUE",
+                    "feedback": "",
+                    "verification_attempts": 0}
+        update = self.pre_verify(state)
+        if update is not None:
+            await adispatch_custom_event("pre_verification", {"verifier": self.type, "next": update["next"]},
+                                         config=config)
+            return update
+        with deferred_cache_writes(skip_lookups=name in (state.get("retry_attempts") or {})) as cache_writes:
+            result = await agent.ainvoke(state, tag_user_story(state, config), return_only_outputs=True, )
+        update = register_node_result(state, self.process_feedback(state, result), name, config)
+        if update["next"] == "ERROR":
+            await asyncio.sleep(retry_delay(update["retry_attempts"][name]))
+        else:
+            cache_writes.commit()
+        return update
+
     def create_agent_node(self):
         agent = self.create_verifier_agent()
-        executor = AgentExecutor(tools=[get_project_context], agent=agent, verbose=True)
+        executor = AgentExecutor(tools=get_agent_tools(), agent=agent)
         if self.type == "user_story":
-            return functools.partial(self.agent_node_check, agent=executor, name="check_us_quality")
+            name = "check_us_quality"
         elif self.type == "acceptance_criteria":
-            return functools.partial(self.agent_node_check, agent=executor, name="check_ac_quality")
+            name = "check_ac_quality"
         elif self.type == "tasks":
-            return functools.partial(self.agent_node_check, agent=executor, name="check_tasks_quality")
\ No newline at end of file
+            name = "check_tasks_quality"
+        elif self.type == "acceptance_criteria_and_tasks":
+            name = "check_ac_tasks_quality"
+        # The same node serves both graph.invoke and graph.ainvoke
+        return RunnableLambda(functools.partial(self.agent_node_check, agent=executor, name=name),
+                              afunc=functools.partial(self.aagent_node_check, agent=executor, name=name),
+                              name=name)
@@ -1,14 +1,27 @@
+from __future__ import annotations
+
+import asyncio
+import contextvars
+import queue
+import threading
+from typing import TYPE_CHECKING, AsyncIterator, Callable, Iterator
+
 from dotenv import load_dotenv
-from langgraph.graph import END, StateGraph, START
 from loguru import logger
 
-from AgentCreator import AgentCreator
-from AgentVerifier import AgentVerifier
 from Config import *
-from GraphElements import AgentState, select_next_user_story_to_process, \
-    process_user_story, \
-    write_final_output
-from models.AgileCrewModels import Feature
+
+# langchain, langgraph and the LLM clients take most of the start up time, they are imported by the methods that
+# build the workflows and run them, so importing this module and creating an AgileCrewGraph stay cheap
+if TYPE_CHECKING:
+    from langgraph.graph import StateGraph
+
+    from AgentCreator import AgentCreator
+    from AgentVerifier import AgentVerifier
+    from Checkpoints import CheckpointStore
+    from RunReport import RunReport
+    from UsageLedger import UsageLedger
+    from models.AgileCrewModels import Feature
 
 load_dotenv()
 
@@ -19,16 +32,167 @@ class AgileCrewGraph:
     check_us_agent: AgentVerifier
     check_ac_agent: AgentVerifier
     check_tasks_agent: AgentVerifier
+    creator_ac_tasks_agent: AgentCreator
+    check_ac_tasks_agent: AgentVerifier
+
+    # The log file sink is shared by every AgileCrewGraph in the process and removed with the last one
+    _log_sink_lock = threading.Lock()
+    _log_sink_id: int | None = None
+    _log_sink_users: int = 0
+
+    def __init__(self, api_key: str | None = None):
+        """ The LLM clients use `api_key`, or the AZURE_OPENAI_API_KEY environment variable when it is None """
+        self.api_key = api_key
+        # Fails on an invalid config file before any work is done
+        config.load()
+        self._agents_created = False
+        self._open_log_sink()
+        self._closed = False
+        self._graph = None
+        self._checkpoint_store = None
+        self._checkpointed_graph = None
+        self._user_story_graphs = {}
+        self._graph_lock = threading.Lock()
+
+    def create_agents(self):
+        """ Create the agents, once, when the first workflow is built """
+        if self._agents_created:
+            return
+        from AgentCreator import AgentCreator
+        from AgentVerifier import AgentVerifier
+
+        self.creator_us_agent = AgentCreator("user_story", self.api_key)
+        self.creator_ac_agent = AgentCreator("acceptance_criteria", self.api_key)
+        self.creator_tasks_agent = AgentCreator("tasks", self.api_key)
+        self.check_us_agent = AgentVerifier("user_story", self.api_key)
+        self.check_ac_agent = AgentVerifier("acceptance_criteria", self.api_key)
+        self.check_tasks_agent = AgentVerifier("tasks", self.api_key)
+        self.creator_ac_tasks_agent = AgentCreator("acceptance_criteria_and_tasks", self.api_key)
+        self.check_ac_tasks_agent = AgentVerifier("acceptance_criteria_and_tasks", self.api_key)
+        self._agents_created = True
+
+    @property
+    def graph(self):
+        """ Compiled workflow shared by every invocation, it holds no per-run state so it is safe to use concurrently.
+        It is built on first use, so the LLM clients pick up credentials provided after construction. """
+        if self._graph is None:
+            with self._graph_lock:
+                if self._graph is None:
+                    self._graph = self.create_workflow().compile()
+        return self._graph
+
+    @property
+    def checkpoint_store(self) -> CheckpointStore:
+        """ SQLite checkpoints of the runs invoked with a thread id, opened on first use """
+        from Checkpoints import CheckpointStore
+
+        if self._checkpoint_store is None:
+            with self._graph_lock:
+                if self._checkpoint_store is None:
+                    self._checkpoint_store = CheckpointStore(
+                        config.get_value_by_mapping(ConfigMapping.CHECKPOINTS_PATH))
+        return self._checkpoint_store
+
+    @property
+    def checkpointed_graph(self):
+        """ Same workflow as graph, persisting the state after every node so a failed run can be resumed """
+        if self._checkpointed_graph is None:
+            store = self.checkpoint_store
+            with self._graph_lock:
+                if self._checkpointed_graph is None:
+                    self._checkpointed_graph = self.create_workflow().compile(checkpointer=store.saver)
+        return self._checkpointed_graph
+
+    @classmethod
+    def _open_log_sink(cls):
+        with cls._log_sink_lock:
+            if cls._log_sink_id is None:
+                cls._log_sink_id = logger.add("logs/file_{time}.log", enqueue=True)
+            cls._log_sink_users += 1
+
+    @classmethod
+    def _close_log_sink(cls):
+        with cls._log_sink_lock:
+            cls._log_sink_users -= 1
+            if cls._log_sink_users == 0 and cls._log_sink_id is not None:
+                logger.remove(cls._log_sink_id)
+                cls._log_sink_id = None
+
+    def close(self):
+        """ Release the log file sink and the checkpoints database, the compiled graphs must not be used afterwards """
+        if not self._closed:
+            self._closed = True
+            self._close_log_sink()
+            if self._checkpoint_store is not None:
+                self._checkpoint_store.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def add_user_story_nodes(self, workflow: StateGraph, end: str, verify: bool = True) -> str:
+        """ Add the nodes creating and reviewing the AC and tasks of one user story, the last review continues to
+        `end`. With graph.combined_ac_tasks a single agent creates both, without verify the reviews are left out.
+        Returns the first node. """
+        if config.get_value_by_mapping(ConfigMapping.COMBINED_AC_TASKS):
+            workflow.add_node("agent_ac_tasks", self.creator_ac_tasks_agent.create_agent_node())
+            ac_tasks_creation_conditional_map = {"CONTINUE": "ac_tasks_review" if verify else end,
+                                                 "ERROR": "agent_ac_tasks"}
+            workflow.add_conditional_edges("agent_ac_tasks", lambda x: x["next"], ac_tasks_creation_conditional_map)
+            if verify:
+                workflow.add_node("ac_tasks_review", self.check_ac_tasks_agent.create_agent_node())
+                ac_tasks_review_conditional_map = {"REVIEW": "agent_ac_tasks", "CONTINUE": end, "ERROR": "ac_tasks_review"}
+                workflow.add_conditional_edges("ac_tasks_review", lambda x: x["next"], ac_tasks_review_conditional_map)
+            return "agent_ac_tasks"
+
+        workflow.add_node("agent_ac", self.creator_ac_agent.create_agent_node())
+        workflow.add_node("agent_tasks", self.creator_tasks_agent.create_agent_node())
+
+        ac_creation_conditional_map = {"CONTINUE": "ac_review" if verify else "agent_tasks", "ERROR": "agent_ac"}
+        tasks_creation_conditional_map = {"CONTINUE": "tasks_review" if verify else end, "ERROR": "agent_tasks"}
+        workflow.add_conditional_edges("agent_ac", lambda x: x["next"], ac_creation_conditional_map)
+        workflow.add_conditional_edges("agent_tasks", lambda x: x["next"], tasks_creation_conditional_map)
+        if verify:
+            workflow.add_node("ac_review", self.check_ac_agent.create_agent_node())
+            workflow.add_node("tasks_review", self.check_tasks_agent.create_agent_node())
+            ac_review_conditional_map = {"REVIEW": "agent_ac", "CONTINUE": "agent_tasks", "ERROR": "ac_review"}
+            tasks_review_conditional_map = {"REVIEW": "agent_tasks", "CONTINUE": end, "ERROR": "tasks_review"}
+            workflow.add_conditional_edges("ac_review", lambda x: x["next"], ac_review_conditional_map)
+            workflow.add_conditional_edges("tasks_review", lambda x: x["next"], tasks_review_conditional_map)
+        return "agent_ac"
+
+    def create_user_story_workflow(self, verify: bool = True):
+        """ Subgraph that takes a single user story through the AC and tasks creation and review """
+        from langgraph.graph import END, StateGraph, START
 
-    def __init__(self):
-        self.creator_us_agent = AgentCreator("user_story")
-        self.creator_ac_agent = AgentCreator("acceptance_criteria")
-        self.creator_tasks_agent = AgentCreator("tasks")
-        self.check_us_agent = AgentVerifier("user_story")
-        self.check_ac_agent = AgentVerifier("acceptance_criteria")
-        self.check_tasks_agent = AgentVerifier("tasks")
+        from GraphElements import AgentState
+
+        self.create_agents()
+        workflow = StateGraph(AgentState)
+        workflow.add_edge(START, self.add_user_story_nodes(workflow, END, verify))
+        return workflow
+
+    def user_story_graph(self, verify: bool = True):
+        """ Compiled user story subgraph used to regenerate single user stories, built on first use """
+        if verify not in self._user_story_graphs:
+            with self._graph_lock:
+                if verify not in self._user_story_graphs:
+                    self._user_story_graphs[verify] = self.create_user_story_workflow(verify).compile()
+        return self._user_story_graphs[verify]
 
     def create_workflow(self):
+        from langgraph.graph import END, StateGraph, START
+
+        from GraphElements import AgentState, select_next_user_story_to_process, process_user_story
+
+        self.create_agents()
+        if config.get_value_by_mapping(ConfigMapping.VERIFICATION_MODE) == "batch":
+            return self.create_batch_verification_workflow()
+        if config.get_value_by_mapping(ConfigMapping.PARALLEL_USER_STORIES):
+            return self.create_parallel_workflow()
+
         # Define the graph
         workflow = StateGraph(AgentState)
 
@@ -36,50 +200,304 @@ class AgileCrewGraph:
         workflow.add_node("user_story_creation", self.creator_us_agent.create_agent_node())
         workflow.add_node("user_stories_review", self.check_us_agent.create_agent_node())
         workflow.add_node("select_next_user_story", select_next_user_story_to_process)
-        workflow.add_node("agent_ac", self.creator_ac_agent.create_agent_node())
-        workflow.add_node("ac_review", self.check_ac_agent.create_agent_node())
-        workflow.add_node("agent_tasks", self.creator_tasks_agent.create_agent_node())
-        workflow.add_node("tasks_review", self.check_tasks_agent.create_agent_node())
+        first_user_story_node = self.add_user_story_nodes(workflow, "process_user_story")
         workflow.add_node("process_user_story", process_user_story)
-        workflow.add_node("write_output", write_final_output)
+        workflow.add_node("write_output", self.create_write_output_node())
 
         # Define the edges
         workflow.add_edge(START, "user_story_creation")
-        last_conditional_map = {"CONTINUE": "agent_ac", "FINISH": "write_output"}
+        last_conditional_map = {"CONTINUE": first_user_story_node, "FINISH": "write_output"}
         us_creation_conditional_map = {"CONTINUE": "user_stories_review", "ERROR": "user_story_creation"}
         us_review_conditional_map = {"REVIEW": "user_story_creation", "CONTINUE": "select_next_user_story", "ERROR": "user_stories_review"}
-        ac_creation_conditional_map = {"CONTINUE": "ac_review", "ERROR": "agent_ac"}
-        ac_review_conditional_map = {"REVIEW": "agent_ac", "CONTINUE": "agent_tasks", "ERROR": "ac_review"}
-        tasks_creation_conditional_map = {"CONTINUE": "tasks_review", "ERROR": "agent_tasks"}
-        tasks_review_conditional_map = {"REVIEW": "agent_tasks", "CONTINUE": "process_user_story", "ERROR": "tasks_review"}
         workflow.add_conditional_edges("select_next_user_story", lambda x: x["next"], last_conditional_map)
         workflow.add_conditional_edges("user_stories_review", lambda x: x["next"], us_review_conditional_map)
-        workflow.add_conditional_edges("ac_review", lambda x: x["next"], ac_review_conditional_map)
-        workflow.add_conditional_edges("tasks_review", lambda x: x["next"], tasks_review_conditional_map)
         workflow.add_conditional_edges("user_story_creation", lambda x: x["next"], us_creation_conditional_map)
-        workflow.add_conditional_edges("agent_ac", lambda x: x["next"], ac_creation_conditional_map)
-        workflow.add_conditional_edges("agent_tasks", lambda x: x["next"], tasks_creation_conditional_map)
         workflow.add_edge("process_user_story", "select_next_user_story")
         workflow.add_edge("write_output", END)
 
         return workflow
 
+    def create_parallel_workflow(self):
+        """ Same flow as create_workflow, but every user story goes through its own subgraph at the same time """
+        from langgraph.graph import END, StateGraph, START
 
-    def invoke_graph(self, feature_description: str, project_context: str) -> Feature:
-        logger.add("logs/file_{time}.log")
-        workflow = self.create_workflow()
-        graph = workflow.compile()
-        config.set_config_value(ConfigMapping.FEATURE_DESCRIPTION, feature_description)
-        config.set_config_value(ConfigMapping.PROJECT_CONTEXT, project_context)
-        if debug_mode:
-            logger.debug("Starting the Agile Crew Graph")
-        result = graph.invoke({
+        from GraphElements import AgentState, process_user_stories_in_parallel, aprocess_user_stories_in_parallel, \
+            run_config_node
+
+        self.create_agents()
+        workflow = StateGraph(AgentState)
+
+        workflow.add_node("user_story_creation", self.creator_us_agent.create_agent_node())
+        workflow.add_node("user_stories_review", self.check_us_agent.create_agent_node())
+        user_story_graph = self.create_user_story_workflow().compile()
+        max_concurrency = config.get_value_by_mapping(ConfigMapping.MAX_CONCURRENCY)
+        workflow.add_node("process_user_stories", run_config_node(
+            process_user_stories_in_parallel, aprocess_user_stories_in_parallel, user_story_graph=user_story_graph,
+            max_concurrency=max_concurrency))
+        workflow.add_node("write_output", self.create_write_output_node())
+
+        workflow.add_edge(START, "user_story_creation")
+        us_creation_conditional_map = {"CONTINUE": "user_stories_review", "ERROR": "user_story_creation"}
+        us_review_conditional_map = {"REVIEW": "user_story_creation", "CONTINUE": "process_user_stories", "ERROR": "user_stories_review"}
+        workflow.add_conditional_edges("user_story_creation", lambda x: x["next"], us_creation_conditional_map)
+        workflow.add_conditional_edges("user_stories_review", lambda x: x["next"], us_review_conditional_map)
+        workflow.add_edge("process_user_stories", "write_output")
+        workflow.add_edge("write_output", END)
+
+        return workflow
+
+    def create_write_output_node(self):
+        from GraphElements import write_final_output, awrite_final_output, run_config_node
+
+        return run_config_node(write_final_output, awrite_final_output, api_key=self.api_key)
+
+    def create_batch_stage_node(self, creator: AgentCreator, stage: str):
+        from GraphElements import generate_batch_stage, agenerate_batch_stage, run_config_node
+
+        creator_node = creator.create_agent_node()
+        max_concurrency = config.get_value_by_mapping(ConfigMapping.MAX_CONCURRENCY)
+        return run_config_node(generate_batch_stage, agenerate_batch_stage, creator_node=creator_node, stage=stage,
+                               max_concurrency=max_concurrency)
+
+    def create_batch_verification_workflow(self):
+        """ Generate the AC of every user story, review them all in one verifier call and regenerate only the
+        flagged ones, then the same for the tasks """
+        from langgraph.graph import END, StateGraph, START
+
+        from BatchVerifier import BatchAgentVerifier
+        from GraphElements import AgentState
+
+        self.create_agents()
+        workflow = StateGraph(AgentState)
+
+        workflow.add_node("user_story_creation", self.creator_us_agent.create_agent_node())
+        workflow.add_node("user_stories_review", self.check_us_agent.create_agent_node())
+        workflow.add_node("generate_acceptance_criteria", self.create_batch_stage_node(self.creator_ac_agent,
+                                                                                       "acceptance_criteria"))
+        workflow.add_node("batch_ac_review", BatchAgentVerifier("acceptance_criteria", self.api_key).create_agent_node())
+        workflow.add_node("generate_tasks", self.create_batch_stage_node(self.creator_tasks_agent, "tasks"))
+        workflow.add_node("batch_tasks_review", BatchAgentVerifier("tasks", self.api_key).create_agent_node())
+        workflow.add_node("write_output", self.create_write_output_node())
+
+        workflow.add_edge(START, "user_story_creation")
+        us_creation_conditional_map = {"CONTINUE": "user_stories_review", "ERROR": "user_story_creation"}
+        us_review_conditional_map = {"REVIEW": "user_story_creation", "CONTINUE": "generate_acceptance_criteria", "ERROR": "user_stories_review"}
+        ac_review_conditional_map = {"REVIEW": "generate_acceptance_criteria", "CONTINUE": "generate_tasks", "ERROR": "batch_ac_review"}
+        tasks_review_conditional_map = {"REVIEW": "generate_tasks", "CONTINUE": "write_output", "ERROR": "batch_tasks_review"}
+        workflow.add_conditional_edges("user_story_creation", lambda x: x["next"], us_creation_conditional_map)
+        workflow.add_conditional_edges("user_stories_review", lambda x: x["next"], us_review_conditional_map)
+        workflow.add_edge("generate_acceptance_criteria", "batch_ac_review")
+        workflow.add_conditional_edges("batch_ac_review", lambda x: x["next"], ac_review_conditional_map)
+        workflow.add_edge("generate_tasks", "batch_tasks_review")
+        workflow.add_conditional_edges("batch_tasks_review", lambda x: x["next"], tasks_review_conditional_map)
+        workflow.add_edge("write_output", END)
+
+        return workflow
+
+
+    @staticmethod
+    def create_run_report() -> RunReport:
+        from RunReport import RunReport
+
+        return RunReport()
+
+    @staticmethod
+    def prepare_graph_input(feature_description: str, project_context: str) -> dict:
+        return {
             "messages": [("human", config.get_value_by_mapping(ConfigMapping.GRAPH_INITIAL_MESSAGE))],
             "feature_description": feature_description,
+            "project_context": project_context,
             "verification_attempts": 0,
-        },
-            config={"recursion_limit": config.get_value_by_mapping(ConfigMapping.RECURSION_LIMIT)})
+        }
+
+    @staticmethod
+    def prepare_run_config(project_context: str, run_report: RunReport, usage_ledger: UsageLedger | None = None,
+                           on_event: Callable[[dict], None] | None = None,
+                           stop_event: threading.Event | None = None) -> dict:
+        from FeatureEvents import FeatureEventEmitter, RunStopper
+        from Telemetry import get_telemetry_handler
+
+        # The project context travels with the run so concurrent invocations never see each other's context
+        callbacks = [run_report, usage_ledger, get_telemetry_handler(),
+                     FeatureEventEmitter(on_event) if on_event is not None else None,
+                     RunStopper(stop_event) if stop_event is not None else None]
+        return {"recursion_limit": config.get_value_by_mapping(ConfigMapping.RECURSION_LIMIT),
+                "configurable": {"project_context": project_context},
+                "callbacks": [callback for callback in callbacks if callback is not None]}
+
+    def invoke_graph(self, feature_description: str, project_context: str,
+                     run_report: RunReport | None = None, thread_id: str | None = None,
+                     usage_ledger: UsageLedger | None = None, on_event: Callable[[dict], None] | None = None,
+                     stop_event: threading.Event | None = None) -> Feature:
+        """ Run the crew for a feature, pass a RunReport to inspect the per-node figures of the run afterwards, a
+        UsageLedger to account for its tokens and on_event to receive the work accepted along the way, see
+        FeatureEvents. Setting stop_event aborts the run with FeatureEvents.RunStopped at its next step.
+        With a thread_id the state is checkpointed after every node, and invoking again with the same thread_id
+        resumes the run from the last completed node, or returns the feature if the run already finished. """
+        run_report = run_report or self.create_run_report()
+        if debug_mode:
+            logger.debug("Starting the Agile Crew Graph")
+        graph = self.graph
+        graph_input = self.prepare_graph_input(feature_description, project_context)
+        run_config = self.prepare_run_config(project_context, run_report, usage_ledger, on_event, stop_event)
+        if thread_id is not None:
+            graph = self.checkpointed_graph
+            run_config["configurable"]["thread_id"] = thread_id
+            snapshot = graph.get_state(run_config)
+            if snapshot.next:
+                logger.info(f"Resuming run {thread_id} at {', '.join(snapshot.next)}")
+                graph_input = None
+            elif snapshot.values.get("final_output") is not None:
+                logger.info(f"Run {thread_id} already finished")
+                return snapshot.values["final_output"]
+            self.checkpoint_store.mark_started(thread_id)
+        result = graph.invoke(graph_input, config=run_config)
+        if thread_id is not None:
+            self.checkpoint_store.mark_completed(thread_id)
         logger.debug(result.get("final_output").json())
         logger.debug(result)
+        logger.info(f"Prompt size per node: {run_report.prompt_sizes()}")
+        logger.info(f"Project context calls: {run_report.project_context_calls()}")
+        logger.info(f"Pre-verification: {run_report.pre_verification_report()}")
         return result.get("final_output")
 
+    async def ainvoke_graph(self, feature_description: str, project_context: str,
+                            run_report: RunReport | None = None, usage_ledger: UsageLedger | None = None,
+                            on_event: Callable[[dict], None] | None = None) -> Feature:
+        """ Async version of invoke_graph, every LLM call is awaited so many features can run on one event loop """
+        run_report = run_report or self.create_run_report()
+        if debug_mode:
+            logger.debug("Starting the Agile Crew Graph")
+        result = await self.graph.ainvoke(self.prepare_graph_input(feature_description, project_context),
+                                          config=self.prepare_run_config(project_context, run_report, usage_ledger,
+                                                                         on_event))
+        logger.debug(result.get("final_output").json())
+        logger.debug(result)
+        logger.info(f"Prompt size per node: {run_report.prompt_sizes()}")
+        logger.info(f"Project context calls: {run_report.project_context_calls()}")
+        logger.info(f"Pre-verification: {run_report.pre_verification_report()}")
+        return result.get("final_output")
+
+    def prepare_regeneration(self, feature: Feature, user_story_indices: list, project_context: str,
+                             feature_description: str | None, verify: bool, run_report: RunReport,
+                             usage_ledger: UsageLedger | None, on_event: Callable[[dict], None] | None) -> tuple:
+        from langchain_core.runnables.config import patch_config
+
+        from GraphElements import prepare_regeneration_inputs
+
+        inputs = prepare_regeneration_inputs(feature, user_story_indices, feature_description or feature.description,
+                                             project_context)
+        run_config = patch_config(self.prepare_run_config(project_context, run_report, usage_ledger, on_event),
+                                  max_concurrency=config.get_value_by_mapping(ConfigMapping.MAX_CONCURRENCY))
+        logger.info(f"Regenerating the AC and tasks of user stories {user_story_indices}"
+                    f"{'' if verify else ' without verification'}")
+        return self.user_story_graph(verify), inputs, run_config
+
+    def regenerate_user_stories(self, feature: Feature, user_story_indices: list, project_context: str = "",
+                                feature_description: str | None = None, verify: bool = True,
+                                run_report: RunReport | None = None, usage_ledger: UsageLedger | None = None,
+                                on_event: Callable[[dict], None] | None = None) -> Feature:
+        """ Create again the acceptance criteria and tasks of the user stories at `user_story_indices`, e.g. after
+        they were edited, concurrently and keeping the rest of the feature as it is. Without verify the review
+        agents are skipped. The feature description defaults to the description of the feature. Returns a copy of
+        the feature with the new work. """
+        run_report = run_report or self.create_run_report()
+        user_story_indices = sorted(set(user_story_indices))
+        graph, inputs, run_config = self.prepare_regeneration(feature, user_story_indices, project_context,
+                                                              feature_description, verify, run_report,
+                                                              usage_ledger, on_event)
+        results = graph.batch(inputs, config=run_config)
+        logger.info(f"Prompt size per node: {run_report.prompt_sizes()}")
+        from GraphElements import merge_regenerated_user_stories
+
+        return merge_regenerated_user_stories(feature, user_story_indices, results)
+
+    async def aregenerate_user_stories(self, feature: Feature, user_story_indices: list, project_context: str = "",
+                                       feature_description: str | None = None, verify: bool = True,
+                                       run_report: RunReport | None = None, usage_ledger: UsageLedger | None = None,
+                                       on_event: Callable[[dict], None] | None = None) -> Feature:
+        """ Async version of regenerate_user_stories """
+        run_report = run_report or self.create_run_report()
+        user_story_indices = sorted(set(user_story_indices))
+        graph, inputs, run_config = self.prepare_regeneration(feature, user_story_indices, project_context,
+                                                              feature_description, verify, run_report,
+                                                              usage_ledger, on_event)
+        results = await graph.abatch(inputs, config=run_config)
+        logger.info(f"Prompt size per node: {run_report.prompt_sizes()}")
+        from GraphElements import merge_regenerated_user_stories
+
+        return merge_regenerated_user_stories(feature, user_story_indices, results)
+
+    @staticmethod
+    def create_usage_ledger(token_budget: int | None = None) -> UsageLedger:
+        from UsageLedger import UsageLedger
+
+        if token_budget is None:
+            token_budget = config.get_value_by_mapping(ConfigMapping.TOKEN_BUDGET)
+        return UsageLedger(token_budget)
+
+    def invoke_graph_with_usage(self, feature_description: str, project_context: str,
+                                token_budget: int | None = None, **kwargs) -> tuple[Feature, dict]:
+        """ invoke_graph returning the token usage of the run next to the feature. The run is aborted with
+        TokenBudgetExceeded once it uses more than token_budget tokens, graph.token_budget by default. """
+        usage_ledger = self.create_usage_ledger(token_budget)
+        feature = self.invoke_graph(feature_description, project_context, usage_ledger=usage_ledger, **kwargs)
+        logger.info(f"Token usage: {usage_ledger.total}")
+        return feature, usage_ledger.summary()
+
+    async def ainvoke_graph_with_usage(self, feature_description: str, project_context: str,
+                                       token_budget: int | None = None, **kwargs) -> tuple[Feature, dict]:
+        usage_ledger = self.create_usage_ledger(token_budget)
+        feature = await self.ainvoke_graph(feature_description, project_context, usage_ledger=usage_ledger,
+                                           **kwargs)
+        logger.info(f"Token usage: {usage_ledger.total}")
+        return feature, usage_ledger.summary()
+
+    def stream_graph(self, feature_description: str, project_context: str, **kwargs) -> Iterator[dict]:
+        """ invoke_graph yielding an event every time the user stories, or the acceptance criteria or tasks of a
+        user story are accepted, and a last "feature" event with the result. The run happens in a background
+        thread, its errors are raised from the iterator. The run stops when the iterator is closed or garbage
+        collected before the end. """
+        from FeatureEvents import RunStopped
+
+        events = queue.Queue()
+        finished = object()
+        stop = threading.Event()
+
+        def run():
+            try:
+                feature = self.invoke_graph(feature_description, project_context, on_event=events.put,
+                                            stop_event=stop, **kwargs)
+                events.put({"type": "feature", "feature": feature})
+            except RunStopped:
+                logger.info("The stream was closed, its run is stopped")
+            except Exception as e:
+                events.put(e)
+            finally:
+                events.put(finished)
+
+        # The run keeps the config overrides of the caller
+        threading.Thread(target=contextvars.copy_context().run, args=(run,), name="agile-crew-stream",
+                         daemon=True).start()
+        try:
+            while (event := events.get()) is not finished:
+                if isinstance(event, Exception):
+                    raise event
+                yield event
+        finally:
+            stop.set()
+
+    async def astream_graph(self, feature_description: str, project_context: str, **kwargs) -> AsyncIterator[dict]:
+        """ Async version of stream_graph, the run is a task on the running event loop """
+        loop = asyncio.get_running_loop()
+        events = asyncio.Queue()
+        run = asyncio.ensure_future(self.ainvoke_graph(
+            feature_description, project_context,
+            on_event=lambda event: loop.call_soon_threadsafe(events.put_nowait, event), **kwargs))
+        run.add_done_callback(lambda _: events.put_nowait(None))
+        try:
+            while (event := await events.get()) is not None:
+                yield event
+            yield {"type": "feature", "feature": run.result()}
+        finally:
+            run.cancel()
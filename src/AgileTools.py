@@ -1,5 +1,5 @@
-
 from dotenv import load_dotenv
+from langchain_core.runnables import ensure_config
 from langchain_core.tools import tool
 
 from Config import *
@@ -9,4 +9,20 @@ load_dotenv()
 @tool
 def get_project_context() -> str:
     """Get the project context for the user stories creation"""
-    return config.get_value_by_mapping(ConfigMapping.PROJECT_CONTEXT)
+    # The run config of the calling node carries the context of its own run, the yaml value is only a fallback
+    return ensure_config().get("configurable", {}).get("project_context",
+                                                       config.get_value_by_mapping(ConfigMapping.PROJECT_CONTEXT))
+
+
+def project_context_inlined() -> bool:
+    return config.get_value_by_mapping(ConfigMapping.PROJECT_CONTEXT_MODE) == "inline"
+
+
+def get_agent_tools() -> list:
+    """ Tools bound to the agents, the project context tool is dropped when the context is inlined in the prompt """
+    return [] if project_context_inlined() else [get_project_context]
+
+
+def get_project_context_messages() -> list:
+    """ Prompt messages carrying the project context when it is inlined """
+    return [("system", "Project context:\n{project_context}")] if project_context_inlined() else []
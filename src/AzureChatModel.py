@@ -0,0 +1,42 @@
+import json
+from typing import Any, List, Optional
+
+from langchain_core.messages import BaseMessage, get_buffer_string
+from langchain_core.outputs import ChatResult
+from langchain_openai import AzureChatOpenAI
+
+from RateLimiter import get_rate_limiter
+
+
+class RateLimitedAzureChatOpenAI(AzureChatOpenAI):
+    """ AzureChatOpenAI waiting for the rate limits of its deployment, shared by the whole process, before every
+    request. Responses served from the LLM cache never reach _generate, so they are not limited. """
+
+    def estimate_tokens(self, messages: List[BaseMessage], **kwargs: Any) -> int:
+        # Azure charges the prompt, the function definitions and max_tokens when it admits the request
+        return (len(get_buffer_string(messages)) + len(json.dumps(kwargs.get("functions", [])))) // 4 + \
+            (self.max_tokens or 0)
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager=None,
+                  **kwargs: Any) -> ChatResult:
+        limiter = get_rate_limiter(self.deployment_name or self.model_name)
+        if limiter is None:
+            return super()._generate(messages, stop=stop, run_manager=run_manager, **kwargs)
+        estimated_tokens = self.estimate_tokens(messages, **kwargs)
+        limiter.acquire(estimated_tokens)
+        result = super()._generate(messages, stop=stop, run_manager=run_manager, **kwargs)
+        limiter.settle(estimated_tokens, (result.llm_output or {}).get("token_usage", {}).get("total_tokens",
+                                                                                              estimated_tokens))
+        return result
+
+    async def _agenerate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager=None,
+                         **kwargs: Any) -> ChatResult:
+        limiter = get_rate_limiter(self.deployment_name or self.model_name)
+        if limiter is None:
+            return await super()._agenerate(messages, stop=stop, run_manager=run_manager, **kwargs)
+        estimated_tokens = self.estimate_tokens(messages, **kwargs)
+        await limiter.aacquire(estimated_tokens)
+        result = await super()._agenerate(messages, stop=stop, run_manager=run_manager, **kwargs)
+        limiter.settle(estimated_tokens, (result.llm_output or {}).get("token_usage", {}).get("total_tokens",
+                                                                                              estimated_tokens))
+        return result
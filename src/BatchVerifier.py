@@ -0,0 +1,176 @@
+import asyncio
+import functools
+import time
+
+from langchain.agents import AgentExecutor
+from langchain.agents.format_scratchpad import format_to_openai_function_messages
+from langchain_core.callbacks.manager import adispatch_custom_event, dispatch_custom_event
+from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+from langchain_core.runnables import RunnableConfig, RunnableLambda
+from loguru import logger
+
+from AgentVerifier import AgentVerifier
+from AgileTools import get_agent_tools, get_project_context_messages
+from Config import *
+from GraphElements import pending_user_stories
+from LLMCache import deferred_cache_writes
+from LLMClients import get_chat_model
+from Utils import create_agent, register_node_result, retry_delay
+from VerificationRules import acceptance_criteria_issues, rules_feedback, tasks_issues
+from models.AgileCrewModels import ListOfUserStoryFeedback, UserStoryFeedback
+
+
+class BatchAgentVerifier(AgentVerifier):
+    """ Verifier reviewing the acceptance criteria or the tasks of all the pending user stories in a single call,
+    with a verdict per user story. It uses the settings of the per-story verifier of the same type. """
+
+    def prepare_agent_inputs(self) -> dict:
+        return {
+            "feature_description": lambda x: x["feature_description"],
+            "project_context": lambda x: x["project_context"],
+            "review_items": lambda x: x["review_items"],
+            "agent_scratchpad": lambda x: format_to_openai_function_messages(
+                x["intermediate_steps"]
+            ),
+        }
+
+    def create_prompt(self) -> ChatPromptTemplate:
+        if self.type == "acceptance_criteria":
+            prompt, work = ConfigMapping.AGENT_PROMPT_CHECK_AC, "User stories and acceptance criteria to review"
+        elif self.type == "tasks":
+            prompt, work = ConfigMapping.AGENT_PROMPT_CHECK_TASKS, "User stories and tasks to review"
+        return ChatPromptTemplate([
+            ("system", config.get_value_by_mapping(prompt)),
+            *get_project_context_messages(),
+            ("user", "Feature description: \n{feature_description}"),
+            ("user", work + ":\n{review_items}"),
+            ("system", "Review every user story on its own and return one feedback per user story, with its index, "
+                       "using the 'ListOfUserStoryFeedback' tool provided."),
+            MessagesPlaceholder("agent_scratchpad")],
+            input_variables=["examples", "agent_scratchpad", "feature_description",
+                             "review_items"]).partial(examples="")
+
+    def create_verifier_agent(self):
+        if self.type == "acceptance_criteria":
+            model_name = config.get_value_by_mapping(ConfigMapping.AGENT_MODEL_DEPLOYED_CHECK_AC)
+            model_temp = config.get_value_by_mapping(ConfigMapping.AGENT_MODEL_TEMPERATURE_CHECK_AC)
+        elif self.type == "tasks":
+            model_name = config.get_value_by_mapping(ConfigMapping.AGENT_MODEL_DEPLOYED_CHECK_TASKS)
+            model_temp = config.get_value_by_mapping(ConfigMapping.AGENT_MODEL_TEMPERATURE_CHECK_TASKS)
+        llm_with_tools = get_chat_model(model_name, model_temp, self.api_key).\
+            bind_functions([*get_agent_tools(), ListOfUserStoryFeedback])
+
+        return create_agent(llm_with_tools, self.prompt, self.prepare_agent_inputs())
+
+    def format_review_item(self, state, pending: UserStoryFeedback) -> str:
+        idx = pending.user_story_index
+        item = f"User story #{idx}:\n{state['user_stories'].user_stories[idx]}\n" \
+               f"Acceptance criteria:\n{state['acceptance_criteria_us'][idx]}\n"
+        if self.type == "tasks":
+            item += f"Tasks:\n{state['tasks'][idx]}\n"
+        if pending.feedback:
+            item += f"Previously returned feedback:\n{pending.feedback}\n"
+        return item
+
+    def story_rule_issues(self, state, idx: int) -> list:
+        if self.type == "acceptance_criteria":
+            return acceptance_criteria_issues(state["acceptance_criteria_us"][idx])
+        elif self.type == "tasks":
+            return tasks_issues(state["tasks"][idx])
+
+    def pre_verify_stories(self, state) -> tuple:
+        """ Split the pending user stories into the ones the rules send back, with their feedback, and the ones the
+        verifier agent has to review """
+        pending = pending_user_stories(state)
+        if not config.get_value_by_mapping(ConfigMapping.PRE_VERIFICATION_ENABLED):
+            return [], pending
+        flagged, to_review = [], []
+        for item in pending:
+            issues = self.story_rule_issues(state, item.user_story_index)
+            if issues:
+                flagged.append(UserStoryFeedback(user_story_index=item.user_story_index,
+                                                 feedback=rules_feedback(issues), needs_review=True))
+            elif not config.get_value_by_mapping(ConfigMapping.PRE_VERIFICATION_TRUST_PASSES):
+                to_review.append(item)
+        return flagged, to_review
+
+    def process_batch_feedback(self, state, flagged: list, to_review: list, result) -> dict:
+        if result is not None:
+            try:
+                verdicts = ListOfUserStoryFeedback(**result)
+            except Exception as e:
+                logger.error(f"Error parsing the output: {e}")
+                return {"next": "ERROR"}
+            # Verdicts on stories that were not asked for are ignored, stories without a verdict are accepted
+            reviewed = {item.user_story_index for item in to_review}
+            flagged = flagged + [verdict for verdict in verdicts.feedbacks
+                                 if verdict.needs_review and verdict.user_story_index in reviewed]
+        if debug_mode:
+            logger.debug(f"User stories to review: {[item.user_story_index for item in flagged]}")
+        if flagged:
+            return {"next": "REVIEW",
+                    "pending_user_stories": flagged,
+                    "verification_attempts": state["verification_attempts"] + 1}
+        return self.finish_stage()
+
+    @staticmethod
+    def finish_stage() -> dict:
+        return {"next": "CONTINUE",
+                "pending_user_stories": [],
+                "feedback": "",
+                "verification_attempts": 0}
+
+    def pre_verification_events(self, flagged: list, to_review: list, pending: int) -> list:
+        # One event per user story decided by the rules alone, as the per-story verifier reports them
+        return [{"verifier": self.type, "next": "REVIEW"} for _ in flagged] + \
+            [{"verifier": self.type, "next": "CONTINUE"} for _ in range(pending - len(flagged) - len(to_review))]
+
+    def agent_node_check(self, state, config: RunnableConfig, agent, name):
+        if not self.check_required(state):
+            return self.finish_stage()
+        flagged, to_review = self.pre_verify_stories(state)
+        for event in self.pre_verification_events(flagged, to_review, len(pending_user_stories(state))):
+            dispatch_custom_event("pre_verification", event, config=config)
+        result = None
+        # A retry gets a new response from the model, not the one the cache holds for its prompt
+        with deferred_cache_writes(skip_lookups=name in (state.get("retry_attempts") or {})) as cache_writes:
+            if to_review:
+                review_items = "\n".join(self.format_review_item(state, item) for item in to_review)
+                result = agent.invoke({**state, "review_items": review_items}, config, return_only_outputs=True, )
+        update = register_node_result(state, self.process_batch_feedback(state, flagged, to_review, result), name,
+                                      config)
+        if update["next"] == "ERROR":
+            time.sleep(retry_delay(update["retry_attempts"][name]))
+        else:
+            cache_writes.commit()
+        return update
+
+    async def aagent_node_check(self, state, config: RunnableConfig, agent, name):
+        if not self.check_required(state):
+            return self.finish_stage()
+        flagged, to_review = self.pre_verify_stories(state)
+        for event in self.pre_verification_events(flagged, to_review, len(pending_user_stories(state))):
+            await adispatch_custom_event("pre_verification", event, config=config)
+        result = None
+        with deferred_cache_writes(skip_lookups=name in (state.get("retry_attempts") or {})) as cache_writes:
+            if to_review:
+                review_items = "\n".join(self.format_review_item(state, item) for item in to_review)
+                result = await agent.ainvoke({**state, "review_items": review_items}, config, return_only_outputs=True, )
+        update = register_node_result(state, self.process_batch_feedback(state, flagged, to_review, result), name,
+                                      config)
+        if update["next"] == "ERROR":
+            await asyncio.sleep(retry_delay(update["retry_attempts"][name]))
+        else:
+            cache_writes.commit()
+        return update
+
+    def create_agent_node(self):
+        agent = self.create_verifier_agent()
+        executor = AgentExecutor(tools=get_agent_tools(), agent=agent)
+        if self.type == "acceptance_criteria":
+            name = "batch_check_ac_quality"
+        elif self.type == "tasks":
+            name = "batch_check_tasks_quality"
+        return RunnableLambda(functools.partial(self.agent_node_check, agent=executor, name=name),
+                              afunc=functools.partial(self.aagent_node_check, agent=executor, name=name),
+                              name=name)
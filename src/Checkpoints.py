@@ -0,0 +1,59 @@
+import os
+import sqlite3
+import time
+
+from langgraph.checkpoint.sqlite import SqliteSaver
+
+
+class CheckpointStore:
+    """ SQLite store of the graph state checkpoints, one thread per run, plus a table tracking the runs so old ones
+    can be listed and garbage collected """
+
+    def __init__(self, path: str):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.saver = SqliteSaver(sqlite3.connect(path, check_same_thread=False))
+        self.saver.setup()
+        with self.saver.lock, self.saver.conn:
+            self.saver.conn.execute("CREATE TABLE IF NOT EXISTS runs ("
+                                    "thread_id TEXT PRIMARY KEY, created_at REAL NOT NULL, "
+                                    "updated_at REAL NOT NULL, completed INTEGER NOT NULL DEFAULT 0)")
+
+    def mark_started(self, thread_id: str):
+        now = time.time()
+        with self.saver.lock, self.saver.conn:
+            self.saver.conn.execute("INSERT INTO runs (thread_id, created_at, updated_at) VALUES (?, ?, ?) "
+                                    "ON CONFLICT (thread_id) DO UPDATE SET updated_at = excluded.updated_at",
+                                    (thread_id, now, now))
+
+    def mark_completed(self, thread_id: str):
+        with self.saver.lock, self.saver.conn:
+            self.saver.conn.execute("UPDATE runs SET updated_at = ?, completed = 1 WHERE thread_id = ?",
+                                    (time.time(), thread_id))
+
+    def list_runs(self) -> list:
+        """ Checkpointed runs, most recently updated first """
+        with self.saver.lock:
+            rows = self.saver.conn.execute(
+                "SELECT r.thread_id, r.created_at, r.updated_at, r.completed, "
+                "(SELECT COUNT(*) FROM checkpoints c WHERE c.thread_id = r.thread_id) "
+                "FROM runs r ORDER BY r.updated_at DESC").fetchall()
+        return [{"thread_id": row[0], "created_at": row[1], "updated_at": row[2], "completed": bool(row[3]),
+                 "checkpoints": row[4]} for row in rows]
+
+    def delete_run(self, thread_id: str):
+        with self.saver.lock, self.saver.conn:
+            for table in ("writes", "checkpoints", "runs"):
+                self.saver.conn.execute(f"DELETE FROM {table} WHERE thread_id = ?", (thread_id,))
+
+    def garbage_collect(self, max_age_seconds: float, completed_only: bool = False) -> int:
+        """ Delete the runs not updated in the last max_age_seconds, returns how many were deleted """
+        query = "SELECT thread_id FROM runs WHERE updated_at < ?" + (" AND completed = 1" if completed_only else "")
+        with self.saver.lock:
+            thread_ids = [row[0] for row in self.saver.conn.execute(query, (time.time() - max_age_seconds,))]
+        for thread_id in thread_ids:
+            self.delete_run(thread_id)
+        return len(thread_ids)
+
+    def close(self):
+        self.saver.conn.close()
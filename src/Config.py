@@ -1,7 +1,12 @@
+import contextvars
+import os
+import threading
+from contextlib import contextmanager
 from enum import Enum
-from functools import reduce
+from types import MappingProxyType
 
-import yaml
+# Resolved from this module, so the config is found whatever the working directory of the process
+DEFAULT_CONFIG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "config", "config.GPT4.QA_DISABLED.yml")
 
 
 class ConfigMapping(Enum):
@@ -49,30 +54,289 @@ class ConfigMapping(Enum):
     FEATURE_DESCRIPTION = "graph.feature_description"
     PROJECT_CONTEXT = "graph.project_context"
     RECURSION_LIMIT = "graph.recursion_limit"
+    PARALLEL_USER_STORIES = "graph.parallel_user_stories"
+    MAX_CONCURRENCY = "graph.max_concurrency"
+    VERIFICATION_MODE = "graph.verification_mode"
+    COMBINED_AC_TASKS = "graph.combined_ac_tasks"
+    PROJECT_CONTEXT_MODE = "graph.project_context_mode"
+    RETRY_MAX_ATTEMPTS = "graph.retry.max_attempts"
+    RETRY_BASE_DELAY_SECONDS = "graph.retry.base_delay_seconds"
+    RETRY_MAX_DELAY_SECONDS = "graph.retry.max_delay_seconds"
+    PRE_VERIFICATION_ENABLED = "graph.pre_verification.enabled"
+    PRE_VERIFICATION_TRUST_PASSES = "graph.pre_verification.trust_passes"
+    TOKEN_BUDGET = "graph.token_budget"
+    CHECKPOINTS_PATH = "graph.checkpoints.path"
+    HISTORY_POLICY = "graph.history.policy"
+    HISTORY_WINDOW = "graph.history.window"
     DEBUG_MODE = "graph.debug_mode"
 
+    # LLM clients mapping
+    LLM_PROVIDER = "llm.provider"
+    FAKE_LLM_MODE = "llm.fake.mode"
+    FAKE_LLM_CASSETTE = "llm.fake.cassette"
+    FAKE_LLM_LATENCY_SECONDS = "llm.fake.latency_seconds"
+    FAKE_LLM_USER_STORIES = "llm.fake.user_stories"
+    LLM_MAX_CONNECTIONS = "llm.max_connections"
+    LLM_MAX_KEEPALIVE_CONNECTIONS = "llm.max_keepalive_connections"
+    LLM_KEEPALIVE_EXPIRY = "llm.keepalive_expiry"
+    LLM_TIMEOUT = "llm.timeout"
+    LLM_PROMPT_LAYOUT = "llm.prompt_layout"
+    LLM_RATE_LIMIT_RPM = "llm.rate_limits.requests_per_minute"
+    LLM_RATE_LIMIT_TPM = "llm.rate_limits.tokens_per_minute"
+    LLM_RATE_LIMIT_DEPLOYMENTS = "llm.rate_limits.deployments"
+    LLM_CACHE_ENABLED = "llm.cache.enabled"
+    LLM_CACHE_BACKEND = "llm.cache.backend"
+    LLM_CACHE_PATH = "llm.cache.path"
+    LLM_CACHE_MAX_ENTRIES = "llm.cache.max_entries"
+    LLM_CACHE_TTL_SECONDS = "llm.cache.ttl_seconds"
+
+    # Telemetry mapping
+    TELEMETRY_EXPORTER = "telemetry.exporter"
+    TELEMETRY_SERVICE_NAME = "telemetry.service_name"
+    TELEMETRY_OTLP_ENDPOINT = "telemetry.otlp_endpoint"
+
+    # Azure DevOps export mapping
+    ADO_API_VERSION = "ado.api_version"
+    ADO_MAX_CONCURRENCY = "ado.max_concurrency"
+    ADO_MAX_RETRIES = "ado.max_retries"
+    ADO_TIMEOUT = "ado.timeout"
+
+
+# Type of every value that is not a string, int values are accepted for the float ones
+VALUE_TYPES = {
+    ConfigMapping.MODEL_TEMPERATURE_FEATURE: float,
+    ConfigMapping.AGENT_MODEL_TEMPERATURE_US: float,
+    ConfigMapping.AGENT_MODEL_TEMPERATURE_AC: float,
+    ConfigMapping.AGENT_MODEL_TEMPERATURE_TASKS: float,
+    ConfigMapping.CHECK_US_ENABLED: bool,
+    ConfigMapping.MAX_US_VERIFICATION_ATTEMPTS: int,
+    ConfigMapping.AGENT_MODEL_TEMPERATURE_CHECK_US: float,
+    ConfigMapping.CHECK_AC_ENABLED: bool,
+    ConfigMapping.MAX_AC_VERIFICATION_ATTEMPTS: int,
+    ConfigMapping.AGENT_MODEL_TEMPERATURE_CHECK_AC: float,
+    ConfigMapping.CHECK_TASKS_ENABLED: bool,
+    ConfigMapping.MAX_TASKS_VERIFICATION_ATTEMPTS: int,
+    ConfigMapping.AGENT_MODEL_TEMPERATURE_CHECK_TASKS: float,
+    ConfigMapping.RECURSION_LIMIT: int,
+    ConfigMapping.PARALLEL_USER_STORIES: bool,
+    ConfigMapping.MAX_CONCURRENCY: int,
+    ConfigMapping.COMBINED_AC_TASKS: bool,
+    ConfigMapping.RETRY_MAX_ATTEMPTS: int,
+    ConfigMapping.RETRY_BASE_DELAY_SECONDS: float,
+    ConfigMapping.RETRY_MAX_DELAY_SECONDS: float,
+    ConfigMapping.PRE_VERIFICATION_ENABLED: bool,
+    ConfigMapping.PRE_VERIFICATION_TRUST_PASSES: bool,
+    ConfigMapping.TOKEN_BUDGET: int,
+    ConfigMapping.HISTORY_WINDOW: int,
+    ConfigMapping.DEBUG_MODE: bool,
+    ConfigMapping.FAKE_LLM_LATENCY_SECONDS: float,
+    ConfigMapping.FAKE_LLM_USER_STORIES: int,
+    ConfigMapping.LLM_MAX_CONNECTIONS: int,
+    ConfigMapping.LLM_MAX_KEEPALIVE_CONNECTIONS: int,
+    ConfigMapping.LLM_KEEPALIVE_EXPIRY: float,
+    ConfigMapping.LLM_TIMEOUT: float,
+    ConfigMapping.LLM_RATE_LIMIT_RPM: int,
+    ConfigMapping.LLM_RATE_LIMIT_TPM: int,
+    ConfigMapping.LLM_RATE_LIMIT_DEPLOYMENTS: dict,
+    ConfigMapping.LLM_CACHE_ENABLED: bool,
+    ConfigMapping.LLM_CACHE_MAX_ENTRIES: int,
+    ConfigMapping.LLM_CACHE_TTL_SECONDS: int,
+    ConfigMapping.ADO_MAX_CONCURRENCY: int,
+    ConfigMapping.ADO_MAX_RETRIES: int,
+    ConfigMapping.ADO_TIMEOUT: float,
+}
+
+# Values allowed for the options
+VALUE_CHOICES = {
+    ConfigMapping.VERIFICATION_MODE: ("per_story", "batch"),
+    ConfigMapping.PROJECT_CONTEXT_MODE: ("tool", "inline"),
+    ConfigMapping.HISTORY_POLICY: ("full", "window", "drop_progress", "summary"),
+    ConfigMapping.LLM_PROVIDER: ("azure", "fake"),
+    ConfigMapping.FAKE_LLM_MODE: ("scripted", "record", "replay"),
+    ConfigMapping.LLM_PROMPT_LAYOUT: ("default", "cache_friendly"),
+    ConfigMapping.LLM_CACHE_BACKEND: ("memory", "sqlite"),
+    ConfigMapping.TELEMETRY_EXPORTER: ("none", "console", "memory", "otlp"),
+}
+
+# Keys read every time a run uses them, the only ones Config.override accepts. The others are read when the workflow,
+# the agents and the LLM clients are built, which are cached and shared by the runs.
+RUN_KEYS = frozenset({
+    ConfigMapping.CHECK_US_ENABLED,
+    ConfigMapping.MAX_US_VERIFICATION_ATTEMPTS,
+    ConfigMapping.CHECK_AC_ENABLED,
+    ConfigMapping.MAX_AC_VERIFICATION_ATTEMPTS,
+    ConfigMapping.CHECK_TASKS_ENABLED,
+    ConfigMapping.MAX_TASKS_VERIFICATION_ATTEMPTS,
+    ConfigMapping.GRAPH_INITIAL_MESSAGE,
+    ConfigMapping.PROJECT_CONTEXT,
+    ConfigMapping.RECURSION_LIMIT,
+    ConfigMapping.RETRY_MAX_ATTEMPTS,
+    ConfigMapping.RETRY_BASE_DELAY_SECONDS,
+    ConfigMapping.RETRY_MAX_DELAY_SECONDS,
+    ConfigMapping.PRE_VERIFICATION_ENABLED,
+    ConfigMapping.PRE_VERIFICATION_TRUST_PASSES,
+    ConfigMapping.TOKEN_BUDGET,
+    ConfigMapping.HISTORY_POLICY,
+    ConfigMapping.HISTORY_WINDOW,
+    ConfigMapping.DEBUG_MODE,
+    ConfigMapping.ADO_API_VERSION,
+    ConfigMapping.ADO_MAX_CONCURRENCY,
+    ConfigMapping.ADO_MAX_RETRIES,
+    ConfigMapping.ADO_TIMEOUT,
+})
+
+# Values set by Config.override for the code running in the current context
+_overrides = contextvars.ContextVar("config_overrides", default=MappingProxyType({}))
+
+
+class ConfigError(Exception):
+    """ Raised when a config file misses keys or has values of the wrong type """
+
+
+def freeze(value):
+    """ Read-only copy of a value loaded from the config file """
+    if isinstance(value, dict):
+        return MappingProxyType({key: freeze(item) for key, item in value.items()})
+    if isinstance(value, list):
+        return tuple(freeze(item) for item in value)
+    return value
+
+
+def merge(base: dict, overlay: dict) -> dict:
+    """ The overlay values replace the base ones, nested sections are merged key by key """
+    merged = dict(base)
+    for key, value in overlay.items():
+        merged[key] = merge(merged[key], value) \
+            if isinstance(value, dict) and isinstance(merged.get(key), dict) else value
+    return merged
+
+
+def load_config_file(path: str, extended: tuple = ()) -> dict:
+    """ Settings of the config file merged over the file it `extends`, a path relative to its own directory """
+    import yaml
+    if path in extended:
+        raise ConfigError(f"Config files extend each other in a loop: {' -> '.join(extended + (path,))}")
+    with open(path, "r") as file:
+        settings = yaml.safe_load(file) or {}
+    base = settings.pop("extends", None)
+    if base is None:
+        return settings
+    return merge(load_config_file(os.path.join(os.path.dirname(path), base), extended + (path,)), settings)
+
+
+def validate_value(key_enum: ConfigMapping, value):
+    """ The value converted to the type of the key, ConfigError when it cannot be """
+    expected = VALUE_TYPES.get(key_enum, str)
+    if expected is float and isinstance(value, int) and not isinstance(value, bool):
+        value = float(value)
+    if not isinstance(value, expected) or expected is int and isinstance(value, bool):
+        raise ConfigError(f"{key_enum.value} must be of type {expected.__name__}, got {value!r}")
+    if key_enum in VALUE_CHOICES and value not in VALUE_CHOICES[key_enum]:
+        raise ConfigError(f"{key_enum.value} must be one of {', '.join(VALUE_CHOICES[key_enum])}, got {value!r}")
+    return freeze(value)
+
+
+def set_nested_value(settings: dict, key_enum: ConfigMapping, value):
+    *sections, key = key_enum.value.split(".")
+    for section in sections:
+        settings = settings.setdefault(section, {})
+    settings[key] = value
+
+
+def resolve_values(settings: dict, path: str) -> MappingProxyType:
+    """ Value of every ConfigMapping key, validated, so the lookups are a single dictionary access """
+    values, missing, errors = {}, [], []
+    for key_enum in ConfigMapping:
+        section = settings
+        for key in key_enum.value.split("."):
+            if not isinstance(section, dict) or key not in section:
+                missing.append(key_enum.value)
+                break
+            section = section[key]
+        else:
+            try:
+                values[key_enum] = validate_value(key_enum, section)
+            except ConfigError as e:
+                errors.append(str(e))
+    if missing:
+        errors.insert(0, f"missing keys {', '.join(missing)}")
+    if errors:
+        raise ConfigError(f"Invalid config file {path}: {'; '.join(errors)}")
+    return MappingProxyType(values)
+
 
 class Config:
-    def __init__(self, path: str = "src/config/config.GPT4.QA_DISABLED.yml"):
-        # Load the config yaml file as a dictionary
-        with open(path, "r") as file:
-            self._config = yaml.safe_load(file)
+    """ Settings of a config file and the files it extends, loaded and validated on first use. The values are read
+    only, runs that need other values use override, processes set_startup_values. """
 
-    def get_config(self, key: str) -> str:
-        return self._config[key]
+    def __init__(self, path: str = DEFAULT_CONFIG_PATH):
+        self.path = path
+        self._startup_values = {}
+        self._settings = None
+        self._values = None
+        self._lock = threading.Lock()
 
+    def load(self) -> MappingProxyType:
+        """ Validated values by ConfigMapping key, the file is loaded the first time. Entry points call it on start so
+        an invalid config file fails before any work is done. """
+        if self._values is None:
+            with self._lock:
+                if self._values is None:
+                    settings = load_config_file(self.path)
+                    for key_enum, value in self._startup_values.items():
+                        set_nested_value(settings, key_enum, value)
+                    values = resolve_values(settings, self.path)
+                    self._settings = freeze(settings)
+                    self._values = values
+        return self._values
 
-    def set_config_value(self, key: str, value: str):
-        self._config[key] = value
+    def set_startup_values(self, values: dict):
+        """ Use these values of ConfigMapping keys instead of the file ones in the whole process, any key included.
+        They have to be set before the config is loaded, when nothing has been built with the file values yet. """
+        with self._lock:
+            if self._values is not None:
+                raise ConfigError("The startup values must be set before the config is loaded")
+            self._startup_values.update(values)
 
-    # Define the function to access nested keys
-    def get_nested_key(self, nested_key: str):
-        keys = nested_key.split('.')
-        return reduce(lambda d, key: d[key], keys, self._config)
+    def get_config(self, key: str):
+        """ Read-only section of the settings """
+        self.load()
+        return self._settings[key]
 
     def get_value_by_mapping(self, key_enum: ConfigMapping):
-        return self.get_nested_key(key_enum.value)
+        overrides = _overrides.get()
+        if key_enum in overrides:
+            return overrides[key_enum]
+        return (self._values or self.load())[key_enum]
+
+    @contextmanager
+    def override(self, values: dict):
+        """ Use these values of ConfigMapping keys instead of the file ones in the block. Overrides are per context,
+        they apply to the run started in the block, including its graph nodes and tasks, but not to other runs.
+        Only the RUN_KEYS can be overridden, a ConfigError is raised for the keys read when the workflow is built. """
+        build_keys = [key_enum.value for key_enum in values if key_enum not in RUN_KEYS]
+        if build_keys:
+            raise ConfigError(f"Keys read when the workflow is built cannot be overridden per run: "
+                              f"{', '.join(build_keys)}, use set_startup_values before the config is loaded")
+        self.load()
+        overrides = dict(_overrides.get())
+        overrides.update({key_enum: validate_value(key_enum, value) for key_enum, value in values.items()})
+        token = _overrides.set(MappingProxyType(overrides))
+        try:
+            yield
+        finally:
+            _overrides.reset(token)
+
+
+class LazyFlag:
+    """ Boolean config value read every time it is tested, so it can be imported before the config is loaded """
+
+    def __init__(self, key_enum: ConfigMapping):
+        self.key_enum = key_enum
+
+    def __bool__(self):
+        return bool(config.get_value_by_mapping(self.key_enum))
 
 
 config = Config()
-debug_mode = bool(config.get_value_by_mapping(ConfigMapping.DEBUG_MODE))
\ No newline at end of file
+debug_mode = LazyFlag(ConfigMapping.DEBUG_MODE)
\ No newline at end of file
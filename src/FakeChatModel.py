@@ -0,0 +1,155 @@
+import asyncio
+import hashlib
+import json
+import os
+import threading
+import time
+from typing import Any, List, Optional
+
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, BaseMessage, FunctionMessage, get_buffer_string
+from langchain_core.outputs import ChatGeneration, ChatResult
+from langchain_core.pydantic_v1 import PrivateAttr
+from langchain_core.utils.function_calling import convert_to_openai_function
+
+
+def scripted_arguments(function_name: str, user_stories: int) -> dict:
+    """ Default function call arguments returned for each output model of the crew """
+    if function_name == "ListOfUserStories":
+        return {"user_stories": [{"title": f"As a user, I want capability {i + 1} so that I get benefit {i + 1}.",
+                                  "description": f"Description of the user story number {i + 1} of the feature."}
+                                 for i in range(user_stories)]}
+    if function_name == "ListOfAcceptanceCriteria":
+        return {"acceptance_criteria": ["Given a valid input, when the user submits it, then it is stored.",
+                                        "Given an invalid input, when the user submits it, then an error is shown."]}
+    if function_name == "ListOfTasks":
+        return {"tasks": [{"title": "Implement the backend endpoint", "description": "Create and test the endpoint."},
+                          {"title": "Build the user interface", "description": "Add the screen and its validation."}]}
+    if function_name == "AcceptanceCriteriaAndTasks":
+        return {**scripted_arguments("ListOfAcceptanceCriteria", user_stories),
+                **scripted_arguments("ListOfTasks", user_stories)}
+    if function_name == "FeedbackOutput":
+        return {"feedback": "The work meets the expected quality.", "needs_review": False}
+    if function_name == "ListOfUserStoryFeedback":
+        # User stories without a verdict are accepted
+        return {"feedbacks": []}
+    raise ValueError(f"No scripted output for function {function_name}")
+
+
+class FakeChatModel(BaseChatModel):
+    """ Offline stand-in for AzureChatOpenAI.
+
+    scripted: answers with a function call to the bound output model, after fetching the project context first
+    when get_project_context is bound, and with a feature title and description when nothing is bound.
+    record: forwards every call to `delegate` and appends the response to the cassette file.
+    replay: answers from the cassette file, keyed on the prompt, the deployment and the bound functions.
+    """
+    model: str = "fake"
+    temperature: float = 0.0
+    mode: str = "scripted"
+    latency_seconds: float = 0.0
+    user_stories: int = 3
+    # Overrides of the scripted arguments, either a dict or a callable receiving the prompt messages
+    responses: dict = {}
+    cassette: Optional[str] = None
+    delegate: Optional[BaseChatModel] = None
+
+    _cassette_entries: dict = PrivateAttr(default_factory=dict)
+    _cassette_lock: Any = PrivateAttr(default_factory=threading.Lock)
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        if self.mode == "replay":
+            with open(self.cassette, "r") as file:
+                for line in file:
+                    entry = json.loads(line)
+                    self._cassette_entries[entry["key"]] = entry["message"]
+        elif self.mode == "record" and self.delegate is None:
+            raise ValueError("The record mode needs a delegate chat model")
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-azure-chat"
+
+    @property
+    def _identifying_params(self) -> dict:
+        return {"model": self.model, "temperature": self.temperature}
+
+    def bind_functions(self, functions: list, **kwargs):
+        return self.bind(functions=[convert_to_openai_function(function) for function in functions], **kwargs)
+
+    def cassette_key(self, messages: List[BaseMessage], functions: list) -> str:
+        payload = json.dumps({"model": self.model, "temperature": self.temperature,
+                              "functions": sorted(function["name"] for function in functions),
+                              "prompt": get_buffer_string(messages)})
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def scripted_message(self, messages: List[BaseMessage], functions: list) -> AIMessage:
+        names = [function["name"] for function in functions]
+        context_fetched = any(isinstance(message, FunctionMessage) for message in messages)
+        if "get_project_context" in names and not context_fetched:
+            return AIMessage(content="", additional_kwargs={
+                "function_call": {"name": "get_project_context", "arguments": "{}"}})
+        outputs = [name for name in names if name != "get_project_context"]
+        if not outputs:
+            return AIMessage(content=json.dumps({"title": "Scripted feature",
+                                                 "description": "Feature produced by the offline chat model."}))
+        response = self.responses.get(outputs[0])
+        if callable(response):
+            arguments = response(messages)
+        elif response is not None:
+            arguments = response
+        else:
+            arguments = scripted_arguments(outputs[0], self.user_stories)
+        return AIMessage(content="", additional_kwargs={
+            "function_call": {"name": outputs[0], "arguments": json.dumps(arguments)}})
+
+    def create_result(self, messages: List[BaseMessage], message: AIMessage) -> ChatResult:
+        # Token counts are estimated at four characters per token, close enough for relative comparisons
+        prompt_tokens = len(get_buffer_string(messages)) // 4
+        completion_tokens = (len(message.content) + len(json.dumps(message.additional_kwargs))) // 4
+        token_usage = {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                       "total_tokens": prompt_tokens + completion_tokens}
+        message.response_metadata = {"token_usage": token_usage, "model_name": self.model}
+        message.usage_metadata = {"input_tokens": prompt_tokens, "output_tokens": completion_tokens,
+                                  "total_tokens": prompt_tokens + completion_tokens}
+        return ChatResult(generations=[ChatGeneration(message=message)],
+                          llm_output={"token_usage": token_usage, "model_name": self.model})
+
+    def respond(self, messages: List[BaseMessage], functions: list) -> AIMessage:
+        if self.mode == "replay":
+            key = self.cassette_key(messages, functions)
+            if key not in self._cassette_entries:
+                raise KeyError(f"No recorded response in {self.cassette} for this prompt of {self.model}")
+            entry = self._cassette_entries[key]
+            return AIMessage(content=entry["content"], additional_kwargs=entry["additional_kwargs"])
+        return self.scripted_message(messages, functions)
+
+    def record(self, messages: List[BaseMessage], functions: list, message: BaseMessage):
+        entry = {"key": self.cassette_key(messages, functions),
+                 "message": {"content": message.content, "additional_kwargs": message.additional_kwargs}}
+        with self._cassette_lock:
+            if os.path.dirname(self.cassette):
+                os.makedirs(os.path.dirname(self.cassette), exist_ok=True)
+            with open(self.cassette, "a") as file:
+                file.write(json.dumps(entry) + "\n")
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager=None,
+                  **kwargs: Any) -> ChatResult:
+        functions = kwargs.get("functions", [])
+        if self.mode == "record":
+            result = self.delegate._generate(messages, stop=stop, **kwargs)
+            self.record(messages, functions, result.generations[0].message)
+            return result
+        time.sleep(self.latency_seconds)
+        return self.create_result(messages, self.respond(messages, functions))
+
+    async def _agenerate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager=None,
+                         **kwargs: Any) -> ChatResult:
+        functions = kwargs.get("functions", [])
+        if self.mode == "record":
+            result = await self.delegate._agenerate(messages, stop=stop, **kwargs)
+            self.record(messages, functions, result.generations[0].message)
+            return result
+        await asyncio.sleep(self.latency_seconds)
+        return self.create_result(messages, self.respond(messages, functions))
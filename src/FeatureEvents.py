@@ -0,0 +1,84 @@
+import threading
+from typing import Callable
+
+from langchain_core.callbacks import BaseCallbackHandler
+
+# Review node -> events emitted when it accepts the work, in the sequential graph and in the user story subgraph
+REVIEW_EVENTS = {"user_stories_review": ("user_stories",), "ac_review": ("acceptance_criteria",),
+                 "tasks_review": ("tasks",), "ac_tasks_review": ("acceptance_criteria", "tasks")}
+# Batch review node -> event emitted for every user story when it accepts the work of all of them
+BATCH_REVIEW_EVENTS = {"batch_ac_review": "acceptance_criteria", "batch_tasks_review": "tasks"}
+
+
+def create_event(event_type: str, state: dict, user_story_index: int | None = None) -> dict:
+    """ Event of the work accepted, the last artifact of the state or the one of user_story_index if given """
+    position = -1 if user_story_index is None else user_story_index
+    user_story_index = state.get("user_story_index") if user_story_index is None else user_story_index
+    if event_type == "user_stories":
+        return {"type": event_type, "user_stories": list(state["user_stories"].user_stories)}
+    if event_type == "acceptance_criteria":
+        return {"type": event_type, "user_story_index": user_story_index,
+                "acceptance_criteria": list(state["acceptance_criteria_us"][position].acceptance_criteria)}
+    return {"type": event_type, "user_story_index": user_story_index,
+            "tasks": list(state["tasks"][position].tasks)}
+
+
+class FeatureEventEmitter(BaseCallbackHandler):
+    """ Callback handler calling `on_event` every time a review node accepts the user stories, or the acceptance
+    criteria or tasks of a user story, so the results can be shown before the whole feature is ready """
+    run_inline = True
+
+    def __init__(self, on_event: Callable[[dict], None]):
+        self.on_event = on_event
+        self._lock = threading.Lock()
+        # run_id -> (node, state the node started with)
+        self._reviews = {}
+
+    def on_chain_start(self, serialized, inputs, *, run_id, parent_run_id=None, tags=None, metadata=None, **kwargs):
+        node = (metadata or {}).get("langgraph_node")
+        if (node not in REVIEW_EVENTS and node not in BATCH_REVIEW_EVENTS) or kwargs.get("name") != node:
+            return
+        with self._lock:
+            # The runnable wrapped by a node may report under the same name, only the outer run is tracked
+            if parent_run_id not in self._reviews:
+                self._reviews[run_id] = (node, inputs)
+
+    def on_chain_end(self, outputs, *, run_id, **kwargs):
+        with self._lock:
+            review = self._reviews.pop(run_id, None)
+        if review is None or not isinstance(outputs, dict) or outputs.get("next") != "CONTINUE":
+            return
+        node, state = review
+        if node in BATCH_REVIEW_EVENTS:
+            for idx in range(len(state["user_stories"].user_stories)):
+                self.on_event(create_event(BATCH_REVIEW_EVENTS[node], state, idx))
+        else:
+            for event_type in REVIEW_EVENTS[node]:
+                self.on_event(create_event(event_type, state))
+
+    def on_chain_error(self, error, *, run_id, **kwargs):
+        with self._lock:
+            self._reviews.pop(run_id, None)
+
+
+class RunStopped(Exception):
+    """ Raised in a run whose stop event is set, e.g. the one of a stream_graph its consumer stopped iterating """
+
+
+class RunStopper(BaseCallbackHandler):
+    """ Callback handler aborting the run with RunStopped at its next chain or LLM call once `stop_event` is set """
+    run_inline = True
+    raise_error = True
+
+    def __init__(self, stop_event: threading.Event):
+        self.stop_event = stop_event
+
+    def check(self):
+        if self.stop_event.is_set():
+            raise RunStopped("The run was stopped")
+
+    def on_chain_start(self, serialized, inputs, **kwargs):
+        self.check()
+
+    def on_llm_start(self, serialized, prompts, **kwargs):
+        self.check()
@@ -3,75 +3,262 @@ import operator
 from typing import Sequence, TypedDict, Annotated, List
 
 from dotenv import load_dotenv
-from langchain_core.messages import BaseMessage
+from langchain_core.messages import BaseMessage, SystemMessage
 from langchain_core.output_parsers import PydanticOutputParser
 from langchain_core.prompts import ChatPromptTemplate
-from langchain_openai import AzureChatOpenAI
+from langchain_core.runnables import RunnableConfig, RunnableLambda
+from langchain_core.runnables.config import patch_config
 from loguru import logger
 
 from Config import *
+from LLMCache import deferred_cache_writes
+from LLMClients import get_chat_model
 from models.AgileCrewModels import ListOfTasks, \
     UserStory, ListOfUserStories, BaseUserStory, BaseFeature, Feature, Task, \
-    ListOfAcceptanceCriteria
+    ListOfAcceptanceCriteria, UserStoryFeedback
 
 load_dotenv()
 
+feature_parser = PydanticOutputParser(pydantic_object=BaseFeature)
 
 
+def progress_message(content: str) -> SystemMessage:
+    """ System message reporting the graph progress, flagged so the history policy can tell it apart """
+    return SystemMessage(content=content, additional_kwargs={"progress": True})
+
+
+def is_progress_message(message) -> bool:
+    return isinstance(message, SystemMessage) and message.additional_kwargs.get("progress", False)
+
+
+def add_messages_with_history_policy(left: Sequence, right: Sequence) -> list:
+    """ Append the new messages and bound the history according to the configured policy """
+    messages = list(left) + list(right)
+    policy = config.get_value_by_mapping(ConfigMapping.HISTORY_POLICY)
+    if policy == "drop_progress":
+        messages = [message for message in messages if not is_progress_message(message)]
+    elif policy == "window":
+        # The first message holds the instructions of the run, keep it along with the most recent ones
+        window = config.get_value_by_mapping(ConfigMapping.HISTORY_WINDOW)
+        if len(messages) > window + 1:
+            messages = messages[:1] + messages[-window:]
+    return messages
+
 
 # Define the graph state
 class AgentState(TypedDict):
     # The annotation tells the graph that new messages will always
     # be added to the current states
     input: Annotated[str, operator.setitem]
-    messages: Annotated[Sequence[BaseMessage], operator.add]
+    messages: Annotated[Sequence[BaseMessage], add_messages_with_history_policy]
     feature_description: Annotated[str, operator.setitem]
+    project_context: Annotated[str, operator.setitem]
     # The 'next' field indicates where to route to next
     next: Annotated[str, operator.setitem]
     user_stories: Annotated[ListOfUserStories, operator.setitem]
     user_story_to_process: Annotated[BaseUserStory, operator.setitem]
+    user_story_index: Annotated[int, operator.setitem]
     acceptance_criteria_us: Annotated[List[ListOfAcceptanceCriteria], operator.setitem]
     tasks: Annotated[List[ListOfTasks], operator.setitem]
     final_output: Annotated[Feature, operator.setitem]
     feedback: Annotated[str, operator.setitem]
     verification_attempts: Annotated[int, operator.setitem]
+    # Consecutive failed attempts per node, see Utils.register_node_result
+    retry_attempts: Annotated[dict, operator.setitem]
+    # Batch verification mode: user stories whose artifact has to be (re)generated with their feedback, empty for all
+    pending_user_stories: Annotated[List[UserStoryFeedback], operator.setitem]
 
 
 # Nodes
 
 
+def run_config_node(func, afunc, **kwargs) -> RunnableLambda:
+    """ Graph node calling func, or afunc in async runs, with the node state, kwargs and the run config of the node
+    as `run_config` """
+
+    def node(state, config: RunnableConfig):
+        return func(state, run_config=config, **kwargs)
+
+    async def anode(state, config: RunnableConfig):
+        return await afunc(state, run_config=config, **kwargs)
+
+    return RunnableLambda(node, afunc=anode, name=func.__name__)
+
+
 def select_next_user_story_to_process(state: AgentState):
     """ Select the next user story to process based on the user stories created """
-    user_stories_to_process = [us for us in state["user_stories"].user_stories if not us.processed]
+    # The index is carried along, stories with the same content would all match the first one
+    user_stories_to_process = [(idx, us) for idx, us in enumerate(state["user_stories"].user_stories)
+                               if not us.processed]
     if len(user_stories_to_process) == 0:
         return {"next": "FINISH"}
+    idx, user_story = user_stories_to_process[0]
     if debug_mode:
-        logger.debug(f"User story to process: {user_stories_to_process[0].title}")
+        logger.debug(f"User story to process: {user_story.title}")
     return {"next": "CONTINUE",
-            "user_story_to_process": user_stories_to_process[0],
-            "messages": [("system", f"Process new user story: {user_stories_to_process[0].title}")]}
+            "user_story_to_process": user_story,
+            "user_story_index": idx,
+            "messages": [progress_message(f"Process new user story: {user_story.title}")]}
 
 
 def process_user_story(state: AgentState):
     """ Mark the user story as processed """
     user_story = state["user_story_to_process"]
-    us_completed = [us for us in state["user_stories"].user_stories if us.title == user_story.title][0]
-    us_completed.processed = True
+    state["user_stories"].user_stories[state["user_story_index"]].processed = True
     if debug_mode:
         logger.debug(f"User story processed: {user_story.title}")
-    return {"messages": [("system", f"User story has been processed successfully. "
-                                    f"\nIt looks like this: \n\n {json.dumps(user_story.dict(), indent=4)}"
-                                    f"\n\nThis are the acceptance criteria for this user story:\n {json.dumps(state['acceptance_criteria_us'][-1].dict(), indent=4)}"
-                                    f"\n\nThese are the tasks for this user story:\n {json.dumps(state['tasks'][-1].dict(), indent=4)}")]}
+    if config.get_value_by_mapping(ConfigMapping.HISTORY_POLICY) == "summary":
+        return {"messages": [progress_message(f"User story has been processed successfully: {user_story.title}"
+                                              f"\nIt has {len(state['acceptance_criteria_us'][-1].acceptance_criteria)} "
+                                              f"acceptance criteria and these tasks: "
+                                              f"{', '.join(task.title for task in state['tasks'][-1].tasks)}")]}
+    return {"messages": [progress_message(f"User story has been processed successfully. "
+                                          f"\nIt looks like this: \n\n {json.dumps(user_story.dict(), indent=4)}"
+                                          f"\n\nThis are the acceptance criteria for this user story:\n {json.dumps(state['acceptance_criteria_us'][-1].dict(), indent=4)}"
+                                          f"\n\nThese are the tasks for this user story:\n {json.dumps(state['tasks'][-1].dict(), indent=4)}")]}
 
 
+def prepare_user_story_inputs(state: AgentState) -> list:
+    """ Build the initial state of the AC/tasks subgraph for every user story """
+    return [{"messages": list(state["messages"]) + [progress_message(f"Process new user story: {us.title}")],
+             "feature_description": state["feature_description"],
+             "project_context": state["project_context"],
+             "user_story_to_process": us,
+             "user_story_index": idx,
+             "feedback": "",
+             "verification_attempts": 0} for idx, us in enumerate(state["user_stories"].user_stories)]
 
-def write_final_output(state: AgentState):
-    """ Generates the feature title and description and produces the final output """
-    node_llm = AzureChatOpenAI(model=config.get_value_by_mapping(ConfigMapping.MODEL_DEPLOYED_FEATURE),
-                               temperature=config.get_value_by_mapping(ConfigMapping.MODEL_TEMPERATURE_FEATURE))
-    feature_parser = PydanticOutputParser(pydantic_object=BaseFeature)
 
+def prepare_regeneration_inputs(feature: Feature, user_story_indices: list, feature_description: str,
+                                project_context: str) -> list:
+    """ Build the initial state of the AC/tasks subgraph for the user stories of an existing feature """
+    inputs = []
+    for idx in user_story_indices:
+        us = BaseUserStory(title=feature.user_stories[idx].title, description=feature.user_stories[idx].description)
+        inputs.append({"messages": [("human", config.get_value_by_mapping(ConfigMapping.GRAPH_INITIAL_MESSAGE)),
+                                    progress_message(f"Regenerate user story: {us.title}")],
+                       "feature_description": feature_description,
+                       "project_context": project_context,
+                       "user_story_to_process": us,
+                       "user_story_index": idx,
+                       "feedback": "",
+                       "verification_attempts": 0})
+    return inputs
+
+
+def merge_regenerated_user_stories(feature: Feature, user_story_indices: list, results: list) -> Feature:
+    """ Copy of the feature with the new AC and tasks of the regenerated user stories """
+    regenerated = feature.copy(deep=True)
+    for idx, result in zip(user_story_indices, results):
+        regenerated.user_stories[idx].acceptance_criteria = result["acceptance_criteria_us"][-1].acceptance_criteria
+        regenerated.user_stories[idx].tasks = [Task(**task.dict()) for task in result["tasks"][-1].tasks]
+    return regenerated
+
+
+def merge_user_story_results(state: AgentState, results: list):
+    """ Merge the subgraph results, batch preserves the input order so the i-th result belongs to the i-th story """
+    for us in state["user_stories"].user_stories:
+        us.processed = True
+    return {"acceptance_criteria_us": [result["acceptance_criteria_us"][-1] for result in results],
+            "tasks": [result["tasks"][-1] for result in results]}
+
+
+def process_user_stories_in_parallel(state: AgentState, run_config: RunnableConfig, user_story_graph,
+                                     max_concurrency: int):
+    """ Run every user story through its own AC/tasks subgraph concurrently and merge the results by story index """
+    inputs = prepare_user_story_inputs(state)
+    if debug_mode:
+        logger.debug(f"Processing {len(inputs)} user stories with max concurrency {max_concurrency}")
+    results = user_story_graph.batch(inputs, config=patch_config(run_config, max_concurrency=max_concurrency))
+    return merge_user_story_results(state, results)
+
+
+async def aprocess_user_stories_in_parallel(state: AgentState, run_config: RunnableConfig, user_story_graph,
+                                            max_concurrency: int):
+    """ Async version of process_user_stories_in_parallel """
+    inputs = prepare_user_story_inputs(state)
+    if debug_mode:
+        logger.debug(f"Processing {len(inputs)} user stories with max concurrency {max_concurrency}")
+    results = await user_story_graph.abatch(inputs, config=patch_config(run_config, max_concurrency=max_concurrency))
+    return merge_user_story_results(state, results)
+
+
+# The artifact each stage of the batch verification pipeline generates, and its state key
+BATCH_STAGE_KEYS = {"acceptance_criteria": "acceptance_criteria_us", "tasks": "tasks"}
+
+
+def pending_user_stories(state: AgentState) -> list:
+    """ User stories the current batch stage works on, all of them when the stage starts """
+    if state.get("pending_user_stories"):
+        return state["pending_user_stories"]
+    return [UserStoryFeedback(user_story_index=idx, feedback="", needs_review=True)
+            for idx in range(len(state["user_stories"].user_stories))]
+
+
+def prepare_batch_stage_inputs(state: AgentState, stage: str) -> list:
+    """ Creator state of every pending user story. Like in the per-story flow, the previous artifact is only passed
+    along with feedback, and the tasks always get the accepted acceptance criteria of their story """
+    inputs = []
+    for pending in pending_user_stories(state):
+        idx = pending.user_story_index
+        us = state["user_stories"].user_stories[idx]
+        previous_ac = [state["acceptance_criteria_us"][idx]] if stage == "tasks" or pending.feedback else None
+        previous_tasks = [state["tasks"][idx]] if stage == "tasks" and pending.feedback else None
+        inputs.append({"messages": list(state["messages"]) + [progress_message(f"Process new user story: {us.title}")],
+                       "feature_description": state["feature_description"],
+                       "project_context": state["project_context"],
+                       "user_story_to_process": us,
+                       "user_story_index": idx,
+                       "acceptance_criteria_us": previous_ac,
+                       "tasks": previous_tasks,
+                       "feedback": pending.feedback,
+                       "verification_attempts": 0})
+    return inputs
+
+
+def merge_batch_stage_results(state: AgentState, stage: str, results: dict) -> dict:
+    """ Put the artifact generated for every pending user story at the story index """
+    key = BATCH_STAGE_KEYS[stage]
+    artifacts = list(state.get(key) or [None] * len(state["user_stories"].user_stories))
+    for idx, artifact in results.items():
+        artifacts[idx] = artifact
+    return {"next": "CONTINUE", key: artifacts}
+
+
+def split_failed_inputs(inputs: list, updates: list, stage: str, results: dict) -> list:
+    """ Collect the artifacts created and return the inputs to run again, with their retry counters """
+    retry = []
+    for story_state, update in zip(inputs, updates):
+        if update["next"] == "ERROR":
+            retry.append({**story_state, "retry_attempts": update["retry_attempts"]})
+        else:
+            results[story_state["user_story_index"]] = update[BATCH_STAGE_KEYS[stage]][-1]
+    return retry
+
+
+def generate_batch_stage(state: AgentState, run_config: RunnableConfig, creator_node, stage: str, max_concurrency: int):
+    """ Generate the AC or the tasks of every pending user story concurrently, without reviewing them. Failed
+    generations are run again until the creator node retry budget is exhausted """
+    inputs, results = prepare_batch_stage_inputs(state, stage), {}
+    while inputs:
+        updates = creator_node.batch(inputs, config=patch_config(run_config, max_concurrency=max_concurrency))
+        inputs = split_failed_inputs(inputs, updates, stage, results)
+    return merge_batch_stage_results(state, stage, results)
+
+
+async def agenerate_batch_stage(state: AgentState, run_config: RunnableConfig, creator_node, stage: str,
+                                max_concurrency: int):
+    """ Async version of generate_batch_stage """
+    inputs, results = prepare_batch_stage_inputs(state, stage), {}
+    while inputs:
+        updates = await creator_node.abatch(inputs, config=patch_config(run_config, max_concurrency=max_concurrency))
+        inputs = split_failed_inputs(inputs, updates, stage, results)
+    return merge_batch_stage_results(state, stage, results)
+
+
+def create_feature_chain(api_key: str | None = None):
+    node_llm = get_chat_model(config.get_value_by_mapping(ConfigMapping.MODEL_DEPLOYED_FEATURE),
+                              config.get_value_by_mapping(ConfigMapping.MODEL_TEMPERATURE_FEATURE), api_key)
     prompt = ChatPromptTemplate.from_messages(
         [
             ("system", config.get_value_by_mapping(ConfigMapping.FEATURE_TASK_PROMPT)),
@@ -79,13 +266,17 @@ def write_final_output(state: AgentState):
             ("user", "{format_instructions}")
         ]
     )
+    return prompt | node_llm
+
 
-    chain = prompt | node_llm
-    result = chain.invoke({"feature_description": state["feature_description"],
-                           "project_context": config.get_value_by_mapping(ConfigMapping.PROJECT_CONTEXT),
-                           "format_instructions": feature_parser.get_format_instructions()})
+def prepare_feature_inputs(state: AgentState) -> dict:
+    return {"feature_description": state["feature_description"],
+            "project_context": state["project_context"],
+            "format_instructions": feature_parser.get_format_instructions()}
 
-    # Create the final output in the correct format
+
+def build_final_output(state: AgentState, result):
+    """ Create the final output in the correct format """
     final_output: Feature = Feature(**feature_parser.parse(result.content).dict())
     final_output.user_stories = [UserStory(**us.dict()) for us in state["user_stories"].user_stories]
     for i in range(len(final_output.user_stories)):
@@ -98,3 +289,22 @@ def write_final_output(state: AgentState):
         "final_output": final_output
     }
 
+
+def write_final_output(state: AgentState, run_config: RunnableConfig, api_key: str | None = None):
+    """ Generates the feature title and description and produces the final output """
+    # A feature the parser rejects fails the run, its response is not cached for the next one
+    with deferred_cache_writes() as cache_writes:
+        result = create_feature_chain(api_key).invoke(prepare_feature_inputs(state), run_config)
+        output = build_final_output(state, result)
+    cache_writes.commit()
+    return output
+
+
+async def awrite_final_output(state: AgentState, run_config: RunnableConfig, api_key: str | None = None):
+    """ Async version of write_final_output """
+    # A feature the parser rejects fails the run, its response is not cached for the next one
+    with deferred_cache_writes() as cache_writes:
+        result = await create_feature_chain(api_key).ainvoke(prepare_feature_inputs(state), run_config)
+        output = build_final_output(state, result)
+    cache_writes.commit()
+    return output
@@ -0,0 +1,217 @@
+import contextvars
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Optional
+
+from langchain_core.caches import BaseCache, RETURN_VAL_TYPE
+from langchain_core.messages import message_to_dict, messages_from_dict
+from langchain_core.outputs import ChatGeneration, Generation
+
+from Config import *
+
+
+def cache_key(prompt: str, llm_string: str) -> str:
+    """ Content address of an LLM call, llm_string holds the model, temperature and the bound functions """
+    return hashlib.sha256(f"{llm_string}\n{prompt}".encode("utf-8")).hexdigest()
+
+
+def dump_generations(generations: RETURN_VAL_TYPE) -> str:
+    """ JSON of the cached generations, with the messages of the chat ones and their function calls """
+    return json.dumps([{"text": generation.text, "generation_info": generation.generation_info,
+                        "message": message_to_dict(generation.message)
+                        if isinstance(generation, ChatGeneration) else None} for generation in generations])
+
+
+def load_generations(value: str) -> RETURN_VAL_TYPE | None:
+    """ Generations stored by dump_generations, None for the entries of another format """
+    generations = json.loads(value)
+    if not isinstance(generations, list):
+        return None
+    return [ChatGeneration(message=messages_from_dict([generation["message"]])[0],
+                           generation_info=generation["generation_info"])
+            if generation["message"] is not None else
+            Generation(text=generation["text"], generation_info=generation["generation_info"])
+            for generation in generations]
+
+
+class CacheWrites:
+    """ Responses of the LLM calls made in a deferred_cache_writes block, written to their cache on commit """
+
+    def __init__(self, skip_lookups: bool = False):
+        self.skip_lookups = skip_lookups
+        self._lock = threading.Lock()
+        self._pending = []
+
+    def add(self, cache: "CountingCache", key: str, return_val: RETURN_VAL_TYPE):
+        with self._lock:
+            self._pending.append((cache, key, return_val))
+
+    def commit(self):
+        with self._lock:
+            pending, self._pending = self._pending, []
+        for cache, key, return_val in pending:
+            cache.write(key, return_val)
+
+
+_cache_writes: contextvars.ContextVar[CacheWrites | None] = contextvars.ContextVar("cache_writes", default=None)
+
+
+@contextmanager
+def deferred_cache_writes(skip_lookups: bool = False):
+    """ Hold back the cache writes of the LLM calls made in the block, including the ones of the threads and tasks
+    started from it, until commit is called on the yielded CacheWrites. A node commits once its output has parsed,
+    so the responses it rejects are not served again to its retries. With skip_lookups the calls of the block miss
+    the cache, as the ones of a retry do. """
+    writes = CacheWrites(skip_lookups)
+    token = _cache_writes.set(writes)
+    try:
+        yield writes
+    finally:
+        _cache_writes.reset(token)
+
+
+class CountingCache(BaseCache):
+    """ Base for the LLM caches, keeps the hit and miss counters. The backends implement read and write. """
+
+    def __init__(self, max_entries: int, ttl_seconds: float):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._stats_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _count(self, hit: bool):
+        with self._stats_lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def _expired(self, created_at: float) -> bool:
+        return self.ttl_seconds > 0 and time.time() - created_at > self.ttl_seconds
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            total = self.hits + self.misses
+            return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / total if total else 0.0}
+
+    def read(self, key: str) -> Optional[RETURN_VAL_TYPE]:
+        raise NotImplementedError
+
+    def write(self, key: str, return_val: RETURN_VAL_TYPE) -> None:
+        raise NotImplementedError
+
+    def lookup(self, prompt: str, llm_string: str) -> Optional[RETURN_VAL_TYPE]:
+        writes = _cache_writes.get()
+        return_val = None if writes is not None and writes.skip_lookups else self.read(cache_key(prompt, llm_string))
+        self._count(return_val is not None)
+        return return_val
+
+    def update(self, prompt: str, llm_string: str, return_val: RETURN_VAL_TYPE) -> None:
+        key = cache_key(prompt, llm_string)
+        writes = _cache_writes.get()
+        if writes is not None:
+            writes.add(self, key, return_val)
+        else:
+            self.write(key, return_val)
+
+
+class InMemoryLRUCache(CountingCache):
+    """ Process local cache evicting the least recently used entries """
+
+    def __init__(self, max_entries: int, ttl_seconds: float):
+        super().__init__(max_entries, ttl_seconds)
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def read(self, key: str) -> Optional[RETURN_VAL_TYPE]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self._expired(entry[0]):
+                del self._entries[key]
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(key)
+        return entry[1] if entry is not None else None
+
+    def write(self, key: str, return_val: RETURN_VAL_TYPE) -> None:
+        with self._lock:
+            self._entries[key] = (time.time(), return_val)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self, **kwargs) -> None:
+        with self._lock:
+            self._entries.clear()
+
+
+class SQLiteLLMCache(CountingCache):
+    """ On-disk cache shared by every process using the same file, evicts by age and least recent access """
+
+    def __init__(self, path: str, max_entries: int, ttl_seconds: float):
+        super().__init__(max_entries, ttl_seconds)
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.execute("CREATE TABLE IF NOT EXISTS llm_cache ("
+                                     "key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+                                     "created_at REAL NOT NULL, accessed_at REAL NOT NULL)")
+            self._connection.execute("CREATE INDEX IF NOT EXISTS llm_cache_accessed_at ON llm_cache (accessed_at)")
+
+    def read(self, key: str) -> Optional[RETURN_VAL_TYPE]:
+        with self._lock, self._connection:
+            row = self._connection.execute("SELECT value, created_at FROM llm_cache WHERE key = ?", (key,)).fetchone()
+            if row is not None and self._expired(row[1]):
+                self._connection.execute("DELETE FROM llm_cache WHERE key = ?", (key,))
+                row = None
+            if row is not None:
+                self._connection.execute("UPDATE llm_cache SET accessed_at = ? WHERE key = ?", (time.time(), key))
+        # Entries written by older versions are misses, the next update replaces them
+        return load_generations(row[0]) if row is not None else None
+
+    def write(self, key: str, return_val: RETURN_VAL_TYPE) -> None:
+        now = time.time()
+        with self._lock, self._connection:
+            self._connection.execute("INSERT OR REPLACE INTO llm_cache (key, value, created_at, accessed_at) "
+                                     "VALUES (?, ?, ?, ?)", (key, dump_generations(return_val), now, now))
+            if self.ttl_seconds > 0:
+                self._connection.execute("DELETE FROM llm_cache WHERE created_at < ?", (now - self.ttl_seconds,))
+            self._connection.execute("DELETE FROM llm_cache WHERE key IN (SELECT key FROM llm_cache "
+                                     "ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)", (self.max_entries,))
+
+    def clear(self, **kwargs) -> None:
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM llm_cache")
+
+
+_llm_cache: CountingCache | None = None
+_llm_cache_lock = threading.Lock()
+
+
+def get_llm_cache() -> CountingCache | None:
+    """ Return the process-wide LLM cache, or None when caching is disabled in the config """
+    global _llm_cache
+    if not config.get_value_by_mapping(ConfigMapping.LLM_CACHE_ENABLED):
+        return None
+    with _llm_cache_lock:
+        if _llm_cache is None:
+            max_entries = config.get_value_by_mapping(ConfigMapping.LLM_CACHE_MAX_ENTRIES)
+            ttl_seconds = config.get_value_by_mapping(ConfigMapping.LLM_CACHE_TTL_SECONDS)
+            backend = config.get_value_by_mapping(ConfigMapping.LLM_CACHE_BACKEND)
+            if backend == "memory":
+                _llm_cache = InMemoryLRUCache(max_entries, ttl_seconds)
+            elif backend == "sqlite":
+                _llm_cache = SQLiteLLMCache(config.get_value_by_mapping(ConfigMapping.LLM_CACHE_PATH),
+                                            max_entries, ttl_seconds)
+            else:
+                raise ValueError(f"Unknown LLM cache backend: {backend}")
+        return _llm_cache
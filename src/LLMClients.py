@@ -0,0 +1,97 @@
+import threading
+from typing import Callable
+
+import httpx
+from dotenv import load_dotenv
+from langchain_core.language_models import BaseChatModel
+
+from Config import *
+from FakeChatModel import FakeChatModel
+from LLMCache import get_llm_cache
+
+load_dotenv()
+
+# Chat models are keyed by deployment, temperature and API key, every node and run using the same ones share a client
+_chat_models: dict = {}
+_chat_models_lock = threading.Lock()
+_chat_model_factory: Callable[[str, float], BaseChatModel] | None = None
+_http_client: httpx.Client | None = None
+_http_async_client: httpx.AsyncClient | None = None
+
+
+def _create_http_clients():
+    """ Connection pools shared by all the chat models, so TLS sessions are reused across deployments """
+    global _http_client, _http_async_client
+    limits = httpx.Limits(max_connections=config.get_value_by_mapping(ConfigMapping.LLM_MAX_CONNECTIONS),
+                          max_keepalive_connections=config.get_value_by_mapping(
+                              ConfigMapping.LLM_MAX_KEEPALIVE_CONNECTIONS),
+                          keepalive_expiry=config.get_value_by_mapping(ConfigMapping.LLM_KEEPALIVE_EXPIRY))
+    timeout = config.get_value_by_mapping(ConfigMapping.LLM_TIMEOUT)
+    _http_client = httpx.Client(limits=limits, timeout=timeout)
+    _http_async_client = httpx.AsyncClient(limits=limits, timeout=timeout)
+
+
+def create_azure_chat_model(model: str, temperature: float, api_key: str | None = None) -> BaseChatModel:
+    """ Azure OpenAI chat model using `api_key`, or the AZURE_OPENAI_API_KEY environment variable when it is None """
+    # The openai SDK takes a good part of the start up time, it is only imported when an Azure model is needed
+    from AzureChatModel import RateLimitedAzureChatOpenAI
+
+    if _http_client is None:
+        _create_http_clients()
+    credentials = {"api_key": api_key} if api_key is not None else {}
+    return RateLimitedAzureChatOpenAI(model=model, temperature=temperature,
+                           http_client=_http_client, http_async_client=_http_async_client,
+                           cache=get_llm_cache(), **credentials)
+
+
+def create_fake_chat_model(model: str, temperature: float, api_key: str | None = None) -> FakeChatModel:
+    mode = config.get_value_by_mapping(ConfigMapping.FAKE_LLM_MODE)
+    return FakeChatModel(model=model, temperature=temperature, mode=mode,
+                         cassette=config.get_value_by_mapping(ConfigMapping.FAKE_LLM_CASSETTE),
+                         latency_seconds=config.get_value_by_mapping(ConfigMapping.FAKE_LLM_LATENCY_SECONDS),
+                         user_stories=config.get_value_by_mapping(ConfigMapping.FAKE_LLM_USER_STORIES),
+                         delegate=create_azure_chat_model(model, temperature, api_key) if mode == "record" else None,
+                         cache=get_llm_cache())
+
+
+def set_chat_model_factory(factory: Callable[[str, float], BaseChatModel] | None):
+    """ Build the chat models with `factory(model, temperature)` instead of the configured provider, None restores
+    the provider. Graphs compiled before the call keep the clients they already hold. """
+    global _chat_model_factory
+    with _chat_models_lock:
+        _chat_model_factory = factory
+        _chat_models.clear()
+
+
+def get_chat_model(model: str, temperature: float, api_key: str | None = None) -> BaseChatModel:
+    """ Return the shared client for the deployment, temperature and API key, creating it on first use. Without an
+    API key the client uses the one of the environment. """
+    key = (model, temperature, api_key)
+    with _chat_models_lock:
+        if key not in _chat_models:
+            if _chat_model_factory is not None:
+                _chat_models[key] = _chat_model_factory(model, temperature)
+            elif config.get_value_by_mapping(ConfigMapping.LLM_PROVIDER) == "fake":
+                _chat_models[key] = create_fake_chat_model(model, temperature, api_key)
+            else:
+                _chat_models[key] = create_azure_chat_model(model, temperature, api_key)
+        return _chat_models[key]
+
+
+def close_chat_models():
+    """ Forget the shared clients and close the sync connection pool, the next call creates new ones """
+    global _http_client, _http_async_client
+    with _chat_models_lock:
+        _chat_models.clear()
+        if _http_client is not None:
+            _http_client.close()
+        _http_client = None
+        _http_async_client = None
+
+
+async def aclose_chat_models():
+    """ Async version of close_chat_models that also closes the async connection pool """
+    async_client = _http_async_client
+    close_chat_models()
+    if async_client is not None:
+        await async_client.aclose()
@@ -0,0 +1,144 @@
+""" Local stand-in of the Azure DevOps work item REST API, to run and benchmark the exports offline.
+
+It keeps the work items in memory and serves the requests AdoExport sends: work item creation, WIQL tag queries and
+workitemsbatch. Run it on its own with, e.g.:
+
+    python src/MockAdoServer.py --port 8765 --latency 0.05
+
+and point an AdoProject at http://127.0.0.1:8765/mock-org with any project name and PAT.
+"""
+import argparse
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote, urlparse
+
+TAG_QUERY = re.compile(r"\[System\.Tags\]\s+CONTAINS\s+'([^']*)'", re.IGNORECASE)
+
+
+class MockAdoServer:
+    """ In-memory Azure DevOps work item API. `failure_rate` of the requests are rejected with a 503 before they are
+    handled and `lost_response_rate` of the creations succeed but answer with a 503, as if the response was lost. """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, latency_seconds: float = 0.0,
+                 failure_rate: float = 0.0, lost_response_rate: float = 0.0):
+        self.latency_seconds = latency_seconds
+        self.failure_rate = failure_rate
+        self.lost_response_rate = lost_response_rate
+        self.work_items = {}
+        self.requests = 0
+        self._lock = threading.Lock()
+        self._thread = None
+        self.server = ThreadingHTTPServer((host, port), self._create_handler())
+        self.server.daemon_threads = True
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/mock-org"
+
+    def _create_handler(self):
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or "null")
+                status, response = mock.handle(unquote(urlparse(self.path).path), body, self.headers)
+                content = json.dumps(response).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def handle(self, path: str, body, headers) -> tuple:
+        with self._lock:
+            self.requests += 1
+        if self.latency_seconds:
+            time.sleep(self.latency_seconds)
+        if random.random() < self.failure_rate:
+            return 503, {"message": "Service unavailable"}
+        parts = path.strip("/").split("/")
+        # /{organization}/{project}/_apis/wit/{resource}
+        if len(parts) < 5 or parts[2:4] != ["_apis", "wit"]:
+            return 404, {"message": f"Unknown resource {path}"}
+        organization, project, resource = parts[0], parts[1], parts[4:]
+        if resource[0] == "workitems" and len(resource) == 2 and resource[1].startswith("$"):
+            work_item = self.create_work_item(organization, project, resource[1][1:], body)
+            if random.random() < self.lost_response_rate:
+                return 503, {"message": "Service unavailable"}
+            return 200, work_item
+        if resource == ["wiql"]:
+            tag = TAG_QUERY.search(body["query"])
+            with self._lock:
+                work_items = [work_item for work_item in self.work_items.values() if work_item["project"] == project
+                              and (tag is None or tag.group(1) in self.tags(work_item))]
+            return 200, {"workItems": [{"id": work_item["id"], "url": work_item["url"]} for work_item in work_items]}
+        if resource == ["workitemsbatch"]:
+            with self._lock:
+                work_items = [self.work_items[id] for id in body["ids"] if id in self.work_items]
+            return 200, {"count": len(work_items), "value": [
+                {"id": work_item["id"], "url": work_item["url"],
+                 "fields": {field: work_item["fields"][field] for field in body.get("fields", work_item["fields"])
+                            if field in work_item["fields"]}} for work_item in work_items]}
+        return 404, {"message": f"Unknown resource {path}"}
+
+    def create_work_item(self, organization: str, project: str, work_item_type: str, operations: list) -> dict:
+        fields = {"System.WorkItemType": work_item_type}
+        relations = []
+        for operation in operations:
+            if operation["path"].startswith("/fields/"):
+                fields[operation["path"][len("/fields/"):]] = operation["value"]
+            elif operation["path"] == "/relations/-":
+                relations.append(operation["value"])
+        with self._lock:
+            id = len(self.work_items) + 1
+            work_item = {"id": id, "project": project, "fields": fields, "relations": relations,
+                         "url": f"{self.url.rsplit('/', 1)[0]}/{organization}/{project}/_apis/wit/workItems/{id}"}
+            self.work_items[id] = work_item
+        return work_item
+
+    @staticmethod
+    def tags(work_item: dict) -> list:
+        return [tag.strip() for tag in work_item["fields"].get("System.Tags", "").split(";")]
+
+    def start(self) -> "MockAdoServer":
+        self._thread = threading.Thread(target=self.server.serve_forever, name="mock-ado", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in of the Azure DevOps work item REST API")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.0, help="Simulated latency of every request in seconds")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="Share of the requests rejected with a 503")
+    args = parser.parse_args()
+
+    server = MockAdoServer(port=args.port, latency_seconds=args.latency, failure_rate=args.failure_rate)
+    print(f"Mock Azure DevOps organization at {server.url}")
+    server.server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
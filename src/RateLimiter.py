@@ -0,0 +1,146 @@
+import asyncio
+import threading
+import time
+
+from opentelemetry import metrics
+
+from Config import *
+
+# Recorded through the global meter, a no-op until Telemetry sets up a meter provider
+_queue_wait_histogram = metrics.get_meter("agile_crew").create_histogram(
+    "agile_crew.llm.queue_wait", unit="s", description="Time LLM calls waited for the deployment rate limits")
+
+
+class TokenBucket:
+    """ Bucket holding up to `per_minute` units, refilled continuously at `per_minute` per minute """
+
+    def __init__(self, per_minute: float):
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self.available = per_minute
+        self.updated_at = time.monotonic()
+
+    def refill(self, now: float):
+        self.available = min(self.capacity, self.available + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def wait_time(self, amount: float) -> float:
+        # Amounts larger than the bucket would never fit, they wait for a full bucket instead
+        missing = min(amount, self.capacity) - self.available
+        return max(0.0, missing / self.rate)
+
+
+class DeploymentRateLimiter:
+    """ Process-wide requests per minute and tokens per minute limits of one deployment, a limit of 0 disables it.
+    Calls acquire before the request with the estimated tokens and settle the difference with the actual usage
+    afterwards. Waiting calls are not served in strict arrival order. """
+
+    def __init__(self, deployment: str, requests_per_minute: float, tokens_per_minute: float):
+        self.deployment = deployment
+        self._lock = threading.Lock()
+        self._requests = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self._tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self._stats = {"requests": 0, "waited_requests": 0, "waiting": 0, "total_wait_seconds": 0.0,
+                       "max_wait_seconds": 0.0}
+
+    def _try_acquire(self, tokens: int) -> float:
+        """ Take a request and the tokens if both are available, otherwise return how long to wait """
+        with self._lock:
+            now = time.monotonic()
+            wait = 0.0
+            for bucket, amount in ((self._requests, 1), (self._tokens, tokens)):
+                if bucket is not None:
+                    bucket.refill(now)
+                    wait = max(wait, bucket.wait_time(amount))
+            if wait > 0:
+                return wait
+            if self._requests is not None:
+                self._requests.available -= 1
+            if self._tokens is not None:
+                self._tokens.available -= min(tokens, self._tokens.capacity)
+            return 0.0
+
+    def _record_wait(self, waited: float):
+        with self._lock:
+            self._stats["requests"] += 1
+            if waited:
+                self._stats["waited_requests"] += 1
+                self._stats["total_wait_seconds"] += waited
+                self._stats["max_wait_seconds"] = max(self._stats["max_wait_seconds"], waited)
+        _queue_wait_histogram.record(waited, {"gen_ai.request.model": self.deployment})
+
+    def _set_waiting(self, delta: int):
+        with self._lock:
+            self._stats["waiting"] += delta
+
+    def acquire(self, tokens: int) -> float:
+        """ Block until the call fits in the limits, returns the time waited """
+        start = time.monotonic()
+        wait = self._try_acquire(tokens)
+        if wait == 0:
+            self._record_wait(0.0)
+            return 0.0
+        self._set_waiting(1)
+        try:
+            while wait > 0:
+                time.sleep(wait)
+                wait = self._try_acquire(tokens)
+        finally:
+            self._set_waiting(-1)
+        waited = time.monotonic() - start
+        self._record_wait(waited)
+        return waited
+
+    async def aacquire(self, tokens: int) -> float:
+        """ Async version of acquire, the event loop keeps running while the call waits """
+        start = time.monotonic()
+        wait = self._try_acquire(tokens)
+        if wait == 0:
+            self._record_wait(0.0)
+            return 0.0
+        self._set_waiting(1)
+        try:
+            while wait > 0:
+                await asyncio.sleep(wait)
+                wait = self._try_acquire(tokens)
+        finally:
+            self._set_waiting(-1)
+        waited = time.monotonic() - start
+        self._record_wait(waited)
+        return waited
+
+    def settle(self, estimated_tokens: int, actual_tokens: int):
+        """ Charge the difference between the tokens reserved by acquire and the ones the call really used """
+        if self._tokens is None:
+            return
+        with self._lock:
+            self._tokens.available -= actual_tokens - min(estimated_tokens, self._tokens.capacity)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(self._stats)
+
+
+_rate_limiters: dict = {}
+_rate_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(deployment: str) -> DeploymentRateLimiter | None:
+    """ Limiter shared by every client of the deployment, None when it has no limits configured """
+    with _rate_limiters_lock:
+        if deployment not in _rate_limiters:
+            limits = (config.get_value_by_mapping(ConfigMapping.LLM_RATE_LIMIT_DEPLOYMENTS) or {}).get(deployment, {})
+            requests_per_minute = limits.get("requests_per_minute",
+                                             config.get_value_by_mapping(ConfigMapping.LLM_RATE_LIMIT_RPM))
+            tokens_per_minute = limits.get("tokens_per_minute",
+                                           config.get_value_by_mapping(ConfigMapping.LLM_RATE_LIMIT_TPM))
+            _rate_limiters[deployment] = DeploymentRateLimiter(deployment, requests_per_minute, tokens_per_minute) \
+                if requests_per_minute or tokens_per_minute else None
+        return _rate_limiters[deployment]
+
+
+def rate_limiter_stats() -> dict:
+    """ Queue wait figures of every rate limited deployment """
+    with _rate_limiters_lock:
+        limiters = [limiter for limiter in _rate_limiters.values() if limiter is not None]
+    return {limiter.deployment: limiter.stats() for limiter in limiters}
@@ -0,0 +1,77 @@
+import os
+import threading
+from collections import defaultdict
+
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.messages import get_buffer_string
+
+from AgileTools import project_context_inlined
+
+
+class RunReport(BaseCallbackHandler):
+    """ Callback handler collecting per-node figures of a single graph run """
+    run_inline = True
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.nodes = defaultdict(lambda: {"llm_calls": 0, "prompt_chars": 0, "max_prompt_chars": 0,
+                                          "stable_prefix_chars": 0})
+        # node -> last prompt sent, to measure the prefix the next call shares with it
+        self._last_prompts = {}
+        self.agent_runs = 0
+        self.project_context_tool_calls = 0
+        self.pre_verifications = defaultdict(lambda: {"REVIEW": 0, "CONTINUE": 0})
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, parent_run_id=None, tags=None, metadata=None,
+                            **kwargs):
+        node = (metadata or {}).get("langgraph_node", "unknown")
+        prompt = "\n".join(get_buffer_string(prompt) for prompt in messages)
+        with self._lock:
+            stats = self.nodes[node]
+            stats["llm_calls"] += 1
+            stats["prompt_chars"] += len(prompt)
+            stats["max_prompt_chars"] = max(stats["max_prompt_chars"], len(prompt))
+            if node in self._last_prompts:
+                stats["stable_prefix_chars"] += len(os.path.commonprefix([self._last_prompts[node], prompt]))
+            self._last_prompts[node] = prompt
+
+    def on_chain_start(self, serialized, inputs, *, run_id, parent_run_id=None, tags=None, metadata=None, **kwargs):
+        if kwargs.get("name") == "AgentExecutor":
+            with self._lock:
+                self.agent_runs += 1
+
+    def on_tool_start(self, serialized, input_str, *, run_id, parent_run_id=None, tags=None, metadata=None,
+                      **kwargs):
+        if (serialized or {}).get("name") == "get_project_context":
+            with self._lock:
+                self.project_context_tool_calls += 1
+
+    def on_custom_event(self, name, data, *, run_id, tags=None, metadata=None, **kwargs):
+        if name == "pre_verification":
+            with self._lock:
+                self.pre_verifications[data["verifier"]][data["next"]] += 1
+
+    def pre_verification_report(self) -> dict:
+        """ Verifier runs decided by the rules alone, each one saved at least one LLM call """
+        with self._lock:
+            verifiers = {verifier: dict(outcomes) for verifier, outcomes in self.pre_verifications.items()}
+        return {"verifiers": verifiers,
+                "verifier_runs_avoided": sum(sum(outcomes.values()) for outcomes in verifiers.values())}
+
+    def project_context_calls(self) -> dict:
+        """ Every get_project_context call costs one more completion. The prompts ask the agents to fetch the context
+        first, so with the context inlined each agent run counts as one saved LLM call. """
+        with self._lock:
+            return {"inlined": project_context_inlined(),
+                    "tool_calls": self.project_context_tool_calls,
+                    "llm_calls_saved": self.agent_runs if project_context_inlined() else 0}
+
+    def prompt_sizes(self) -> dict:
+        """ Prompt size per node, tokens are estimated at four characters per token. The stable prefix is the start of
+        each prompt shared with the previous call of the node, the part a provider prefix cache can serve. """
+        with self._lock:
+            return {node: {**stats, "approx_prompt_tokens": stats["prompt_chars"] // 4,
+                           "approx_stable_prefix_tokens": stats["stable_prefix_chars"] // 4,
+                           "stable_prefix_share": round(stats["stable_prefix_chars"] / stats["prompt_chars"], 2)
+                           if stats["prompt_chars"] else 0.0}
+                    for node, stats in self.nodes.items()}
@@ -0,0 +1,185 @@
+import threading
+import time
+
+from langchain_core.callbacks import BaseCallbackHandler
+from langgraph.graph import START
+from opentelemetry import metrics, trace
+from opentelemetry.sdk.metrics import MeterProvider
+from opentelemetry.sdk.metrics.export import ConsoleMetricExporter, InMemoryMetricReader, \
+    PeriodicExportingMetricReader
+from opentelemetry.sdk.resources import Resource
+from opentelemetry.sdk.trace import TracerProvider
+from opentelemetry.sdk.trace.export import BatchSpanProcessor, ConsoleSpanExporter, SimpleSpanProcessor
+from opentelemetry.sdk.trace.export.in_memory_span_exporter import InMemorySpanExporter
+from opentelemetry.trace import Status, StatusCode
+
+from Config import *
+
+# Providers are process wide, they are set up once on the first run with telemetry enabled
+_setup_lock = threading.Lock()
+_tracer: trace.Tracer | None = None
+_instruments: dict = {}
+# Filled with the memory exporter, to inspect the spans and metrics of offline runs
+span_exporter: InMemorySpanExporter | None = None
+metric_reader: InMemoryMetricReader | None = None
+
+
+def telemetry_enabled() -> bool:
+    return config.get_value_by_mapping(ConfigMapping.TELEMETRY_EXPORTER) != "none"
+
+
+def setup_telemetry():
+    """ Create the tracer and meter providers for the configured exporter: console, memory or otlp """
+    global _tracer, span_exporter, metric_reader
+    with _setup_lock:
+        if _tracer is not None:
+            return
+        exporter = config.get_value_by_mapping(ConfigMapping.TELEMETRY_EXPORTER)
+        resource = Resource.create({"service.name": config.get_value_by_mapping(ConfigMapping.TELEMETRY_SERVICE_NAME)})
+        if exporter == "console":
+            span_processor = SimpleSpanProcessor(ConsoleSpanExporter())
+            reader = PeriodicExportingMetricReader(ConsoleMetricExporter())
+        elif exporter == "memory":
+            span_exporter = InMemorySpanExporter()
+            span_processor = SimpleSpanProcessor(span_exporter)
+            reader = metric_reader = InMemoryMetricReader()
+        elif exporter == "otlp":
+            from opentelemetry.exporter.otlp.proto.grpc.metric_exporter import OTLPMetricExporter
+            from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import OTLPSpanExporter
+            endpoint = config.get_value_by_mapping(ConfigMapping.TELEMETRY_OTLP_ENDPOINT)
+            span_processor = BatchSpanProcessor(OTLPSpanExporter(endpoint=endpoint))
+            reader = PeriodicExportingMetricReader(OTLPMetricExporter(endpoint=endpoint))
+        else:
+            raise ValueError(f"Unknown telemetry exporter {exporter}")
+
+        tracer_provider = TracerProvider(resource=resource)
+        tracer_provider.add_span_processor(span_processor)
+        meter_provider = MeterProvider(resource=resource, metric_readers=[reader])
+        trace.set_tracer_provider(tracer_provider)
+        metrics.set_meter_provider(meter_provider)
+
+        meter = meter_provider.get_meter("agile_crew")
+        _instruments["node_duration"] = meter.create_histogram(
+            "agile_crew.node.duration", unit="s", description="Wall time of every graph node run")
+        _instruments["llm_duration"] = meter.create_histogram(
+            "agile_crew.llm.duration", unit="s", description="Wall time of every LLM call")
+        _instruments["llm_tokens"] = meter.create_counter(
+            "agile_crew.llm.tokens", unit="{token}", description="Prompt and completion tokens of the LLM calls")
+        _tracer = tracer_provider.get_tracer("agile_crew")
+
+
+def get_telemetry_handler() -> BaseCallbackHandler | None:
+    """ Callback handler tracing a run, None when telemetry is disabled """
+    if not telemetry_enabled():
+        return None
+    setup_telemetry()
+    return TelemetryHandler(_tracer)
+
+
+class TelemetryHandler(BaseCallbackHandler):
+    """ Callback handler opening a span for the graph run, every node, agent executor and LLM call of a run.
+    Spans are nested following the callback run tree, so parallel user stories keep separate branches. """
+    run_inline = True
+
+    def __init__(self, tracer: trace.Tracer):
+        self._tracer = tracer
+        self._lock = threading.Lock()
+        self._parents = {}
+        # run_id -> (span, start time, node, user story index)
+        self._spans = {}
+
+    def _parent_span(self, parent_run_id):
+        """ Closest traced ancestor of a run, with the node and user story index it belongs to """
+        while parent_run_id is not None and parent_run_id not in self._spans:
+            parent_run_id = self._parents.get(parent_run_id)
+        if parent_run_id is None:
+            return None, None, None
+        span, _, node, story_index = self._spans[parent_run_id]
+        return span, node, story_index
+
+    def _start_span(self, name: str, run_id, parent_run_id, node, story_index, attributes: dict):
+        parent, parent_node, parent_story_index = self._parent_span(parent_run_id)
+        node = node or parent_node
+        story_index = story_index if story_index is not None else parent_story_index
+        if node is not None:
+            attributes["agile_crew.node"] = node
+        if story_index is not None:
+            attributes["agile_crew.user_story_index"] = story_index
+        context = trace.set_span_in_context(parent) if parent is not None else None
+        span = self._tracer.start_span(name, context=context, attributes=attributes)
+        self._spans[run_id] = (span, time.perf_counter(), node, story_index)
+
+    def _end_span(self, run_id, error: BaseException | None = None):
+        span, start, node, _ = self._spans.pop(run_id)
+        if error is not None:
+            span.record_exception(error)
+            span.set_status(Status(StatusCode.ERROR, str(error)))
+        span.end()
+        return span, time.perf_counter() - start, node
+
+    def on_chain_start(self, serialized, inputs, *, run_id, parent_run_id=None, tags=None, metadata=None, **kwargs):
+        name = kwargs.get("name")
+        node = (metadata or {}).get("langgraph_node")
+        with self._lock:
+            self._parents[run_id] = parent_run_id
+            if parent_run_id is None:
+                self._start_span("agile_crew.run", run_id, None, None, None, {})
+            elif node not in (None, START) and name == node and self._parent_span(parent_run_id)[1] != node:
+                # The runnable wrapped by a node reports under the same name, only the outer run gets a span
+                story_index = inputs.get("user_story_index") if isinstance(inputs, dict) else None
+                self._start_span(f"node {node}", run_id, parent_run_id, node, story_index,
+                                 {"agile_crew.verification_attempts": inputs.get("verification_attempts", 0)
+                                  if isinstance(inputs, dict) else 0})
+            elif name == "AgentExecutor":
+                self._start_span("agent_executor", run_id, parent_run_id, None, None, {})
+
+    def on_chain_end(self, outputs, *, run_id, **kwargs):
+        self._finish_chain(run_id, outputs)
+
+    def on_chain_error(self, error, *, run_id, **kwargs):
+        self._finish_chain(run_id, None, error)
+
+    def _finish_chain(self, run_id, outputs, error: BaseException | None = None):
+        with self._lock:
+            self._parents.pop(run_id, None)
+            if run_id not in self._spans:
+                return
+            span, _, node, _ = self._spans[run_id]
+            if isinstance(outputs, dict) and span.is_recording():
+                if "next" in outputs:
+                    span.set_attribute("agile_crew.next", str(outputs["next"]))
+                if "verification_attempts" in outputs:
+                    span.set_attribute("agile_crew.verification_attempts", outputs["verification_attempts"])
+                if node in outputs.get("retry_attempts", {}):
+                    span.set_attribute("agile_crew.retry_attempts", outputs["retry_attempts"][node])
+            is_node_span = node is not None and span.name == f"node {node}"
+            _, duration, _ = self._end_span(run_id, error)
+        if is_node_span:
+            _instruments["node_duration"].record(duration, {"agile_crew.node": node, "error": error is not None})
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, parent_run_id=None, tags=None, metadata=None,
+                            **kwargs):
+        model = (metadata or {}).get("ls_model_name") or kwargs.get("invocation_params", {}).get("model", "unknown")
+        with self._lock:
+            self._start_span(f"llm {model}", run_id, parent_run_id, (metadata or {}).get("langgraph_node"), None,
+                             {"gen_ai.request.model": model})
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        usage = (response.llm_output or {}).get("token_usage", {})
+        with self._lock:
+            if run_id not in self._spans:
+                return
+            span, _, node, _ = self._spans[run_id]
+            model = span.attributes.get("gen_ai.request.model") if span.is_recording() else "unknown"
+            span.set_attribute("gen_ai.usage.input_tokens", usage.get("prompt_tokens", 0))
+            span.set_attribute("gen_ai.usage.output_tokens", usage.get("completion_tokens", 0))
+            _, duration, _ = self._end_span(run_id)
+        attributes = {"gen_ai.request.model": model, "agile_crew.node": node or "unknown"}
+        _instruments["llm_duration"].record(duration, attributes)
+        _instruments["llm_tokens"].add(usage.get("prompt_tokens", 0), {**attributes, "gen_ai.token.type": "input"})
+        _instruments["llm_tokens"].add(usage.get("completion_tokens", 0), {**attributes, "gen_ai.token.type": "output"})
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        with self._lock:
+            if run_id in self._spans:
+                self._end_span(run_id, error)
@@ -0,0 +1,74 @@
+import threading
+from collections import defaultdict
+
+from langchain_core.callbacks import BaseCallbackHandler
+
+
+class TokenBudgetExceeded(Exception):
+    """ Raised to abort a run once its LLM calls consumed more tokens than its budget """
+
+    def __init__(self, budget: int, used: int):
+        super().__init__(f"Token budget of {budget} exceeded, {used} tokens used")
+        self.budget = budget
+        self.used = used
+
+
+def _empty_usage() -> dict:
+    return {"llm_calls": 0, "prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
+
+
+class UsageLedger(BaseCallbackHandler):
+    """ Callback handler adding up the tokens reported by the LLM responses of a run, per node, per user story and
+    per model deployment. Responses served from the LLM cache report no usage and cost nothing.
+    With a token budget, the run is aborted with TokenBudgetExceeded as soon as the budget is exceeded. """
+    run_inline = True
+    raise_error = True
+
+    def __init__(self, token_budget: int | None = None):
+        self.token_budget = token_budget or None
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.total = _empty_usage()
+        self.nodes = defaultdict(_empty_usage)
+        self.user_stories = defaultdict(_empty_usage)
+        self.deployments = defaultdict(_empty_usage)
+
+    def _check_budget(self):
+        if self.token_budget is not None and self.total["total_tokens"] > self.token_budget:
+            raise TokenBudgetExceeded(self.token_budget, self.total["total_tokens"])
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, parent_run_id=None, tags=None, metadata=None,
+                            **kwargs):
+        metadata = metadata or {}
+        deployment = metadata.get("ls_model_name") or kwargs.get("invocation_params", {}).get("model", "unknown")
+        with self._lock:
+            self._check_budget()
+            self._calls[run_id] = (metadata.get("langgraph_node", "unknown"), metadata.get("user_story_index"),
+                                   deployment)
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        token_usage = (response.llm_output or {}).get("token_usage") or {}
+        usage = {"llm_calls": 1,
+                 "prompt_tokens": token_usage.get("prompt_tokens", 0),
+                 "completion_tokens": token_usage.get("completion_tokens", 0)}
+        usage["total_tokens"] = token_usage.get("total_tokens", usage["prompt_tokens"] + usage["completion_tokens"])
+        with self._lock:
+            node, user_story_index, deployment = self._calls.pop(run_id, ("unknown", None, "unknown"))
+            entries = [self.total, self.nodes[node], self.deployments[deployment]]
+            if user_story_index is not None:
+                entries.append(self.user_stories[user_story_index])
+            for entry in entries:
+                for key, value in usage.items():
+                    entry[key] += value
+            self._check_budget()
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        with self._lock:
+            self._calls.pop(run_id, None)
+
+    def summary(self) -> dict:
+        with self._lock:
+            return {"total": dict(self.total),
+                    "nodes": {node: dict(usage) for node, usage in self.nodes.items()},
+                    "user_stories": {index: dict(usage) for index, usage in sorted(self.user_stories.items())},
+                    "deployments": {deployment: dict(usage) for deployment, usage in self.deployments.items()}}
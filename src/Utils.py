@@ -1,9 +1,15 @@
 import json
+import random
+from typing import TYPE_CHECKING, Callable
 
-from bluesheperd.core.items import Feature, Task, UserStory
-from bluesheperd.core.project import AzureProject
 from langchain_core.agents import AgentActionMessageLog, AgentFinish
-from langchain_core.prompts import ChatPromptTemplate
+from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+from loguru import logger
+
+from Config import *
+
+if TYPE_CHECKING:
+    from AdoExport import AdoProject
 
 
 def prepare_tool_prompt(task: str, task_requirements: str, task_input: str) -> ChatPromptTemplate:
@@ -27,7 +33,8 @@ def parse(output):
     name = function_call["name"]
     inputs = json.loads(function_call["arguments"])
 
-    if name in ("ListOfUserStories", "ListOfAcceptanceCriteria", "ListOfTasks", "FeedbackOutput"):
+    if name in ("ListOfUserStories", "ListOfAcceptanceCriteria", "ListOfTasks", "AcceptanceCriteriaAndTasks",
+                "FeedbackOutput", "ListOfUserStoryFeedback"):
         return AgentFinish(return_values=inputs, log=str(function_call))
     # Otherwise, return an agent action
     else:
@@ -36,7 +43,30 @@ def parse(output):
         )
 
 
+# Prompt variables holding the same value on every call of a graph run
+STABLE_PROMPT_VARIABLES = {"project_context", "feature_description"}
+
+
+def cache_friendly_prompt(prompt: ChatPromptTemplate) -> ChatPromptTemplate:
+    """ Same prompt with the messages that do not change between calls first: the static instructions, then the ones
+    filled with the project context or the feature description, then the per-call inputs, the history and the
+    agent scratchpad """
+    def rank(message) -> int:
+        if isinstance(message, MessagesPlaceholder):
+            return 4 if message.variable_name == "agent_scratchpad" else 3
+        variables = set(message.input_variables) - set(prompt.partial_variables)
+        if not variables:
+            return 0
+        return 1 if variables <= STABLE_PROMPT_VARIABLES else 2
+
+    # sorted is stable, the messages keep their relative order within each group
+    return ChatPromptTemplate(sorted(prompt.messages, key=rank), input_variables=prompt.input_variables). \
+        partial(**prompt.partial_variables)
+
+
 def create_agent(agent_llm, prompt, inputs):
+    if config.get_value_by_mapping(ConfigMapping.LLM_PROMPT_LAYOUT) == "cache_friendly":
+        prompt = cache_friendly_prompt(prompt)
     agent = (
             inputs
             | prompt
@@ -45,45 +75,55 @@ def create_agent(agent_llm, prompt, inputs):
     )
     return agent
 
-def save_to_ado(llm_output: str, project: AzureProject | None = None):
-    llm_output = json.loads(llm_output)
-
-    parent_feature = {
-        k: v for k, v in llm_output["items"][0].items() if k != "user_stories"
-    }
-
-    feat = Feature(
-        title=parent_feature["title"],
-        description=parent_feature["description"],
-        project=project,
-    )
-
-    created_feature = feat.create_item()
-
-    user_stories = llm_output["items"][0]["user_stories"]
-    for idx, user_story in enumerate(user_stories):
-        user_stories[idx] = {k: v for k, v in user_story.items()}
-
-    ado_user_stories = []
-    for us in user_stories:
-        children_tasks = [
-            Task(
-                title=task["title"],
-                description=task["description"],
-                project=project,
-            )
-            for task in us["tasks"]
-        ]
-
-        ado_user_stories.append(
-            UserStory(
-                title=us["title"],
-                description=us["description"],
-                acceptance_criteria=us["acceptance_criteria"],
-                parent_url=created_feature[0].url,
-                children=children_tasks,
-                project=project,
-            ).create_item()
-        )
-
-    return None
\ No newline at end of file
+class RetryBudgetExhausted(Exception):
+    """ Raised when a node keeps failing after all the retries allowed by the config """
+
+    def __init__(self, node: str, attempts: int):
+        super().__init__(f"Node '{node}' exhausted its retry budget after {attempts} failed attempts")
+        self.node = node
+        self.attempts = attempts
+
+
+def register_node_result(state, update: dict, node: str, run_config: dict | None = None) -> dict:
+    """ Track the consecutive failures of a node, separately from the verification attempts.
+    A failed attempt is added to the retry counters, a successful one resets the node counter. The counters are
+    kept by the agent name `node`, RetryBudgetExhausted names the graph node of `run_config`, as the logs do. """
+    retry_attempts = dict(state.get("retry_attempts") or {})
+    if update["next"] != "ERROR":
+        if retry_attempts.pop(node, None) is not None:
+            update["retry_attempts"] = retry_attempts
+        return update
+    retry_attempts[node] = retry_attempts.get(node, 0) + 1
+    if retry_attempts[node] > config.get_value_by_mapping(ConfigMapping.RETRY_MAX_ATTEMPTS):
+        graph_node = ((run_config or {}).get("metadata") or {}).get("langgraph_node", node)
+        logger.error(f"Node {graph_node} exhausted its retry budget")
+        raise RetryBudgetExhausted(graph_node, retry_attempts[node])
+    update["retry_attempts"] = retry_attempts
+    return update
+
+
+def tag_user_story(state, config: dict) -> dict:
+    """ Add the index of the user story a node works on to the run metadata, so the callbacks of its LLM calls
+    can be attributed to the story """
+    if state.get("user_story_index") is None:
+        return config
+    return {**config, "metadata": {**(config.get("metadata") or {}), "user_story_index": state["user_story_index"]}}
+
+
+def retry_delay(attempt: int) -> float:
+    """ Exponential backoff with jitter, half of the delay is fixed and the other half random """
+    delay = min(config.get_value_by_mapping(ConfigMapping.RETRY_BASE_DELAY_SECONDS) * 2 ** (attempt - 1),
+                config.get_value_by_mapping(ConfigMapping.RETRY_MAX_DELAY_SECONDS))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+def save_to_ado(llm_output: str, project: "AdoProject | None" = None,
+                on_progress: Callable[[int, int], None] | None = None) -> dict:
+    """ Export the feature of the AgileWorkItems JSON to Azure DevOps, to the project of the environment when `project`
+    is None, see AdoExport.export_feature. Returns the url of every work item. """
+    from AdoExport import AdoClient, AdoProject, export_feature
+
+    feature = json.loads(llm_output)["items"][0]
+    project = project or AdoProject.from_environment()
+    with AdoClient(project) as client:
+        return export_feature(client, feature, on_progress=on_progress)
\ No newline at end of file
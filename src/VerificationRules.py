@@ -0,0 +1,52 @@
+import re
+
+from models.AgileCrewModels import ListOfAcceptanceCriteria, ListOfTasks, ListOfUserStories
+
+USER_STORY_TITLE = re.compile(r"^\s*As an? .+?,?\s+I want .+?,?\s+so that .+", re.IGNORECASE | re.DOTALL)
+
+
+def duplicates(values: list) -> list:
+    seen, repeated = set(), []
+    for value in values:
+        key = " ".join(value.lower().split())
+        if key in seen and value not in repeated:
+            repeated.append(value)
+        seen.add(key)
+    return repeated
+
+
+def user_stories_issues(user_stories: ListOfUserStories | None) -> list:
+    """ Problems of the user stories that do not need an LLM to be found """
+    if user_stories is None or not user_stories.user_stories:
+        return ["No user stories were created for the feature."]
+    issues = [f"The title '{us.title}' does not follow the format: As a <type of user>, I want <some goal> so that "
+              f"<some reason>." for us in user_stories.user_stories if not USER_STORY_TITLE.match(us.title)]
+    issues += [f"The user story '{us.title}' has no description." for us in user_stories.user_stories
+               if not us.description.strip()]
+    issues += [f"The user story '{title}' is duplicated." for title in
+               duplicates([us.title for us in user_stories.user_stories])]
+    return issues
+
+
+def acceptance_criteria_issues(acceptance_criteria: ListOfAcceptanceCriteria) -> list:
+    if not acceptance_criteria.acceptance_criteria:
+        return ["No acceptance criteria were created for the user story."]
+    issues = ["Some acceptance criteria are empty."] \
+        if any(not ac.strip() for ac in acceptance_criteria.acceptance_criteria) else []
+    issues += [f"The acceptance criterion '{ac}' is duplicated." for ac in
+               duplicates([ac for ac in acceptance_criteria.acceptance_criteria if ac.strip()])]
+    return issues
+
+
+def tasks_issues(tasks: ListOfTasks) -> list:
+    if not tasks.tasks:
+        return ["No tasks were created for the user story."]
+    issues = [f"The task '{task.title}' has no description." if task.title.strip() else "A task has no title."
+              for task in tasks.tasks if not task.title.strip() or not task.description.strip()]
+    issues += [f"The task '{title}' is duplicated." for title in
+               duplicates([task.title for task in tasks.tasks if task.title.strip()])]
+    return issues
+
+
+def rules_feedback(issues: list) -> str:
+    return "The work does not meet these basic requirements, fix them:\n" + "\n".join(f"- {issue}" for issue in issues)
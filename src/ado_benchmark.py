@@ -0,0 +1,83 @@
+""" Offline throughput benchmark of the Azure DevOps export against the local MockAdoServer.
+
+Every run exports a synthetic feature to a fresh mock server, then exports it again to check that no work item is
+duplicated. Run it from the repository root, e.g.:
+
+    python src/ado_benchmark.py --stories 10 --tasks 5 --concurrency 1 4 16 --latency 0.05
+"""
+import argparse
+import json
+import time
+
+from loguru import logger
+
+from AdoExport import AdoClient, AdoExportError, AdoProject, export_feature
+from Config import *
+from MockAdoServer import MockAdoServer
+
+
+def synthetic_feature(user_stories: int, tasks: int) -> dict:
+    return {"id": "benchmark", "title": "Benchmark feature", "description": "Feature exported by the benchmark",
+            "user_stories": [{"title": f"As a user, I want goal {i} so that reason {i}",
+                              "description": f"User story {i}",
+                              "acceptance_criteria": [f"Criterion {i}.{j}" for j in range(3)],
+                              "tasks": [{"title": f"Task {i}.{j}", "description": f"Task {j} of user story {i}"}
+                                        for j in range(tasks)]}
+                             for i in range(user_stories)]}
+
+
+def run_benchmark(feature: dict, concurrency: int, latency: float, failure_rate: float) -> dict:
+    with config.override({ConfigMapping.ADO_MAX_CONCURRENCY: concurrency}), \
+            MockAdoServer(latency_seconds=latency, failure_rate=failure_rate) as server, \
+            AdoClient(AdoProject(server.url, "benchmark", "pat")) as client:
+        start = time.perf_counter()
+        try:
+            urls = export_feature(client, feature)
+        except AdoExportError as e:
+            # Failed items are left to the second export, as a user exporting again would do
+            urls = {}
+            logger.warning(str(e))
+        wall_time = time.perf_counter() - start
+        requests = server.requests
+        export_feature(client, feature)
+        return {"concurrency": concurrency,
+                "work_items": len(urls),
+                "wall_time": round(wall_time, 4),
+                "work_items_per_second": round(len(urls) / wall_time, 2) if wall_time else 0.0,
+                "requests": requests,
+                "work_items_after_reexport": len(server.work_items)}
+
+
+def print_results(results: list):
+    print(f"{'concurrency':>12} {'work items':>11} {'wall time (s)':>14} {'items/s':>9} {'requests':>9} "
+          f"{'after re-export':>16}")
+    for result in results:
+        print(f"{result['concurrency']:>12} {result['work_items']:>11} {result['wall_time']:>14.3f} "
+              f"{result['work_items_per_second']:>9} {result['requests']:>9} {result['work_items_after_reexport']:>16}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark of the Azure DevOps export")
+    parser.add_argument("--stories", type=int, default=10, help="User stories of the exported feature")
+    parser.add_argument("--tasks", type=int, default=5, help="Tasks of every user story")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16],
+                        help="Work items created at the same time, one benchmark per value")
+    parser.add_argument("--latency", type=float, default=0.05, help="Simulated latency of every request in seconds")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="Share of the requests rejected with a 503")
+    parser.add_argument("--json", help="Also write the results to this file")
+    parser.add_argument("--verbose", action="store_true", help="Keep the export logs output")
+    args = parser.parse_args()
+
+    if not args.verbose:
+        logger.remove()
+    feature = synthetic_feature(args.stories, args.tasks)
+    results = [run_benchmark(feature, concurrency, args.latency, args.failure_rate)
+               for concurrency in args.concurrency]
+    print_results(results)
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
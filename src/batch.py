@@ -0,0 +1,136 @@
+""" Generate many features from a JSONL file with AgileCrewGraph.
+
+Every input line holds a `feature_description`, a `project_context` and optionally an `id`. Results are appended to
+the output file as one JSON line per feature as soon as they are ready, and inputs whose id is already there are
+skipped, so an interrupted batch is restarted with the same command. Run it from the repository root, e.g.:
+
+    python src/batch.py backlog.jsonl features.ndjson --workers 8 --executor thread
+"""
+import argparse
+import hashlib
+import json
+import math
+import os
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from multiprocessing import util
+
+from loguru import logger
+
+from AgileGraph import AgileCrewGraph
+
+# Graph of the current process, shared by the threads of a thread pool or created once per pool process
+_crew: AgileCrewGraph | None = None
+
+
+def input_id(item: dict) -> str:
+    if item.get("id") is not None:
+        return str(item["id"])
+    content = json.dumps([item["feature_description"], item.get("project_context", "")])
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()[:16]
+
+
+def read_inputs(path: str) -> list:
+    with open(path, "r") as file:
+        items = [json.loads(line) for line in file if line.strip()]
+    return [{**item, "id": input_id(item)} for item in items]
+
+
+def read_done_ids(path: str) -> set:
+    """ Ids already generated in a previous run, failed ones are tried again """
+    if not os.path.exists(path):
+        return set()
+    with open(path, "r") as file:
+        return {result["id"] for result in map(json.loads, filter(str.strip, file)) if "feature" in result}
+
+
+def init_worker(verbose: bool):
+    global _crew
+    if not verbose:
+        logger.remove()
+    _crew = AgileCrewGraph()
+    # Pool processes exit without running the atexit handlers, the multiprocessing finalizers run in both cases
+    util.Finalize(None, close_worker, exitpriority=10)
+
+
+def close_worker():
+    """ Close the graph of the current process, releasing its log sink and checkpoints database """
+    global _crew
+    if _crew is not None:
+        _crew.close()
+        _crew = None
+
+
+def generate_feature(item: dict, checkpoints: bool) -> dict:
+    start = time.perf_counter()
+    try:
+        feature = _crew.invoke_graph(item["feature_description"], item.get("project_context", ""),
+                                     thread_id=item["id"] if checkpoints else None)
+        result = {"id": item["id"], "feature": feature.dict()}
+    except Exception as e:
+        logger.error(f"Feature {item['id']} failed: {e}")
+        result = {"id": item["id"], "error": f"{type(e).__name__}: {e}"}
+    result["latency"] = round(time.perf_counter() - start, 3)
+    return result
+
+
+def create_executor(kind: str, workers: int, verbose: bool) -> Executor:
+    if kind == "process":
+        return ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(verbose,))
+    # AgileCrewGraph is safe to share between threads, a single graph serves the whole pool
+    init_worker(verbose)
+    return ThreadPoolExecutor(max_workers=workers, thread_name_prefix="agile-crew-batch")
+
+
+def percentile(values: list, percent: float) -> float:
+    """ Nearest-rank percentile """
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(percent / 100 * len(ordered)) - 1)]
+
+
+def run_batch(input_path: str, output_path: str, workers: int, kind: str, checkpoints: bool, verbose: bool) -> dict:
+    items = read_inputs(input_path)
+    done = read_done_ids(output_path)
+    pending = [item for item in items if item["id"] not in done]
+    logger.info(f"{len(items)} inputs, {len(items) - len(pending)} already done, {len(pending)} to generate")
+    latencies, failed = [], 0
+    start = time.perf_counter()
+    with open(output_path, "a") as output, create_executor(kind, workers, verbose) as executor:
+        futures = [executor.submit(generate_feature, item, checkpoints) for item in pending]
+        for future in as_completed(futures):
+            result = future.result()
+            output.write(json.dumps(result) + "\n")
+            output.flush()
+            if "feature" in result:
+                latencies.append(result["latency"])
+            else:
+                failed += 1
+    if kind == "thread":
+        # The graph of a thread pool belongs to this process, it is not needed once the batch is done
+        close_worker()
+    wall_time = time.perf_counter() - start
+    return {"inputs": len(items), "skipped": len(items) - len(pending), "generated": len(latencies),
+            "failed": failed, "wall_time": round(wall_time, 3),
+            "features_per_minute": round(len(latencies) / wall_time * 60, 2) if wall_time else 0.0,
+            "latency_p50": percentile(latencies, 50) if latencies else None,
+            "latency_p95": percentile(latencies, 95) if latencies else None}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate features in batch with the Agile Crew graph")
+    parser.add_argument("input", help="JSONL file with feature_description, project_context and optional id")
+    parser.add_argument("output", help="NDJSON file the features are appended to")
+    parser.add_argument("--workers", type=int, default=4, help="Number of features generated at the same time")
+    parser.add_argument("--executor", choices=["thread", "process"], default="thread",
+                        help="Run the features in a thread pool or in a process pool")
+    parser.add_argument("--checkpoints", action="store_true",
+                        help="Checkpoint every feature under its id, so a feature interrupted midway resumes")
+    parser.add_argument("--verbose", action="store_true", help="Keep the graph logs output")
+    args = parser.parse_args()
+
+    report = run_batch(args.input, args.output, args.workers, args.executor, args.checkpoints, args.verbose)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+""" Offline end-to-end benchmark of AgileCrewGraph.invoke_graph.
+
+Every chat model is replaced by the scripted FakeChatModel, so no network access is needed. Run it from the
+repository root, e.g.:
+
+    python src/benchmark.py --stories 1 5 10 25 50 --latency 0.05 --json bench.json
+"""
+import argparse
+import json
+import threading
+import time
+import tracemalloc
+from collections import defaultdict
+
+from loguru import logger
+
+import LLMClients
+from AgileGraph import AgileCrewGraph
+from Config import *
+from FakeChatModel import FakeChatModel
+from RunReport import RunReport
+
+
+class BenchmarkReport(RunReport):
+    """ RunReport that also records the wall time and the peak traced memory of every graph node.
+    Peaks are process wide, so they overlap when nodes run concurrently. """
+
+    def __init__(self):
+        super().__init__()
+        self._active_nodes = {}
+        self.node_timings = defaultdict(lambda: {"runs": 0, "wall_time": 0.0, "peak_memory": 0})
+
+    def on_chain_start(self, serialized, inputs, *, run_id, parent_run_id=None, tags=None, metadata=None, **kwargs):
+        super().on_chain_start(serialized, inputs, run_id=run_id, parent_run_id=parent_run_id, tags=tags,
+                               metadata=metadata, **kwargs)
+        node = (metadata or {}).get("langgraph_node")
+        if node is None or kwargs.get("name") != node:
+            return
+        with self._lock:
+            # The runnable wrapped by a node reports under the same name, only the outer run is timed
+            if parent_run_id in self._active_nodes:
+                return
+            if not self._active_nodes:
+                tracemalloc.reset_peak()
+            self._active_nodes[run_id] = (node, time.perf_counter())
+
+    def on_chain_end(self, outputs, *, run_id, **kwargs):
+        self._finish_node(run_id)
+
+    def on_chain_error(self, error, *, run_id, **kwargs):
+        self._finish_node(run_id)
+
+    def _finish_node(self, run_id):
+        with self._lock:
+            if run_id not in self._active_nodes:
+                return
+            node, start = self._active_nodes.pop(run_id)
+            timings = self.node_timings[node]
+            timings["runs"] += 1
+            timings["wall_time"] += time.perf_counter() - start
+            timings["peak_memory"] = max(timings["peak_memory"], tracemalloc.get_traced_memory()[1])
+
+    def per_node(self) -> dict:
+        prompt_sizes = self.prompt_sizes()
+        return {node: {"runs": timings["runs"],
+                       "wall_time": round(timings["wall_time"], 4),
+                       "llm_calls": prompt_sizes.get(node, {}).get("llm_calls", 0),
+                       "prompt_tokens": prompt_sizes.get(node, {}).get("approx_prompt_tokens", 0),
+                       "stable_prefix_tokens": prompt_sizes.get(node, {}).get("approx_stable_prefix_tokens", 0),
+                       "peak_memory_kb": timings["peak_memory"] // 1024}
+                for node, timings in self.node_timings.items()}
+
+
+def run_benchmark(user_stories: int, latency: float) -> dict:
+    LLMClients.set_chat_model_factory(
+        lambda model, temperature: FakeChatModel(model=model, temperature=temperature, latency_seconds=latency,
+                                                 user_stories=user_stories))
+    with AgileCrewGraph() as crew:
+        report = BenchmarkReport()
+        tracemalloc.start()
+        start = time.perf_counter()
+        feature = crew.invoke_graph("Benchmark feature description", "Benchmark project context", run_report=report)
+        wall_time = time.perf_counter() - start
+        peak_memory = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    nodes = report.per_node()
+    return {"user_stories": len(feature.user_stories),
+            "wall_time": round(wall_time, 4),
+            "llm_calls": sum(node["llm_calls"] for node in nodes.values()),
+            "prompt_tokens": sum(node["prompt_tokens"] for node in nodes.values()),
+            "peak_memory_kb": peak_memory // 1024,
+            "nodes": nodes}
+
+
+def print_results(results: list):
+    print(f"{'stories':>8} {'wall time (s)':>14} {'LLM calls':>10} {'prompt tokens':>14} {'peak memory (KB)':>17}")
+    for result in results:
+        print(f"{result['user_stories']:>8} {result['wall_time']:>14.3f} {result['llm_calls']:>10} "
+              f"{result['prompt_tokens']:>14} {result['peak_memory_kb']:>17}")
+    for result in results:
+        print(f"\nPer node, {result['user_stories']} user stories")
+        print(f"{'node':>24} {'runs':>6} {'wall time (s)':>14} {'LLM calls':>10} {'prompt tokens':>14} "
+              f"{'stable prefix':>14} {'peak memory (KB)':>17}")
+        for node, stats in result["nodes"].items():
+            print(f"{node:>24} {stats['runs']:>6} {stats['wall_time']:>14.3f} {stats['llm_calls']:>10} "
+                  f"{stats['prompt_tokens']:>14} {stats['stable_prefix_tokens']:>14} {stats['peak_memory_kb']:>17}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark of the Agile Crew graph")
+    parser.add_argument("--stories", type=int, nargs="+", default=[1, 5, 10, 25, 50],
+                        help="Number of user stories the scripted model creates, one benchmark per value")
+    parser.add_argument("--latency", type=float, default=0.0, help="Simulated latency of every LLM call in seconds")
+    parser.add_argument("--parallel", action="store_true", help="Process the user stories in parallel")
+    parser.add_argument("--json", help="Also write the results to this file")
+    parser.add_argument("--verbose", action="store_true", help="Keep the graph logs output")
+    args = parser.parse_args()
+
+    if not args.verbose:
+        logger.remove()
+    # Read when the workflow is built, so it is set for the whole process
+    config.set_startup_values({ConfigMapping.PARALLEL_USER_STORIES: args.parallel})
+    results = [run_benchmark(user_stories, args.latency) for user_stories in args.stories]
+    print_results(results)
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
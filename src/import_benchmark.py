@@ -0,0 +1,90 @@
+""" Import time benchmark of the entry point modules.
+
+Every module is imported in a fresh interpreter with `-X importtime`, the median of the runs is reported along with
+the slowest modules it pulled in and the heavy packages that were imported eagerly. With --max-ms the exit code is 1
+when a module takes longer, e.g.:
+
+    python src/import_benchmark.py AgileGraph batch --repeat 5 --max-ms 300
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+# Packages that should only be imported when a workflow is built or a request is sent
+HEAVY_PACKAGES = ["langchain", "langchain_core", "langchain_openai", "langgraph", "openai", "opentelemetry.sdk",
+                  "pydantic", "yaml"]
+IMPORT_SCRIPT = "import json, sys; import {module}; " \
+                "print(json.dumps([package for package in {heavy!r} if package in sys.modules]))"
+
+
+def parse_import_times(stderr: str) -> dict:
+    """ Cumulative import time in microseconds of every module, from the -X importtime output """
+    times = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        times[name.strip()] = int(cumulative)
+    return times
+
+
+def measure_import(module: str) -> tuple:
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c",
+                             IMPORT_SCRIPT.format(module=module, heavy=HEAVY_PACKAGES)],
+                            cwd=SRC_DIR, capture_output=True, text=True, check=True)
+    return parse_import_times(result.stderr), json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def run_benchmark(module: str, repeat: int, top: int) -> dict:
+    runs = [measure_import(module) for _ in range(repeat)]
+    totals = [times[module] / 1000 for times, _ in runs]
+    # The slowest dependencies of the median run
+    times, heavy = sorted(runs, key=lambda run: run[0][module])[len(runs) // 2]
+    slowest = sorted(((name, cumulative) for name, cumulative in times.items() if name != module),
+                     key=lambda item: -item[1])[:top]
+    return {"module": module,
+            "median_ms": round(statistics.median(totals), 1),
+            "min_ms": round(min(totals), 1),
+            "heavy_packages": heavy,
+            "slowest": {name: round(cumulative / 1000, 1) for name, cumulative in slowest}}
+
+
+def print_results(results: list):
+    print(f"{'module':>20} {'median (ms)':>12} {'min (ms)':>9}  heavy packages imported")
+    for result in results:
+        print(f"{result['module']:>20} {result['median_ms']:>12} {result['min_ms']:>9}  "
+              f"{', '.join(result['heavy_packages']) or '-'}")
+    for result in results:
+        print(f"\nSlowest imports of {result['module']}")
+        for name, milliseconds in result["slowest"].items():
+            print(f"{name:>40} {milliseconds:>9} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Import time benchmark of the Agile Crew entry points")
+    parser.add_argument("modules", nargs="*", default=["AgileGraph", "batch", "AdoExport"],
+                        help="Modules to import, one benchmark per module")
+    parser.add_argument("--repeat", type=int, default=5, help="Fresh interpreters per module")
+    parser.add_argument("--top", type=int, default=10, help="Number of slowest imports listed per module")
+    parser.add_argument("--max-ms", type=float, help="Fail when the median import time of a module is higher")
+    parser.add_argument("--json", help="Also write the results to this file")
+    args = parser.parse_args()
+
+    results = [run_benchmark(module, args.repeat, args.top) for module in args.modules]
+    print_results(results)
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(results, file, indent=2)
+    if args.max_ms is not None:
+        slow = [result["module"] for result in results if result["median_ms"] > args.max_ms]
+        if slow:
+            print(f"\nImport time above {args.max_ms} ms: {', '.join(slow)}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
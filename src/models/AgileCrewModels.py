@@ -1,3 +1,4 @@
+import uuid
 from typing import List
 
 from pydantic.v1 import BaseModel, Field
@@ -52,6 +53,15 @@ class BaseAcceptanceCriteriaWithReasoning(BaseModel):
         description="List of acceptance criteria for the user story"
     )
 
+class AcceptanceCriteriaAndTasks(BaseModel):
+    """Acceptance criteria and tasks of a user story, created together."""
+    acceptance_criteria: List[str] = Field(
+        description="List of acceptance criteria for the user story"
+    )
+    tasks: List[BaseTask] = Field(
+        description="List of tasks to be created to fulfill the acceptance criteria"
+    )
+
 class BaseUserStory(BaseModel):
     title: str = Field(
         description="Title of the user story, follow the format: As a <type of user>, I want <some goal> so that <some reason>."
@@ -118,6 +128,8 @@ class UserStory(BaseUserStory):
 
 
 class Feature(BaseFeature):
+    # Kept through edits and downloads, the Azure DevOps export is keyed on it
+    id: str = Field(default_factory=lambda: uuid.uuid4().hex, description="Stable id of the feature")
     type: str = "Feature"
     user_stories: list[UserStory] = Field(
         default=None, description="List of user stories that are part of the feature"
@@ -138,5 +150,18 @@ class FeedbackOutput(BaseModel):
         return f"Feedback: {self.feedback}"
 
 
+class UserStoryFeedback(BaseModel):
+    """Feedback provided on the work done for one user story."""
+    user_story_index: int = Field(description="Index of the user story the feedback is about, as given in the input.")
+    feedback: str = Field(description="Feedback provided on the work done for this user story.")
+    needs_review: bool = Field(description="Flag to indicate if the work of this user story needs to be reviewed with "
+                                           "the feedback provided. Set to True if review is needed.", default=False)
+
+
+class ListOfUserStoryFeedback(BaseModel):
+    """Feedback provided on the work done for every user story reviewed."""
+    feedbacks: List[UserStoryFeedback] = Field(description="One feedback for every user story reviewed.")
+
+
 class AgileWorkItems(BaseModel):
     items: List[Feature] = Field(description="Feature work items to be created")
\ No newline at end of file
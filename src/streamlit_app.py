@@ -1,85 +1,173 @@
 import json
-import os
 import uuid
 
 import streamlit as st
 
 from AgileGraph import AgileCrewGraph
 from models.AgileCrewModels import AgileWorkItems
-from models.AgileCrewModels import Feature, Task
+from models.AgileCrewModels import Feature, Task, UserStory
+
+
+# One crew per API key entered, the least recently used ones and the ones of keys not used for a day are closed
+@st.cache_resource(max_entries=16, ttl="1d", on_release=AgileCrewGraph.close)
+def get_agile_crew(api_key: str) -> AgileCrewGraph:
+    """ Crew of an API key, shared by every session and rerun using it, AgileCrewGraph is safe to use concurrently """
+    return AgileCrewGraph(api_key)
+
 
-agile_crew = AgileCrewGraph()
 st.set_page_config(page_title="AgileCrew")
 st.title('AgileCrew')
 
 
 @st.dialog("Feature", width="large")
-def create_feature(feature: Feature, popup: bool = False):
-    feature_ui(feature, popup=popup)
+def create_feature(feature: Feature, feature_key: str, popup: bool = False):
+    feature_ui(feature, popup=popup, feature_key=feature_key)
+
+
+def widget_key(feature_key: str, *parts) -> str:
+    """ Stable key of a widget of the feature. The revision of the feature changes when its user stories are deleted
+    or regenerated, so their widgets are created again with the new content. """
+    return "/".join(map(str, (feature_key, st.session_state.revisions.get(feature_key, 0), *parts)))
+
+
+def new_revision(feature_key: str):
+    st.session_state.revisions[feature_key] = st.session_state.revisions.get(feature_key, 0) + 1
+
+
+@st.fragment
+def user_story_ui(user_story: UserStory, idx: int, feature_key: str, editing_disabled: bool):
+    """ Editing a user story only reruns its own fragment, not the whole feature """
+    with st.expander(f"{user_story.title}"):
+        user_story.title = st.text_input("Title", value=user_story.title, disabled=editing_disabled,
+                                         key=widget_key(feature_key, idx, "title"))
+        user_story.description = st.text_area("Description", value=user_story.description,
+                                              disabled=editing_disabled, key=widget_key(feature_key, idx, "description"))
+        st.write("Acceptance Criteria")
+        st.divider()
+        new_criteria = []
+        for ac_idx, acceptance_criteria in enumerate(user_story.acceptance_criteria):
+            new_criteria.append(st.text_area(f"#{ac_idx}", value=acceptance_criteria, disabled=editing_disabled,
+                                             key=widget_key(feature_key, idx, "ac", ac_idx)))
+            # Insert divider except for the last acceptance criteria
+            if ac_idx < len(user_story.acceptance_criteria) - 1:
+                st.divider()
+        user_story.acceptance_criteria = new_criteria
+        st.write("Tasks")
+        st.divider()
+        new_tasks = []
+        for task_idx, task in enumerate(user_story.tasks):
+            new_tasks.append(Task(
+                title=st.text_input("Title", value=task.title, disabled=editing_disabled,
+                                    key=widget_key(feature_key, idx, "task", task_idx, "title")),
+                description=st.text_area("Description", value=task.description, disabled=editing_disabled,
+                                         key=widget_key(feature_key, idx, "task", task_idx, "description"))
+            ))
+            # Insert divider except for the last task
+            if task_idx < len(user_story.tasks) - 1:
+                st.divider()
+        user_story.tasks = new_tasks
 
 
 # Define the UI for the feature model
-def feature_ui(feature: Feature, popup: bool = False):
+def feature_ui(feature: Feature, popup: bool = False, feature_key: str = "feature"):
     with st.container(border=True):
         editing_disabled = not popup
-        feature.title = st.text_input("Title", feature.title, disabled=editing_disabled, key=uuid.uuid4())
+        feature.title = st.text_input("Title", feature.title, disabled=editing_disabled,
+                                      key=widget_key(feature_key, "title"))
         feature.description = st.text_area("Description", value=feature.description, disabled=editing_disabled,
-                                           key=uuid.uuid4())
+                                           key=widget_key(feature_key, "description"))
         st.write("User Stories")
 
         def delete_user_story(user_story):
             feature.user_stories.remove(user_story)
-            st.rerun()
-
-        for user_story in feature.user_stories:
-            with st.expander(f"{user_story.title}"):
-                user_story.title = st.text_input("Title", value=user_story.title, disabled=editing_disabled,
-                                                 key=uuid.uuid4())
-                user_story.description = st.text_area("Description", value=user_story.description,
-                                                      disabled=editing_disabled, key=uuid.uuid4())
-                st.write("Acceptance Criteria")
-                st.divider()
-                new_criteria = []
-                for idx, acceptance_criteria in enumerate(user_story.acceptance_criteria):
-                    new_criteria.append(st.text_area(f"#{idx}", value=acceptance_criteria, disabled=editing_disabled,
-                                                     key=uuid.uuid4()))
-                    # Insert divider except for the last acceptance criteria
-                    if idx < len(user_story.acceptance_criteria) - 1:
-                        st.divider()
-                user_story.acceptance_criteria = new_criteria
-                st.write("Tasks")
-                st.divider()
-                new_tasks = []
-                for idx, task in enumerate(user_story.tasks):
-                    new_tasks.append(Task(
-                        title=st.text_input("Title", value=task.title, disabled=editing_disabled,
-                                            key=uuid.uuid4()),
-                        description=st.text_area("Description", value=task.description,
-                                                 disabled=editing_disabled, key=uuid.uuid4())
-                    ))
-                    # Insert divider except for the last task
-                    if idx < len(user_story.tasks) - 1:
-                        st.divider()
-                user_story.tasks = new_tasks
-            st.button("Delete User Story", key=uuid.uuid4(), on_click=delete_user_story, args=(user_story,),
-                      disabled=editing_disabled)
+            new_revision(feature_key)
+
+        def regenerate_user_story(user_story, verify_key: str):
+            """ New AC and tasks for the edited user story, the rest of the feature is kept """
+            idx = feature.user_stories.index(user_story)
+            if not st.session_state.get("openai_api_key"):
+                st.error('Please enter your OpenAI API key!')
+                return
+            try:
+                regenerated = get_agile_crew(st.session_state.openai_api_key).regenerate_user_stories(
+                    feature, [idx], st.session_state.get("project_context", ""),
+                    verify=st.session_state.get(verify_key, True))
+                feature.user_stories[idx] = regenerated.user_stories[idx]
+                new_revision(feature_key)
+            except Exception as e:
+                st.error(f'Error regenerating the user story: {e}')
+
+        for idx, user_story in enumerate(feature.user_stories):
+            user_story_ui(user_story, idx, feature_key, editing_disabled)
+            # The buttons change the list of user stories, they rerun the whole feature instead of the fragment
+            st.button("Delete User Story", key=widget_key(feature_key, idx, "delete"), on_click=delete_user_story,
+                      args=(user_story,), disabled=editing_disabled)
+            verify_key = widget_key(feature_key, idx, "verify_regeneration")
+            st.checkbox("Verify the regenerated AC and tasks", value=True, key=verify_key, disabled=editing_disabled)
+            st.button("Regenerate AC and Tasks", key=widget_key(feature_key, idx, "regenerate"),
+                      on_click=regenerate_user_story, args=(user_story, verify_key), disabled=editing_disabled)
         if popup:
-            if st.button('Save Feature', use_container_width=True):
-                st.session_state.feature[str(uuid.uuid4())] = feature
+            if st.button('Save Feature', use_container_width=True, key=widget_key(feature_key, "save")):
+                st.session_state.feature[feature_key] = feature
                 st.toast('Feature saved successfully!')
                 st.rerun()
 
 
+def usage_ui(usage: dict):
+    total = usage["total"]
+    with st.expander(f"Token usage: {total['total_tokens']} tokens in {total['llm_calls']} LLM calls"):
+        for title, key, label in (("Per node", "nodes", "node"), ("Per user story", "user_stories", "user story"),
+                                  ("Per model deployment", "deployments", "deployment")):
+            if usage[key]:
+                st.write(title)
+                st.table([{label: name, **figures} for name, figures in usage[key].items()])
+
+
+def apply_feature_event(feature: Feature, event: dict):
+    """ Fill the feature being created with the work accepted so far """
+    if event["type"] == "user_stories":
+        feature.user_stories = [UserStory(title=us.title, description=us.description, acceptance_criteria=[],
+                                          tasks=[]) for us in event["user_stories"]]
+    elif event["type"] == "acceptance_criteria":
+        feature.user_stories[event["user_story_index"]].acceptance_criteria = event["acceptance_criteria"]
+    elif event["type"] == "tasks":
+        feature.user_stories[event["user_story_index"]].tasks = [Task(title=task.title, description=task.description)
+                                                                 for task in event["tasks"]]
+
+
+def stream_feature(agile_crew: AgileCrewGraph, feature_description: str, project_context: str):
+    """ Show the user stories as they are accepted, then open the finished feature """
+    progress = st.empty()
+    partial_feature = Feature(title="Creating the feature...", description=feature_description, user_stories=[])
+    usage_ledger = agile_crew.create_usage_ledger()
+    with st.spinner('Agile LLM is creating the feature...'):
+        for event in agile_crew.stream_graph(feature_description, project_context, usage_ledger=usage_ledger):
+            if event["type"] == "feature":
+                feature = event["feature"]
+                continue
+            apply_feature_event(partial_feature, event)
+            # Every update is drawn with new widgets, the same keys cannot be used twice in a run
+            new_revision("partial_feature")
+            with progress.container():
+                feature_ui(partial_feature, feature_key="partial_feature")
+    progress.empty()
+    st.session_state.usage = usage_ledger.summary()
+    create_feature(feature, str(uuid.uuid4()), popup=True)
+
+
 def get_feature_title(key: str):
     return st.session_state.feature[key].title
 
 # Initialize the feature dictionary in the session state
 if 'feature' not in st.session_state:
     st.session_state.feature = {}
+# Revision of the widgets of every feature, see widget_key
+if 'revisions' not in st.session_state:
+    st.session_state.revisions = {}
 
 # Sidebar components
 with st.sidebar:
-    openai_api_key = st.text_input('OpenAI API Key')
+    openai_api_key = st.text_input('OpenAI API Key', key="openai_api_key")
     with st.form("my-form", clear_on_submit=True):
         file = st.file_uploader("Feature uploader", type=['json'])
         submitted = st.form_submit_button("Upload!")
@@ -88,7 +176,7 @@ with st.sidebar:
         st.toast("Uploaded succesfully!")
         try:
             feature = Feature(**json.loads(file.getvalue().decode("utf-8")))
-            create_feature(feature, popup=True)
+            create_feature(feature, str(uuid.uuid4()), popup=True)
         except Exception as e:
             st.error(f'Error creating feature: {e}')
     feature_selected = st.selectbox('Features created', [key for key in st.session_state.feature.keys()],
@@ -101,17 +189,20 @@ with st.form('my_form'):
 
     if not openai_api_key:
         st.warning('Please enter your OpenAI API key!', icon='⚠')
-    if submitted and openai_api_key:
-        os.environ['AZURE_OPENAI_API_KEY'] = openai_api_key
-        with st.spinner('Agile LLM is creating the feature...'):
-            try:
-                feature = agile_crew.invoke_graph(feature_description, project_context)
-                create_feature(feature, popup=True)
-            except Exception as e:
-                st.error(f'Error creating feature: {e}')
+# The feature is rendered outside the form, buttons are not allowed inside one
+if submitted and openai_api_key:
+    # Kept for the user stories regenerated later on
+    st.session_state.project_context = project_context
+    try:
+        stream_feature(get_agile_crew(openai_api_key), feature_description, project_context)
+    except Exception as e:
+        st.error(f'Error creating feature: {e}')
+
+if st.session_state.get("usage"):
+    usage_ui(st.session_state.usage)
 
 # Display the selected feature from the selectbox in the sidebar
 if feature_selected:
-    feature_ui(st.session_state.feature[feature_selected])
+    feature_ui(st.session_state.feature[feature_selected], feature_key=f"saved/{feature_selected}")
     st.sidebar.download_button('Download Feature', st.session_state.feature[feature_selected].json(),
                                f'feature-{feature_selected}.json')
@@ -1,77 +1,101 @@
 import json
-import os
 import uuid
 
 import streamlit as st
-from bluesheperd.core.project import AzureProject
 
+from AdoExport import AdoProject
 from AgileGraph import AgileCrewGraph
 from Utils import save_to_ado
 from models.AgileCrewModels import AgileWorkItems
 from models.AgileCrewModels import Feature, Task
 
-agile_crew = AgileCrewGraph()
+
+# One crew per API key entered, the least recently used ones and the ones of keys not used for a day are closed
+@st.cache_resource(max_entries=16, ttl="1d", on_release=AgileCrewGraph.close)
+def get_agile_crew(api_key: str) -> AgileCrewGraph:
+    """ Crew of an API key, shared by every session and rerun using it, AgileCrewGraph is safe to use concurrently """
+    return AgileCrewGraph(api_key)
+
+
 st.set_page_config(page_title="AgileCrew")
 st.title('AgileCrew')
 
 
 @st.dialog("Feature", width="large")
-def create_feature(feature: Feature, popup: bool = False):
-    feature_ui(feature, popup=popup)
+def create_feature(feature: Feature, feature_key: str, popup: bool = False):
+    feature_ui(feature, popup=popup, feature_key=feature_key)
+
+
+def widget_key(feature_key: str, *parts) -> str:
+    """ Stable key of a widget of the feature. The revision of the feature changes when its user stories are
+    deleted, so their widgets are created again with the new content. """
+    return "/".join(map(str, (feature_key, st.session_state.revisions.get(feature_key, 0), *parts)))
+
+
+def new_revision(feature_key: str):
+    st.session_state.revisions[feature_key] = st.session_state.revisions.get(feature_key, 0) + 1
+
+
+@st.fragment
+def user_story_ui(user_story, idx: int, feature_key: str, editing_disabled: bool):
+    """ Editing a user story only reruns its own fragment, not the whole feature """
+    with st.expander(f"{user_story.title}"):
+        user_story.title = st.text_input("Title", value=user_story.title, disabled=editing_disabled,
+                                         key=widget_key(feature_key, idx, "title"))
+        user_story.description = st.text_area("Description", value=user_story.description,
+                                              disabled=editing_disabled, key=widget_key(feature_key, idx, "description"))
+        st.write("Acceptance Criteria")
+        st.divider()
+        new_criteria = []
+        for ac_idx, acceptance_criteria in enumerate(user_story.acceptance_criteria):
+            new_criteria.append(st.text_area(f"#{ac_idx}", value=acceptance_criteria, disabled=editing_disabled,
+                                             key=widget_key(feature_key, idx, "ac", ac_idx)))
+            # Insert divider except for the last acceptance criteria
+            if ac_idx < len(user_story.acceptance_criteria) - 1:
+                st.divider()
+        user_story.acceptance_criteria = new_criteria
+        st.write("Tasks")
+        st.divider()
+        new_tasks = []
+        for task_idx, task in enumerate(user_story.tasks):
+            new_tasks.append(Task(
+                title=st.text_input("Title", value=task.title, disabled=editing_disabled,
+                                    key=widget_key(feature_key, idx, "task", task_idx, "title")),
+                description=st.text_area("Description", value=task.description, disabled=editing_disabled,
+                                         key=widget_key(feature_key, idx, "task", task_idx, "description"))
+            ))
+            # Insert divider except for the last task
+            if task_idx < len(user_story.tasks) - 1:
+                st.divider()
+        user_story.tasks = new_tasks
 
 
 # Define the UI for the feature model
-def feature_ui(feature: Feature, popup: bool = False):
+def feature_ui(feature: Feature, popup: bool = False, feature_key: str = "feature"):
     with st.container(border=True):
         editing_disabled = not popup
-        feature.title = st.text_input("Title", feature.title, disabled=editing_disabled, key=uuid.uuid4())
+        feature.title = st.text_input("Title", feature.title, disabled=editing_disabled,
+                                      key=widget_key(feature_key, "title"))
         feature.description = st.text_area("Description", value=feature.description, disabled=editing_disabled,
-                                           key=uuid.uuid4())
+                                           key=widget_key(feature_key, "description"))
         st.write("User Stories")
 
         def delete_user_story(user_story):
             feature.user_stories.remove(user_story)
-            st.rerun()
-
-        for user_story in feature.user_stories:
-            with st.expander(f"{user_story.title}"):
-                user_story.title = st.text_input("Title", value=user_story.title, disabled=editing_disabled,
-                                                 key=uuid.uuid4())
-                user_story.description = st.text_area("Description", value=user_story.description,
-                                                      disabled=editing_disabled, key=uuid.uuid4())
-                st.write("Acceptance Criteria")
-                st.divider()
-                new_criteria = []
-                for idx, acceptance_criteria in enumerate(user_story.acceptance_criteria):
-                    new_criteria.append(st.text_area(f"#{idx}", value=acceptance_criteria, disabled=editing_disabled,
-                                                     key=uuid.uuid4()))
-                    # Insert divider except for the last acceptance criteria
-                    if idx < len(user_story.acceptance_criteria) - 1:
-                        st.divider()
-                user_story.acceptance_criteria = new_criteria
-                st.write("Tasks")
-                st.divider()
-                new_tasks = []
-                for idx, task in enumerate(user_story.tasks):
-                    new_tasks.append(Task(
-                        title=st.text_input("Title", value=task.title, disabled=editing_disabled,
-                                            key=uuid.uuid4()),
-                        description=st.text_area("Description", value=task.description,
-                                                 disabled=editing_disabled, key=uuid.uuid4())
-                    ))
-                    # Insert divider except for the last task
-                    if idx < len(user_story.tasks) - 1:
-                        st.divider()
-                user_story.tasks = new_tasks
-            st.button("Delete User Story", key=uuid.uuid4(), on_click=delete_user_story, args=(user_story,),
-                      disabled=editing_disabled)
+            new_revision(feature_key)
+
+        for idx, user_story in enumerate(feature.user_stories):
+            user_story_ui(user_story, idx, feature_key, editing_disabled)
+            # The button changes the list of user stories, it reruns the whole feature instead of the fragment
+            st.button("Delete User Story", key=widget_key(feature_key, idx, "delete"), on_click=delete_user_story,
+                      args=(user_story,), disabled=editing_disabled)
         if not ado_pat or not target_org_url or not project_name:
             st.warning('Please enter your Azure DevOps PAT, Org URL, and Project Name!', icon='⚠')
         if popup:
             col1, col2 = st.columns([1, 1])
             with col1:
                 if st.button('Submit Feature to Azure DevOps',
-                             use_container_width=True) \
+                             use_container_width=True, key=widget_key(feature_key, "submit")) \
                         and ado_pat and target_org_url and project_name:
                     with st.spinner('Creating feature in Azure Dev Ops...'):
                         try:
@@ -79,42 +103,46 @@ def feature_ui(feature: Feature, popup: bool = False):
                             ado_project = create_ado_project(target_org_url, ado_pat, project_name)
                             work_item = AgileWorkItems(items=[feature])
                             print(work_item.json())
-                            save_to_ado(work_item.json(), ado_project)
+                            progress = st.progress(0.0, text="Creating work items...")
+                            save_to_ado(work_item.json(), ado_project,
+                                        on_progress=lambda done, total: progress.progress(
+                                            done / total, text=f"{done} of {total} work items created"))
                         except Exception as e:
                             st.error(f'Error creating feature: {e}')
                             st.rerun()
-                    st.session_state.feature[str(uuid.uuid4())] = feature
+                    st.session_state.feature[feature_key] = feature
                     st.toast('Feature created successfully!')
                     st.rerun()
             with col2:
-                if st.button('Save Feature', use_container_width=True):
-                    st.session_state.feature[str(uuid.uuid4())] = feature
+                if st.button('Save Feature', use_container_width=True, key=widget_key(feature_key, "save")):
+                    st.session_state.feature[feature_key] = feature
                     st.toast('Feature saved successfully!')
                     st.rerun()
 
         else:
-            edit = st.button("Edit and Submit to Azure DevOps")
+            edit = st.button("Edit and Submit to Azure DevOps", key=widget_key(feature_key, "edit"))
             if edit:
-                create_feature(feature, popup=True)
+                create_feature(feature, str(uuid.uuid4()), popup=True)
 
 
 def get_feature_title(key: str):
     return st.session_state.feature[key].title
 
 
-def create_ado_project(target_organization_url: str, personal_access_token: str, project_name: str) -> AzureProject:
-    project = AzureProject(
+def create_ado_project(target_organization_url: str, personal_access_token: str, project_name: str) -> AdoProject:
+    return AdoProject(
         organization_url=target_organization_url,
         project_name=project_name,
         pat=personal_access_token,
     )
-    ado_project = project.connect()
-    return ado_project
 
 
 # Initialize the feature dictionary in the session state
 if 'feature' not in st.session_state:
     st.session_state.feature = {}
+# Revision of the widgets of every feature, see widget_key
+if 'revisions' not in st.session_state:
+    st.session_state.revisions = {}
 
 # Sidebar components
 with st.sidebar:
@@ -130,7 +158,7 @@ with st.sidebar:
         st.toast("Uploaded succesfully!")
         try:
             feature = Feature(**json.loads(file.getvalue().decode("utf-8")))
-            create_feature(feature, popup=True)
+            create_feature(feature, str(uuid.uuid4()), popup=True)
         except Exception as e:
             st.error(f'Error creating feature: {e}')
     feature_selected = st.selectbox('Features created', [key for key in st.session_state.feature.keys()],
@@ -144,16 +172,15 @@ with st.form('my_form'):
     if not openai_api_key:
         st.warning('Please enter your OpenAI API key!', icon='⚠')
     if submitted and openai_api_key:
-        os.environ['AZURE_OPENAI_API_KEY'] = openai_api_key
         with st.spinner('Agile LLM is creating the feature...'):
             try:
-                feature = agile_crew.invoke_graph(feature_description, project_context)
-                create_feature(feature, popup=True)
+                feature = get_agile_crew(openai_api_key).invoke_graph(feature_description, project_context)
+                create_feature(feature, str(uuid.uuid4()), popup=True)
             except Exception as e:
                 st.error(f'Error creating feature: {e}')
 
 # Display the selected feature from the selectbox in the sidebar
 if feature_selected:
-    feature_ui(st.session_state.feature[feature_selected])
+    feature_ui(st.session_state.feature[feature_selected], feature_key=f"saved/{feature_selected}")
     st.sidebar.download_button('Download Feature', st.session_state.feature[feature_selected].json(),
                                f'feature-{feature_selected}.json')
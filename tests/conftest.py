@@ -0,0 +1,21 @@
+import os
+import sys
+
+import pytest
+
+# The modules of the app are imported from src, as the entry points do
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+
+
+@pytest.fixture
+def chat_models():
+    """ Build the chat models of the agents with FakeChatModel, the test adds its keyword arguments to the yielded
+    dict before creating the agents """
+    import LLMClients
+    from FakeChatModel import FakeChatModel
+
+    kwargs = {}
+    LLMClients.set_chat_model_factory(
+        lambda model, temperature: FakeChatModel(model=model, temperature=temperature, **kwargs))
+    yield kwargs
+    LLMClients.set_chat_model_factory(None)
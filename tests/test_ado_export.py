@@ -0,0 +1,101 @@
+import pytest
+
+from AdoExport import AdoClient, AdoExportError, AdoProject, export_feature, export_key
+from Config import ConfigMapping, config
+from MockAdoServer import MockAdoServer
+from Utils import save_to_ado
+
+
+class FlakyAdoServer(MockAdoServer):
+    """ Mock server rejecting the creation of every work item of `failing_type` """
+    failing_type = None
+
+    def handle(self, path: str, body, headers) -> tuple:
+        if self.failing_type is not None and path.endswith(f"/workitems/${self.failing_type}"):
+            return 503, {"message": "Service unavailable"}
+        return super().handle(path, body, headers)
+
+
+def feature(**values) -> dict:
+    return {"id": "feature-1", "title": "Monthly report", "description": "Export the <b>monthly</b> report",
+            "user_stories": [{"title": f"As a manager, I want report {i} so that I can plan.",
+                              "description": f"Report {i}", "acceptance_criteria": [f"Criterion {i}"],
+                              "tasks": [{"title": f"Task {i}.{j}", "description": f"Task {j}"} for j in range(2)]}
+                             for i in range(2)], **values}
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr("AdoExport.time.sleep", lambda seconds: None)
+
+
+@pytest.fixture
+def server():
+    with FlakyAdoServer() as server:
+        yield server
+
+
+def client(server: MockAdoServer) -> AdoClient:
+    return AdoClient(AdoProject(server.url, "project", "pat"))
+
+
+def test_the_export_creates_every_work_item_under_its_parent(server):
+    with client(server) as ado:
+        urls = export_feature(ado, feature())
+    assert len(urls) == len(server.work_items) == 7
+    feature_item = next(item for item in server.work_items.values() if item["url"] == urls["feature"])
+    assert feature_item["fields"]["System.Description"] == "Export the &lt;b&gt;monthly&lt;/b&gt; report"
+    task = next(item for item in server.work_items.values() if item["url"] == urls["us-1/task-0"])
+    assert task["relations"][0]["url"] == urls["us-1"]
+
+
+def test_a_lost_response_is_found_instead_of_created_again(server):
+    server.lost_response_rate = 1.0
+    with client(server) as ado:
+        urls = export_feature(ado, feature())
+    assert len(urls) == len(server.work_items) == 7
+
+
+def test_exporting_again_after_a_partial_failure_creates_only_the_missing_items(server):
+    server.failing_type = "Task"
+    with config.override({ConfigMapping.ADO_MAX_RETRIES: 1}), client(server) as ado:
+        with pytest.raises(AdoExportError) as error:
+            export_feature(ado, feature())
+    assert sorted(error.value.failed) == ["us-0/task-0", "us-0/task-1", "us-1/task-0", "us-1/task-1"]
+    assert len(server.work_items) == 3
+
+    server.failing_type = None
+    with client(server) as ado:
+        urls = export_feature(ado, feature())
+    assert len(urls) == len(server.work_items) == 7
+
+
+def test_an_edited_feature_keeps_its_work_items(server):
+    with client(server) as ado:
+        urls = export_feature(ado, feature())
+        edited = feature(title="Monthly reports")
+        assert export_feature(ado, edited) == urls
+        # Another key is another export
+        assert export_feature(ado, edited, key="copy") != urls
+    assert len(server.work_items) == 14
+
+
+def test_the_export_key_is_the_feature_id():
+    assert export_key(feature()) == "feature-1"
+    with pytest.raises(ValueError):
+        export_key(feature(id=None))
+
+
+def test_save_to_ado_exports_to_the_project_of_the_environment(server, monkeypatch):
+    from models.AgileCrewModels import AgileWorkItems, Feature
+
+    monkeypatch.setenv("AZURE_DEVOPS_ORGANIZATION_URL", server.url)
+    monkeypatch.setenv("AZURE_DEVOPS_PROJECT", "project")
+    monkeypatch.setenv("AZURE_DEVOPS_PAT", "pat")
+    # A feature gets its id when it is created
+    values = feature()
+    del values["id"]
+    work_items = AgileWorkItems(items=[Feature(**values)])
+    assert len(save_to_ado(work_items.json())) == 7
+    assert len(save_to_ado(work_items.json())) == 7
+    assert len(server.work_items) == 7
@@ -0,0 +1,94 @@
+import pytest
+
+from AgentCreator import AgentCreator
+from Config import ConfigMapping, config
+from FakeChatModel import scripted_arguments
+from LLMCache import InMemoryLRUCache
+from Utils import RetryBudgetExhausted, register_node_result, retry_delay
+from models.AgileCrewModels import BaseUserStory
+
+
+def acceptance_criteria_state(**values) -> dict:
+    """ Graph state reaching the acceptance criteria creator for the first user story """
+    return {"messages": [], "feature_description": "Export the monthly report", "project_context": "Reporting app",
+            "user_story_to_process": BaseUserStory(title="As a manager, I want a report so that I can plan.",
+                                                   description="Monthly report of the team."),
+            "user_story_index": 0, "feedback": "", "acceptance_criteria_us": None, "tasks": None,
+            "retry_attempts": {}, **values}
+
+
+def test_a_rejected_response_is_not_served_to_the_retry(chat_models, monkeypatch):
+    cache = InMemoryLRUCache(max_entries=10, ttl_seconds=0)
+    calls = []
+
+    def acceptance_criteria(messages):
+        calls.append(messages)
+        return {"wrong": 1} if len(calls) == 1 else scripted_arguments("ListOfAcceptanceCriteria", 1)
+
+    chat_models.update(cache=cache, responses={"ListOfAcceptanceCriteria": acceptance_criteria})
+    monkeypatch.setattr("AgentCreator.time.sleep", lambda seconds: None)
+    node = AgentCreator("acceptance_criteria").create_agent_node()
+
+    update = node.invoke(acceptance_criteria_state())
+    assert update["next"] == "ERROR"
+    update = node.invoke(acceptance_criteria_state(retry_attempts=update["retry_attempts"]))
+    assert update["next"] == "CONTINUE"
+    assert len(calls) == 2
+
+    # The accepted response is cached, with the project context call before it
+    hits = cache.hits
+    assert node.invoke(acceptance_criteria_state())["next"] == "CONTINUE"
+    assert len(calls) == 2
+    assert cache.hits == hits + 2
+
+
+def test_a_retry_asks_the_model_instead_of_the_cache(chat_models):
+    cache = InMemoryLRUCache(max_entries=10, ttl_seconds=0)
+    calls = []
+
+    def acceptance_criteria(messages):
+        calls.append(messages)
+        return scripted_arguments("ListOfAcceptanceCriteria", 1)
+
+    chat_models.update(cache=cache, responses={"ListOfAcceptanceCriteria": acceptance_criteria})
+    node = AgentCreator("acceptance_criteria").create_agent_node()
+    node.invoke(acceptance_criteria_state())
+    node.invoke(acceptance_criteria_state(retry_attempts={"acceptance_criteria_creation": 1}))
+    assert len(calls) == 2
+    node.invoke(acceptance_criteria_state())
+    assert len(calls) == 2
+
+
+def test_the_retry_counter_of_a_node_resets_after_a_success():
+    state = {"retry_attempts": {}}
+    with config.override({ConfigMapping.RETRY_MAX_ATTEMPTS: 3}):
+        for _ in range(2):
+            state["retry_attempts"] = register_node_result(state, {"next": "ERROR"}, "tasks_creation")["retry_attempts"]
+        state["retry_attempts"]["user_story_creation"] = 1
+        assert state["retry_attempts"] == {"tasks_creation": 2, "user_story_creation": 1}
+        update = register_node_result(state, {"next": "CONTINUE"}, "tasks_creation")
+        assert update["retry_attempts"] == {"user_story_creation": 1}
+        # Without a counter to reset the update is left as it is
+        assert register_node_result({"retry_attempts": {}}, {"next": "CONTINUE"}, "tasks_creation") == \
+            {"next": "CONTINUE"}
+
+
+def test_the_exhausted_budget_names_the_graph_node(chat_models, monkeypatch):
+    from AgileGraph import AgileCrewGraph
+
+    chat_models.update(responses={"ListOfAcceptanceCriteria": {"wrong": 1}})
+    monkeypatch.setattr("AgentCreator.time.sleep", lambda seconds: None)
+    graph = AgileCrewGraph()
+    with config.override({ConfigMapping.RETRY_MAX_ATTEMPTS: 2}), pytest.raises(RetryBudgetExhausted) as error:
+        graph.invoke_graph("Export the monthly report", "Reporting app")
+    assert error.value.node == "agent_ac"
+    assert error.value.attempts == 3
+
+
+def test_the_backoff_delay_doubles_up_to_the_maximum(monkeypatch):
+    with config.override({ConfigMapping.RETRY_BASE_DELAY_SECONDS: 1, ConfigMapping.RETRY_MAX_DELAY_SECONDS: 5}):
+        monkeypatch.setattr("Utils.random.uniform", lambda low, high: high)
+        assert [retry_delay(attempt) for attempt in range(1, 6)] == [1, 2, 4, 5, 5]
+        # Half of the delay is random
+        monkeypatch.setattr("Utils.random.uniform", lambda low, high: low)
+        assert [retry_delay(attempt) for attempt in range(1, 6)] == [0.5, 1, 2, 2.5, 2.5]
@@ -0,0 +1,64 @@
+from langchain_core.messages import get_buffer_string
+
+from AgileGraph import AgileCrewGraph
+from Config import ConfigMapping, config
+from FakeChatModel import scripted_arguments
+
+FEEDBACK = "Add a criterion for the empty report."
+
+
+def test_only_the_flagged_stories_are_generated_again(chat_models):
+    reviews, generations = [], []
+
+    def review(messages):
+        reviews.append(get_buffer_string(messages))
+        flagged = [{"user_story_index": 1, "feedback": FEEDBACK, "needs_review": True}] if len(reviews) == 1 else []
+        return {"feedbacks": flagged}
+
+    def acceptance_criteria(messages):
+        generations.append(get_buffer_string(messages))
+        criteria = scripted_arguments("ListOfAcceptanceCriteria", 3)["acceptance_criteria"]
+        return {"acceptance_criteria": criteria + (["Given no data, then the report is empty."]
+                                                   if FEEDBACK in generations[-1] else [])}
+
+    chat_models.update(responses={"ListOfUserStoryFeedback": review, "ListOfAcceptanceCriteria": acceptance_criteria})
+    crew = AgileCrewGraph()
+    graph = crew.create_batch_verification_workflow().compile()
+    with config.override({ConfigMapping.CHECK_AC_ENABLED: True, ConfigMapping.CHECK_TASKS_ENABLED: False,
+                          ConfigMapping.PRE_VERIFICATION_TRUST_PASSES: False}):
+        state = graph.invoke(crew.prepare_graph_input("Export the monthly report", "Reporting app"),
+                             config=crew.prepare_run_config("Reporting app", crew.create_run_report()))
+
+    # One review of the three stories, then one of the story sent back
+    assert len(reviews) == 2
+    assert all(f"User story #{idx}" in reviews[0] for idx in range(3))
+    assert "User story #1" in reviews[1] and "User story #0" not in reviews[1]
+    assert len(generations) == 4 and FEEDBACK in generations[3]
+    assert [len(us.acceptance_criteria) for us in state["final_output"].user_stories] == [2, 3, 2]
+
+
+def test_stories_failing_the_rules_are_sent_back_without_a_review(chat_models):
+    reviews, generations = [], []
+
+    def acceptance_criteria(messages):
+        generations.append(messages)
+        # The second generation, whichever story it is for, has no criteria
+        return {"acceptance_criteria": [] if len(generations) == 2 else ["Given a report, then it is exported."]}
+
+    chat_models.update(responses={"ListOfUserStoryFeedback": lambda messages: reviews.append(messages) or
+                                  {"feedbacks": []},
+                                  "ListOfAcceptanceCriteria": acceptance_criteria})
+    crew = AgileCrewGraph()
+    graph = crew.create_batch_verification_workflow().compile()
+    run_report = crew.create_run_report()
+    with config.override({ConfigMapping.CHECK_AC_ENABLED: True, ConfigMapping.CHECK_TASKS_ENABLED: False,
+                          ConfigMapping.PRE_VERIFICATION_ENABLED: True,
+                          ConfigMapping.PRE_VERIFICATION_TRUST_PASSES: True}):
+        state = graph.invoke(crew.prepare_graph_input("Export the monthly report", "Reporting app"),
+                             config=crew.prepare_run_config("Reporting app", run_report))
+
+    assert reviews == []
+    assert len(generations) == 4
+    assert all(us.acceptance_criteria for us in state["final_output"].user_stories)
+    # Two stories pass on the first round and the one sent back on the second
+    assert run_report.pre_verification_report()["verifiers"]["acceptance_criteria"] == {"REVIEW": 1, "CONTINUE": 3}
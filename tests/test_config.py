@@ -0,0 +1,90 @@
+import os
+
+import pytest
+
+from Config import DEFAULT_CONFIG_PATH, Config, ConfigError, ConfigMapping
+
+CONFIG_DIR = os.path.dirname(DEFAULT_CONFIG_PATH)
+
+
+def write_overlay(tmp_path, content: str) -> str:
+    """ Config file extending the base one of the repository """
+    base = os.path.join(CONFIG_DIR, "config.base.yml")
+    path = tmp_path / "config.test.yml"
+    path.write_text(f"extends: {os.path.relpath(base, tmp_path)}\n{content}")
+    return str(path)
+
+
+@pytest.mark.parametrize("name", ["config.GPT4.QA_DISABLED.yml", "config.GPT4.QA_ENABLED.yml",
+                                  "config.GPT3.5.QA_DISABLED.yml", "config.GPT3.5.QA_ENABLED.yml"])
+def test_shipped_config_files_are_valid(name):
+    assert Config(os.path.join(CONFIG_DIR, name)).load()
+
+
+def test_overlays_replace_only_the_values_they_set():
+    base = Config(os.path.join(CONFIG_DIR, "config.base.yml"))
+    config = Config(os.path.join(CONFIG_DIR, "config.GPT3.5.QA_ENABLED.yml"))
+    # Set by the overlay it extends, and by its own file
+    assert config.get_value_by_mapping(ConfigMapping.AGENT_MODEL_DEPLOYED_TASKS) == "blueyellowai-gpt35-latest"
+    assert config.get_value_by_mapping(ConfigMapping.CHECK_TASKS_ENABLED) is True
+    # Siblings of the overridden keys come from the base file
+    assert config.get_value_by_mapping(ConfigMapping.AGENT_MODEL_TEMPERATURE_TASKS) == \
+        base.get_value_by_mapping(ConfigMapping.AGENT_MODEL_TEMPERATURE_TASKS)
+    assert config.get_value_by_mapping(ConfigMapping.AGENT_PROMPT_TASKS) == \
+        base.get_value_by_mapping(ConfigMapping.AGENT_PROMPT_TASKS)
+
+
+def test_values_are_typed_and_read_only(tmp_path):
+    config = Config(write_overlay(tmp_path, "llm:\n  timeout: 60\n"))
+    assert config.get_value_by_mapping(ConfigMapping.LLM_TIMEOUT) == 60.0
+    assert isinstance(config.get_value_by_mapping(ConfigMapping.LLM_TIMEOUT), float)
+    with pytest.raises(TypeError):
+        config.get_config("graph")["parallel_user_stories"] = True
+
+
+@pytest.mark.parametrize("content, message", [
+    ("graph:\n  max_concurrency: four\n", "graph.max_concurrency must be of type int"),
+    ("graph:\n  max_concurrency: true\n", "graph.max_concurrency must be of type int"),
+    ("graph:\n  parallel_user_stories: 1\n", "graph.parallel_user_stories must be of type bool"),
+    ("llm:\n  provider: openai\n", "llm.provider must be one of azure, fake"),
+    ("ado: 5\n", "missing keys ado.api_version"),
+])
+def test_invalid_values_raise_config_error(tmp_path, content, message):
+    with pytest.raises(ConfigError, match=message):
+        Config(write_overlay(tmp_path, content)).load()
+
+
+def test_extends_loop_raises_config_error(tmp_path):
+    (tmp_path / "a.yml").write_text("extends: b.yml\n")
+    (tmp_path / "b.yml").write_text("extends: a.yml\n")
+    with pytest.raises(ConfigError, match="loop"):
+        Config(str(tmp_path / "a.yml")).load()
+
+
+def test_override_applies_to_the_block_only():
+    config = Config()
+    default = config.get_value_by_mapping(ConfigMapping.TOKEN_BUDGET)
+    with config.override({ConfigMapping.TOKEN_BUDGET: default + 100}):
+        assert config.get_value_by_mapping(ConfigMapping.TOKEN_BUDGET) == default + 100
+    assert config.get_value_by_mapping(ConfigMapping.TOKEN_BUDGET) == default
+
+
+def test_override_validates_the_values():
+    with pytest.raises(ConfigError, match="must be of type int"):
+        with Config().override({ConfigMapping.TOKEN_BUDGET: "many"}):
+            pass
+
+
+def test_override_of_a_key_read_when_the_workflow_is_built_raises_config_error():
+    with pytest.raises(ConfigError, match="graph.parallel_user_stories"):
+        with Config().override({ConfigMapping.PARALLEL_USER_STORIES: True}):
+            pass
+
+
+def test_startup_values_are_set_before_loading():
+    config = Config()
+    config.set_startup_values({ConfigMapping.PARALLEL_USER_STORIES: True})
+    assert config.get_value_by_mapping(ConfigMapping.PARALLEL_USER_STORIES) is True
+    assert config.get_config("graph")["parallel_user_stories"] is True
+    with pytest.raises(ConfigError):
+        config.set_startup_values({ConfigMapping.PARALLEL_USER_STORIES: False})
@@ -0,0 +1,73 @@
+import uuid
+
+from FeatureEvents import FeatureEventEmitter
+from models.AgileCrewModels import BaseTask, BaseUserStory, ListOfAcceptanceCriteria, ListOfTasks, ListOfUserStories
+
+
+def review_state() -> dict:
+    return {"user_stories": ListOfUserStories(user_stories=[
+                BaseUserStory(title=f"As a manager, I want report {i} so that I can plan.", description=f"Report {i}")
+                for i in range(2)]),
+            "user_story_index": 1,
+            "acceptance_criteria_us": [ListOfAcceptanceCriteria(acceptance_criteria=[f"Criterion {i}"])
+                                       for i in range(2)],
+            "tasks": [ListOfTasks(tasks=[BaseTask(title=f"Task {i}", description=f"Task {i}")]) for i in range(2)]}
+
+
+def run_node(emitter: FeatureEventEmitter, node: str, outputs: dict, name: str | None = None,
+             parent_run_id=None) -> uuid.UUID:
+    """ Report the start and the end of a graph node, as LangGraph does """
+    run_id = uuid.uuid4()
+    emitter.on_chain_start({}, review_state(), run_id=run_id, parent_run_id=parent_run_id,
+                           metadata={"langgraph_node": node}, name=name or node)
+    emitter.on_chain_end(outputs, run_id=run_id)
+    return run_id
+
+
+def test_an_accepted_review_emits_the_work_of_its_user_story():
+    events = []
+    emitter = FeatureEventEmitter(events.append)
+    run_node(emitter, "ac_tasks_review", {"next": "CONTINUE"})
+    assert events == [{"type": "acceptance_criteria", "user_story_index": 1, "acceptance_criteria": ["Criterion 1"]},
+                      {"type": "tasks", "user_story_index": 1,
+                       "tasks": [BaseTask(title="Task 1", description="Task 1")]}]
+
+
+def test_reviews_sending_the_work_back_and_other_nodes_emit_nothing():
+    events = []
+    emitter = FeatureEventEmitter(events.append)
+    run_node(emitter, "ac_review", {"next": "REVIEW"})
+    run_node(emitter, "agent_ac", {"next": "CONTINUE"})
+    # The runnable wrapped by the node reports under its own name
+    run_node(emitter, "ac_review", {"next": "CONTINUE"}, name="AgentExecutor")
+    assert events == []
+
+
+def test_the_runnable_of_a_node_reporting_under_the_node_name_is_not_counted_twice():
+    events = []
+    emitter = FeatureEventEmitter(events.append)
+    outer = uuid.uuid4()
+    emitter.on_chain_start({}, review_state(), run_id=outer, metadata={"langgraph_node": "user_stories_review"},
+                           name="user_stories_review")
+    run_node(emitter, "user_stories_review", {"next": "CONTINUE"}, parent_run_id=outer)
+    emitter.on_chain_end({"next": "CONTINUE"}, run_id=outer)
+    assert [event["type"] for event in events] == ["user_stories"]
+    assert len(events[0]["user_stories"]) == 2
+
+
+def test_a_batch_review_emits_every_user_story():
+    events = []
+    emitter = FeatureEventEmitter(events.append)
+    run_node(emitter, "batch_tasks_review", {"next": "CONTINUE"})
+    assert [(event["type"], event["user_story_index"]) for event in events] == [("tasks", 0), ("tasks", 1)]
+
+
+def test_a_failed_review_is_forgotten():
+    events = []
+    emitter = FeatureEventEmitter(events.append)
+    run_id = uuid.uuid4()
+    emitter.on_chain_start({}, review_state(), run_id=run_id, metadata={"langgraph_node": "tasks_review"},
+                           name="tasks_review")
+    emitter.on_chain_error(ValueError("Invalid output"), run_id=run_id)
+    emitter.on_chain_end({"next": "CONTINUE"}, run_id=run_id)
+    assert events == []
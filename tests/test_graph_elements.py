@@ -0,0 +1,62 @@
+import pytest
+from langchain_core.messages import AIMessage, HumanMessage
+
+from Config import ConfigMapping, config
+from GraphElements import add_messages_with_history_policy, process_user_story, progress_message, \
+    select_next_user_story_to_process
+from models.AgileCrewModels import BaseTask, BaseUserStory, ListOfAcceptanceCriteria, ListOfTasks, ListOfUserStories
+
+
+def processed_story_state() -> dict:
+    """ State reaching process_user_story for the first of two identical user stories """
+    story = {"title": "As a manager, I want a report so that I can plan.", "description": "Monthly report"}
+    return {"user_stories": ListOfUserStories(user_stories=[BaseUserStory(**story), BaseUserStory(**story)]),
+            "user_story_to_process": BaseUserStory(**story), "user_story_index": 0,
+            "acceptance_criteria_us": [ListOfAcceptanceCriteria(acceptance_criteria=["Given, when, then."])],
+            "tasks": [ListOfTasks(tasks=[BaseTask(title="Build it", description="Build the report"),
+                                         BaseTask(title="Test it", description="Test the report")])]}
+
+
+@pytest.fixture
+def history():
+    """ Messages of a run: its instructions, then progress messages and agent answers in turns """
+    return [HumanMessage(content="Create the feature")] + \
+        [message for i in range(4) for message in (progress_message(f"Step {i}"), AIMessage(content=f"Answer {i}"))]
+
+
+def test_the_full_history_keeps_every_message(history):
+    with config.override({ConfigMapping.HISTORY_POLICY: "full"}):
+        assert add_messages_with_history_policy(history[:5], history[5:]) == history
+
+
+def test_the_window_keeps_the_instructions_and_the_last_messages(history):
+    with config.override({ConfigMapping.HISTORY_POLICY: "window", ConfigMapping.HISTORY_WINDOW: 3}):
+        assert add_messages_with_history_policy(history[:5], history[5:]) == history[:1] + history[-3:]
+        assert add_messages_with_history_policy(history[:2], history[2:4]) == history[:4]
+
+
+def test_drop_progress_removes_the_progress_messages(history):
+    with config.override({ConfigMapping.HISTORY_POLICY: "drop_progress"}):
+        messages = add_messages_with_history_policy(history[:5], history[5:])
+    assert [message.content for message in messages] == ["Create the feature", "Answer 0", "Answer 1", "Answer 2",
+                                                         "Answer 3"]
+
+
+def test_the_summary_policy_reports_a_processed_story_in_one_line():
+    with config.override({ConfigMapping.HISTORY_POLICY: "summary"}):
+        summary = process_user_story(processed_story_state())["messages"][0]
+    with config.override({ConfigMapping.HISTORY_POLICY: "full"}):
+        full = process_user_story(processed_story_state())["messages"][0]
+    assert summary.content.endswith("It has 1 acceptance criteria and these tasks: Build it, Test it")
+    assert len(summary.content) < len(full.content)
+    assert "Build the report" in full.content and "Build the report" not in summary.content
+
+
+def test_stories_with_the_same_content_are_processed_at_their_own_index():
+    state = processed_story_state()
+    indices = []
+    while (update := select_next_user_story_to_process(state))["next"] == "CONTINUE":
+        state.update(update)
+        indices.append(state["user_story_index"])
+        process_user_story(state)
+    assert indices == [0, 1]
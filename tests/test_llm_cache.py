@@ -0,0 +1,76 @@
+import sqlite3
+
+from langchain_core.messages import AIMessage
+from langchain_core.outputs import ChatGeneration, Generation
+
+import LLMCache
+from LLMCache import InMemoryLRUCache, SQLiteLLMCache
+
+
+def generations(text: str) -> list:
+    return [ChatGeneration(message=AIMessage(content=text, additional_kwargs={
+        "function_call": {"name": "ListOfTasks", "arguments": "{\"tasks\": []}"}}))]
+
+
+def test_memory_cache_evicts_the_least_recently_used_entry():
+    cache = InMemoryLRUCache(max_entries=2, ttl_seconds=0)
+    cache.update("a", "llm", generations("a"))
+    cache.update("b", "llm", generations("b"))
+    assert cache.lookup("a", "llm") == generations("a")
+    cache.update("c", "llm", generations("c"))
+    assert cache.lookup("b", "llm") is None
+    assert cache.lookup("a", "llm") == generations("a")
+    assert cache.lookup("c", "llm") == generations("c")
+
+
+def test_memory_cache_keys_by_prompt_and_llm_string():
+    cache = InMemoryLRUCache(max_entries=10, ttl_seconds=0)
+    cache.update("prompt", "gpt4o temperature 0.1", generations("a"))
+    assert cache.lookup("prompt", "gpt4o temperature 0.7") is None
+    assert cache.stats() == {"hits": 0, "misses": 1, "hit_rate": 0.0}
+
+
+def test_memory_cache_expires_entries(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(LLMCache.time, "time", lambda: now[0])
+    cache = InMemoryLRUCache(max_entries=10, ttl_seconds=60)
+    cache.update("a", "llm", generations("a"))
+    now[0] += 61
+    assert cache.lookup("a", "llm") is None
+
+
+def test_sqlite_cache_hit_and_miss(tmp_path):
+    path = str(tmp_path / "cache" / "llm_cache.sqlite")
+    cache = SQLiteLLMCache(path, max_entries=10, ttl_seconds=0)
+    assert cache.lookup("prompt", "llm") is None
+    stored = generations("a") + [Generation(text="plain", generation_info={"finish_reason": "stop"})]
+    cache.update("prompt", "llm", stored)
+    # A new connection to the file, as another process would open
+    hit = SQLiteLLMCache(path, max_entries=10, ttl_seconds=0).lookup("prompt", "llm")
+    assert hit == stored
+    assert hit[0].message.additional_kwargs["function_call"]["name"] == "ListOfTasks"
+    assert cache.stats()["misses"] == 1
+
+
+def test_sqlite_cache_evicts_the_least_recently_accessed_entries(tmp_path, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(LLMCache.time, "time", lambda: now[0])
+    cache = SQLiteLLMCache(str(tmp_path / "llm_cache.sqlite"), max_entries=2, ttl_seconds=0)
+    for prompt in ("a", "b"):
+        now[0] += 1
+        cache.update(prompt, "llm", generations(prompt))
+    now[0] += 1
+    cache.lookup("a", "llm")
+    now[0] += 1
+    cache.update("c", "llm", generations("c"))
+    assert cache.lookup("b", "llm") is None
+    assert cache.lookup("a", "llm") == generations("a")
+
+
+def test_sqlite_cache_entries_of_the_previous_format_are_misses(tmp_path):
+    path = str(tmp_path / "llm_cache.sqlite")
+    cache = SQLiteLLMCache(path, max_entries=10, ttl_seconds=0)
+    cache.update("prompt", "llm", generations("a"))
+    with sqlite3.connect(path) as connection:
+        connection.execute("UPDATE llm_cache SET value = ?", ('{"lc": 1, "type": "constructor"}',))
+    assert cache.lookup("prompt", "llm") is None
@@ -0,0 +1,79 @@
+import pytest
+
+from AgentVerifier import AgentVerifier
+from Config import ConfigMapping, config
+from RunReport import RunReport
+from VerificationRules import acceptance_criteria_issues, tasks_issues, user_stories_issues
+from models.AgileCrewModels import BaseTask, BaseUserStory, ListOfAcceptanceCriteria, ListOfTasks, ListOfUserStories
+
+GOOD_TITLE = "As a manager, I want a monthly report so that I can plan."
+
+
+def test_the_user_story_rules():
+    user_stories = ListOfUserStories(user_stories=[
+        BaseUserStory(title=GOOD_TITLE, description="Monthly report"),
+        BaseUserStory(title="Monthly report", description=" "),
+        BaseUserStory(title=GOOD_TITLE.upper(), description="Monthly report")])
+    assert user_stories_issues(user_stories) == [
+        "The title 'Monthly report' does not follow the format: As a <type of user>, I want <some goal> so that "
+        "<some reason>.",
+        "The user story 'Monthly report' has no description.",
+        f"The user story '{GOOD_TITLE.upper()}' is duplicated."]
+    assert user_stories_issues(None) == ["No user stories were created for the feature."]
+
+
+def test_the_acceptance_criteria_and_tasks_rules():
+    assert acceptance_criteria_issues(ListOfAcceptanceCriteria(acceptance_criteria=["Given a, then b.", " ",
+                                                                                     "given a,  then b."])) == \
+        ["Some acceptance criteria are empty.", "The acceptance criterion 'given a,  then b.' is duplicated."]
+    assert tasks_issues(ListOfTasks(tasks=[BaseTask(title="Build", description=""),
+                                           BaseTask(title="", description="Test")])) == \
+        ["The task 'Build' has no description.", "A task has no title."]
+    assert tasks_issues(ListOfTasks(tasks=[])) == ["No tasks were created for the user story."]
+
+
+def tasks_state(tasks: list) -> dict:
+    return {"messages": [], "feature_description": "Export the monthly report", "project_context": "Reporting app",
+            "user_story_to_process": BaseUserStory(title=GOOD_TITLE, description="Monthly report"),
+            "acceptance_criteria_us": [ListOfAcceptanceCriteria(acceptance_criteria=["Given a, then b."])],
+            "tasks": [ListOfTasks(tasks=tasks)], "feedback": "", "verification_attempts": 0, "retry_attempts": {}}
+
+
+@pytest.fixture
+def reviews(chat_models) -> list:
+    """ Prompts reviewed by the tasks verifier agent """
+    reviews = []
+    chat_models.update(responses={"FeedbackOutput": lambda messages: reviews.append(messages) or
+                                  {"feedback": "Good work.", "needs_review": False}})
+    return reviews
+
+
+def run_verifier(tasks: list, trust_passes: bool = False) -> tuple[dict, dict]:
+    run_report = RunReport()
+    with config.override({ConfigMapping.CHECK_TASKS_ENABLED: True, ConfigMapping.PRE_VERIFICATION_ENABLED: True,
+                          ConfigMapping.PRE_VERIFICATION_TRUST_PASSES: trust_passes}):
+        update = AgentVerifier("tasks").create_agent_node().invoke(tasks_state(tasks), {"callbacks": [run_report]})
+    return update, run_report.pre_verification_report()
+
+
+def test_broken_work_goes_back_to_the_creator_without_the_verifier_agent(reviews):
+    update, report = run_verifier([BaseTask(title="Build", description="")])
+    assert update["next"] == "REVIEW"
+    assert "The task 'Build' has no description." in update["feedback"]
+    assert update["verification_attempts"] == 1
+    assert report == {"verifiers": {"tasks": {"REVIEW": 1, "CONTINUE": 0}}, "verifier_runs_avoided": 1}
+    assert reviews == []
+
+
+def test_work_passing_the_rules_is_reviewed_by_the_agent(reviews):
+    update, report = run_verifier([BaseTask(title="Build", description="Build the report")])
+    assert update["next"] == "CONTINUE"
+    assert report == {"verifiers": {}, "verifier_runs_avoided": 0}
+    assert len(reviews) == 1
+
+
+def test_trusted_passes_are_accepted_without_the_verifier_agent(reviews):
+    update, report = run_verifier([BaseTask(title="Build", description="Build the report")], trust_passes=True)
+    assert update["next"] == "CONTINUE"
+    assert report == {"verifiers": {"tasks": {"REVIEW": 0, "CONTINUE": 1}}, "verifier_runs_avoided": 1}
+    assert reviews == []
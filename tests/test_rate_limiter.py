@@ -0,0 +1,81 @@
+import pytest
+
+import RateLimiter
+from RateLimiter import DeploymentRateLimiter, TokenBucket
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch) -> FakeClock:
+    clock = FakeClock()
+    monkeypatch.setattr(RateLimiter.time, "monotonic", clock)
+    return clock
+
+
+def test_bucket_refills_at_its_rate_up_to_its_capacity(clock):
+    bucket = TokenBucket(60)
+    bucket.available = 0
+    bucket.refill(clock.now + 10)
+    assert bucket.available == pytest.approx(10)
+    bucket.refill(clock.now + 600)
+    assert bucket.available == 60
+
+
+def test_bucket_wait_time_covers_the_missing_units(clock):
+    bucket = TokenBucket(60)
+    bucket.available = 5
+    assert bucket.wait_time(5) == 0
+    assert bucket.wait_time(8) == pytest.approx(3)
+    # Larger than the bucket, it waits for a full bucket
+    assert bucket.wait_time(600) == pytest.approx(55)
+
+
+def test_acquire_takes_a_request_and_the_estimated_tokens(clock):
+    limiter = DeploymentRateLimiter("gpt", requests_per_minute=2, tokens_per_minute=1000)
+    assert limiter._try_acquire(400) == 0
+    assert limiter._try_acquire(400) == 0
+    # No request left, one is refilled every 30 seconds
+    assert limiter._try_acquire(100) == pytest.approx(30)
+    clock.now += 30
+    # A request is back but only 200 + 500 tokens
+    assert limiter._try_acquire(800) == pytest.approx(6)
+    clock.now += 6
+    assert limiter._try_acquire(800) == 0
+
+
+def test_settle_charges_the_difference_with_the_actual_usage(clock):
+    limiter = DeploymentRateLimiter("gpt", requests_per_minute=0, tokens_per_minute=1000)
+    limiter._try_acquire(300)
+    limiter.settle(300, 500)
+    assert limiter._tokens.available == pytest.approx(500)
+    limiter._try_acquire(100)
+    limiter.settle(100, 20)
+    assert limiter._tokens.available == pytest.approx(480)
+
+
+def test_settle_of_an_estimate_above_the_capacity_only_returns_what_was_taken(clock):
+    limiter = DeploymentRateLimiter("gpt", requests_per_minute=0, tokens_per_minute=1000)
+    limiter._try_acquire(5000)
+    assert limiter._tokens.available == 0
+    limiter.settle(5000, 5000)
+    assert limiter._tokens.available == pytest.approx(-4000)
+    assert limiter._try_acquire(100) == pytest.approx(246)
+
+
+def test_acquire_waits_until_the_limits_allow_the_call(clock, monkeypatch):
+    def sleep(seconds):
+        clock.now += seconds
+
+    monkeypatch.setattr(RateLimiter.time, "sleep", sleep)
+    limiter = DeploymentRateLimiter("gpt", requests_per_minute=1, tokens_per_minute=0)
+    assert limiter.acquire(10) == 0
+    assert limiter.acquire(10) == pytest.approx(60)
+    assert limiter.stats()["waited_requests"] == 1
+    assert limiter.stats()["waiting"] == 0
@@ -0,0 +1,57 @@
+import asyncio
+
+import pytest
+
+from AgileGraph import AgileCrewGraph
+from Config import ConfigMapping, config
+from FakeChatModel import scripted_arguments
+from RunReport import RunReport
+from models.AgileCrewModels import Feature, Task, UserStory
+
+
+def story_title(messages) -> str:
+    prompt = next(message.content for message in messages if "User story:" in message.content)
+    return prompt.split("User Story '", 1)[1].split("'", 1)[0]
+
+
+@pytest.fixture
+def feature() -> Feature:
+    return Feature(title="Monthly report", description="Export the monthly report", user_stories=[
+        UserStory(title=f"As a manager, I want report {i} so that I can plan.", description=f"Report {i}",
+                  acceptance_criteria=[f"Old criterion {i}"],
+                  tasks=[Task(title=f"Old task {i}", description=f"Old task {i}")]) for i in range(3)])
+
+
+@pytest.fixture
+def crew(chat_models) -> AgileCrewGraph:
+    # The criteria name the story they were written for
+    chat_models.update(responses={"ListOfAcceptanceCriteria": lambda messages: {
+        "acceptance_criteria": [f"Criterion of {story_title(messages)}"]}})
+    return AgileCrewGraph()
+
+
+def test_only_the_edited_stories_are_regenerated(crew, feature):
+    feature.user_stories[1].title = "As an admin, I want an edited report so that I can audit."
+    regenerated = crew.regenerate_user_stories(feature, [1, 1], "Reporting app", verify=False)
+
+    assert regenerated.user_stories[1].acceptance_criteria == [f"Criterion of {feature.user_stories[1].title}"]
+    assert [task.title for task in regenerated.user_stories[1].tasks] == \
+        [task["title"] for task in scripted_arguments("ListOfTasks", 1)["tasks"]]
+    assert regenerated.user_stories[0] == feature.user_stories[0]
+    assert regenerated.user_stories[2] == feature.user_stories[2]
+    # The feature passed in is left as it is
+    assert feature.user_stories[1].acceptance_criteria == ["Old criterion 1"]
+
+
+def test_the_reviews_run_only_with_verify(crew, feature):
+    with config.override({ConfigMapping.CHECK_AC_ENABLED: True, ConfigMapping.CHECK_TASKS_ENABLED: True}):
+        for verify in (True, False):
+            run_report = RunReport()
+            crew.regenerate_user_stories(feature, [0, 2], "Reporting app", verify=verify, run_report=run_report)
+            reviews = {node for node in run_report.prompt_sizes() if node.endswith("_review")}
+            assert reviews == ({"ac_review", "tasks_review"} if verify else set())
+
+
+def test_the_async_regeneration_matches_the_sync_one(crew, feature):
+    regenerated = asyncio.run(crew.aregenerate_user_stories(feature, [2], "Reporting app", verify=False))
+    assert regenerated == crew.regenerate_user_stories(feature, [2], "Reporting app", verify=False)
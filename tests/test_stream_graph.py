@@ -0,0 +1,28 @@
+import threading
+import time
+
+from AgileGraph import AgileCrewGraph
+
+
+def stream_threads() -> list:
+    return [thread for thread in threading.enumerate() if thread.name == "agile-crew-stream"]
+
+
+def test_the_stream_yields_the_accepted_work_then_the_feature(chat_models):
+    chat_models.update(user_stories=2)
+    events = list(AgileCrewGraph().stream_graph("Export the monthly report", "Reporting app"))
+    assert [event["type"] for event in events] == ["user_stories", "acceptance_criteria", "tasks",
+                                                   "acceptance_criteria", "tasks", "feature"]
+    assert [event.get("user_story_index") for event in events[1:5]] == [0, 0, 1, 1]
+    assert len(events[-1]["feature"].user_stories) == 2
+
+
+def test_closing_the_stream_stops_its_run(chat_models):
+    chat_models.update(user_stories=10, latency_seconds=0.2)
+    stream = AgileCrewGraph().stream_graph("Export the monthly report", "Reporting app")
+    assert next(stream)["type"] == "user_stories"
+    stream.close()
+    deadline = time.monotonic() + 3
+    while stream_threads() and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert not stream_threads()
@@ -0,0 +1,32 @@
+import pytest
+
+from AgileGraph import AgileCrewGraph
+from UsageLedger import TokenBudgetExceeded
+
+
+@pytest.fixture
+def crew(chat_models) -> AgileCrewGraph:
+    return AgileCrewGraph()
+
+
+def test_the_usage_is_added_up_per_node_and_user_story(crew):
+    feature, usage = crew.invoke_graph_with_usage("Export the monthly report", "Reporting app", token_budget=0)
+
+    assert len(feature.user_stories) == len(usage["user_stories"])
+    assert usage["total"]["llm_calls"] == sum(node["llm_calls"] for node in usage["nodes"].values())
+    assert usage["total"]["total_tokens"] == sum(node["total_tokens"] for node in usage["nodes"].values())
+    assert usage["total"]["total_tokens"] == \
+        usage["total"]["prompt_tokens"] + usage["total"]["completion_tokens"] > 0
+    # The user stories are created before any user story is processed
+    assert usage["nodes"]["user_story_creation"]["llm_calls"] > 0
+    assert sum(story["llm_calls"] for story in usage["user_stories"].values()) < usage["total"]["llm_calls"]
+
+
+def test_the_run_is_aborted_once_the_budget_is_exceeded(crew):
+    _, usage = crew.invoke_graph_with_usage("Export the monthly report", "Reporting app", token_budget=0)
+    budget = usage["total"]["total_tokens"] // 2
+
+    with pytest.raises(TokenBudgetExceeded) as raised:
+        crew.invoke_graph_with_usage("Export the monthly report", "Reporting app", token_budget=budget)
+    assert raised.value.budget == budget
+    assert budget < raised.value.used < usage["total"]["total_tokens"]